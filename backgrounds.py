@@ -0,0 +1,220 @@
+"""Index of the random background images.
+
+The directory is listed once, and only listed again
+when its mtime changes (checked at most every few
+seconds), so picking a background doesn't touch the
+disk at all.
+
+Backgrounds are shown under a nearly opaque gradient,
+so optimize() can make much smaller variants of them
+ahead of time.
+
+"""
+
+import mimetypes
+import random
+import zlib
+import time
+import os
+
+from PIL import Image, ImageSequence, features
+
+
+class Background(object):
+    """One background image file.
+
+    Attributes:
+        name (str): Filename, unique within the directory.
+        path (str): Absolute path to the file.
+        size (int): In bytes.
+        mtime (float): Last modified, seconds since the epoch.
+        mimetype (str): Guessed from the filename.
+        etag (str): Changes whenever the file does.
+
+    """
+
+    def __init__(self, directory, name):
+        self.name = name
+        self.path = os.path.join(directory, name)
+        stat = os.stat(self.path)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self.mimetype = (mimetypes.guess_type(name)[0] or
+                         "application/octet-stream")
+        self.etag = "%x-%x-%x" % (zlib.adler32(name) & 0xffffffff,
+                                  int(self.mtime), self.size)
+
+
+class BackgroundIndex(object):
+    """Every file in a directory, as Background objects.
+
+    Attributes:
+        directory (str): Absolute path being indexed.
+        rescan_seconds (float): How often to check whether
+            the directory has changed.
+        backgrounds (list[Background]): --
+        by_name (dict): Name to Background.
+
+    """
+
+    def __init__(self, directory, rescan_seconds):
+        self.directory = directory
+        self.rescan_seconds = rescan_seconds
+        self.backgrounds = []
+        self.by_name = {}
+        self.directory_mtime = None
+        self.checked_at = 0
+        self.refresh()
+
+    def refresh(self):
+        """Rescan the directory if it has changed since the last
+        scan, checking no more often than rescan_seconds.
+
+        """
+
+        now = time.time()
+
+        if now - self.checked_at < self.rescan_seconds:
+
+            return
+
+        self.checked_at = now
+
+        try:
+            directory_mtime = os.stat(self.directory).st_mtime
+        except OSError:
+            directory_mtime = None  # e.g., nothing optimized yet
+
+        if directory_mtime == self.directory_mtime:
+
+            return
+
+        backgrounds = []
+
+        for name in sorted(os.listdir(self.directory)
+                           if directory_mtime else []):
+
+            if os.path.isfile(os.path.join(self.directory, name)):
+                backgrounds.append(Background(self.directory, name))
+
+        self.backgrounds = backgrounds
+        self.by_name = dict((background.name, background)
+                            for background in backgrounds)
+        self.directory_mtime = directory_mtime
+
+    def choice(self):
+        """A random Background, or None if there aren't any."""
+
+        self.refresh()
+
+        if not self.backgrounds:
+
+            return None
+
+        return random.choice(self.backgrounds)
+
+    def get(self, name):
+        """The Background called `name`, or None."""
+
+        self.refresh()
+
+        return self.by_name.get(name)
+
+    def variant(self, name, accept):
+        """The best optimized version of the background `name`
+        which the client accepts, if there is one.
+
+        Animated WebP is only sent to clients which explicitly
+        ask for it; the GIF variant is good for anyone.
+
+        Args:
+            name (str): Name of the original Background.
+            accept (str): The request's Accept header.
+
+        Returns:
+            Background|None: From this index of variants.
+
+        """
+
+        stem = os.path.splitext(name)[0]
+
+        if "image/webp" in accept:
+            webp = self.get(stem + ".webp")
+
+            if webp is not None:
+
+                return webp
+
+        return self.get(stem + ".gif")
+
+
+def optimize(background, directory, max_width, colors, frame_step):
+    """Write lightweight variants of a background to `directory`.
+
+    Every variant is downscaled to at most `max_width`, only
+    keeps every `frame_step`th frame (the dropped frames'
+    time goes to the frame before), and is reduced to
+    `colors` colors. An animated WebP is made too if PIL
+    supports it. Variants which turn out no smaller than the
+    original are thrown away.
+
+    Args:
+        background (Background): The original.
+        directory (str): Where variants go; named like the
+            original, but ending in .gif or .webp.
+        max_width (int): In pixels.
+        colors (int): Palette size of the GIF.
+        frame_step (int): 1 keeps every frame.
+
+    Returns:
+        dict: Variant extension (".gif", ".webp") to its size.
+
+    """
+
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+
+    frames = []
+    durations = []
+    image = Image.open(background.path)
+
+    for index, frame in enumerate(ImageSequence.Iterator(image)):
+        duration = frame.info.get("duration") or 100
+
+        if index % frame_step:
+            durations[-1] += duration
+
+            continue
+
+        frame = frame.convert("RGB")
+
+        if frame.size[0] > max_width:
+            height = max(1, frame.size[1] * max_width // frame.size[0])
+            frame = frame.resize((max_width, height), Image.BILINEAR)
+
+        frames.append(frame)
+        durations.append(duration)
+
+    stem = os.path.join(directory, os.path.splitext(background.name)[0])
+    palette_frames = [each.convert("P", palette=Image.ADAPTIVE,
+                                   colors=colors)
+                      for each in frames]
+    palette_frames[0].save(stem + ".gif", save_all=True,
+                           append_images=palette_frames[1:],
+                           duration=durations, loop=0, optimize=True)
+    sizes = {".gif": os.path.getsize(stem + ".gif")}
+
+    if features.check("webp_anim"):
+        frames[0].save(stem + ".webp", save_all=True,
+                       append_images=frames[1:], duration=durations,
+                       loop=0, quality=40, method=4,
+                       background=(0, 0, 0, 0))
+        sizes[".webp"] = os.path.getsize(stem + ".webp")
+
+    for extension, size in list(sizes.items()):
+
+        if size >= background.size:
+            os.remove(stem + extension)
+            del sizes[extension]
+
+    return sizes
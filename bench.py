@@ -0,0 +1,761 @@
+"""staticfuzz benchmarks.
+
+Each benchmark prints one JSON object per line, so
+results can be saved and compared between versions.
+
+Usage:
+    bench.py hub [<listeners>...] [--messages=<n>]
+    bench.py dither [<sizes>...]
+    bench.py index [--requests=<n>]
+    bench.py records [--requests=<n>]
+    bench.py limiter [--requests=<n>]
+    bench.py sqlite [--posters=<n>] [--listeners=<n>] [--posts=<n>]
+    bench.py load [--posters=<n>] [--listeners=<n>] [--posts=<n>]
+                  [--images=<fraction>] [--settings=<file>]
+    bench.py -h | --help
+
+Options:
+    -h --help         Show this screen.
+    --messages=<n>    Messages to publish per run [default: 50].
+    --requests=<n>    Requests per measurement [default: 2000].
+    --posters=<n>     Clients posting at once [default: 8].
+    --listeners=<n>   Clients streaming at once [default: 50].
+    --posts=<n>       Posts per poster [default: 25].
+    --images=<fraction>  Fraction of posts linking to an image,
+                      served locally [default: 0.25].
+    --settings=<file>  Extra settings for the worker under load.
+
+"""
+
+from gevent import monkey
+monkey.patch_all()  # before requests creates any locks
+
+import subprocess
+import resource
+import calendar
+import datetime
+import tempfile
+import shutil
+import gc
+import socket
+import random
+import json
+import time
+import sys
+import os
+
+import docopt
+import flask
+import gevent
+import gevent.event
+import gevent.pywsgi
+import requests
+from PIL import Image
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
+import broadcast
+import glitch
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# Seconds before a request to a worker counts as stuck.
+REQUEST_TIMEOUT = 30
+
+
+def cpu_seconds():
+    """User plus system CPU time used by this process so far."""
+
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+
+    return usage.ru_utime + usage.ru_stime
+
+
+def percentile(values, fraction):
+    """Nearest-rank percentile of `values`, e.g., 0.99."""
+
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))
+
+    return ordered[index]
+
+
+def bench_hub(listeners, messages):
+    """Fan `messages` memories out to `listeners` subscribers.
+
+    Latency is measured from the moment the frame is
+    published until the last listener has received it.
+
+    Returns:
+        dict: Results of the run.
+
+    """
+
+    hub = broadcast.Hub()
+    frame = broadcast.memory_frame({"id": 1, "text": u"x" * 140,
+                                    "timestamp": "2016-01-01T00:00:00Z",
+                                    "thumbnail_url": None,
+                                    "image_status": None})
+    published_at = [None] * messages
+    received_at = [0.0] * messages
+    pending = [listeners]
+    delivered = gevent.event.Event()
+
+    def listen(queue):
+
+        for index in range(messages):
+            queue.get()
+            pending[0] -= 1
+
+            if not pending[0]:
+                received_at[index] = time.time()
+                delivered.set()
+
+    greenlets = [gevent.spawn(listen, hub.subscribe())
+                 for __ in range(listeners)]
+    gevent.sleep(0)
+
+    cpu_started = cpu_seconds()
+
+    for index in range(messages):
+        pending[0] = listeners
+        delivered.clear()
+        published_at[index] = time.time()
+        hub.publish(frame)
+        delivered.wait()
+
+    cpu_used = cpu_seconds() - cpu_started
+    gevent.joinall(greenlets)
+
+    latencies = [received - published for received, published
+                 in zip(received_at, published_at)]
+
+    return {"benchmark": "hub",
+            "listeners": listeners,
+            "messages": messages,
+            "latency_p50_ms": percentile(latencies, 0.5) * 1000,
+            "latency_p99_ms": percentile(latencies, 0.99) * 1000,
+            "cpu_ms_per_message": cpu_used * 1000 / messages,
+            "cpu_us_per_delivery": cpu_used * 1e6 / (messages * listeners)}
+
+
+def noise_image(size, seed=0):
+    """A reproducible grayscale image full of noise."""
+
+    generator = random.Random(seed)
+    image = Image.new('L', (size, size))
+    image.putdata([generator.randint(0, 255) for __ in range(size * size)])
+
+    return image
+
+
+def best_of(function, argument, repeat=3):
+    """Fastest wall time of `repeat` calls, in seconds."""
+
+    timings = []
+
+    for __ in range(repeat):
+        started = time.time()
+        function(argument)
+        timings.append(time.time() - started)
+
+    return min(timings)
+
+
+def bench_dither(size):
+    """Compare every Atkinson dither on a `size` square thumbnail.
+
+    Returns:
+        dict: Best wall time of each implementation.
+
+    """
+
+    image = noise_image(size)
+    results = {"benchmark": "dither", "size": size}
+    implementations = [("reference", glitch.atkinson_dither_reference),
+                       ("python", glitch.atkinson_dither_python)]
+
+    if glitch.numpy is not None:
+        implementations.append(("numpy", glitch.atkinson_dither_numpy))
+
+    for name, function in implementations:
+        results[name + "_ms"] = best_of(function, image) * 1000
+
+    return results
+
+
+def requests_per_second(function, count):
+    """How many times per second `function()` can run."""
+
+    started = time.time()
+
+    for __ in range(count):
+        function()
+
+    return count / (time.time() - started)
+
+
+def bench_index(count):
+    """Requests per second for the index page, rendering from
+    the in-memory board versus querying the database each
+    time like it used to.
+
+    Returns:
+        dict: Results of the run.
+
+    """
+
+    import staticfuzz  # needs config.py; only import it here
+
+    app = staticfuzz.app
+    staticfuzz.limiter.enabled = False
+    client = app.test_client()
+
+    for index in range(10):
+        client.post('/new_memory', data={'text': u"bench memory %d" % index})
+
+    def render_from_query():
+
+        with app.test_request_context('/'):
+            memories = (staticfuzz.Memory.query.
+                        order_by(staticfuzz.Memory.id.asc()).all())
+            flask.render_template('show_memories.html',
+                                  memories=[memory.to_dict()
+                                            for memory in memories])
+            staticfuzz.db.session.remove()
+
+    def render_from_board():
+
+        with app.test_request_context('/'):
+            flask.render_template('show_memories.html',
+                                  memories=staticfuzz.loaded_board().to_list())
+
+    def get_index():
+        client.get('/')
+
+    return {"benchmark": "index",
+            "requests": count,
+            "query_render_per_second": requests_per_second(render_from_query,
+                                                           count),
+            "board_render_per_second": requests_per_second(render_from_board,
+                                                           count),
+            "route_per_second": requests_per_second(get_index, count)}
+
+
+def objects_held(function, count):
+    """How many more garbage collected objects there are per
+    call of `function()`, with every result kept.
+
+    Python 2 has no tracemalloc; this counts what a call
+    leaves allocated, not its temporaries.
+
+    """
+
+    results = []
+    gc.collect()
+    gc.disable()
+
+    try:
+        before = len(gc.get_objects())
+
+        for __ in range(count):
+            results.append(function())
+
+        return (len(gc.get_objects()) - before) / float(count)
+
+    finally:
+        gc.enable()
+
+
+def bench_records(count):
+    """Streaming and rendering memories as ORM objects and
+    dicts (like it used to) versus MemoryRecords.
+
+    Returns:
+        dict: Results of the run.
+
+    """
+
+    import staticfuzz  # needs config.py; only import it here
+
+    app = staticfuzz.app
+    staticfuzz.limiter.enabled = False
+    client = app.test_client()
+
+    for index in range(10):
+        client.post('/new_memory', data={'text': u"bench memory %d" % index})
+
+    with app.app_context():
+        newest = staticfuzz.Memory.query.order_by(
+            staticfuzz.Memory.id.desc()).first().id
+
+    def event_from_objects():
+
+        with app.app_context():
+            memories = (staticfuzz.Memory.query.
+                        filter(staticfuzz.Memory.id >= newest).
+                        order_by(staticfuzz.Memory.id.asc()).all())
+            frames = [broadcast.memory_frame(memory.to_dict())
+                      for memory in memories]
+
+        return memories, frames
+
+    def event_from_records():
+
+        with app.app_context():
+            records = staticfuzz.memory_records(
+                staticfuzz.Memory.id >= newest)
+            frames = [broadcast.memory_frame(record.to_dict())
+                      for record in records]
+
+        return records, frames
+
+    records = staticfuzz.loaded_board().to_list()
+    memory_dicts = [record.to_dict() for record in records]
+
+    def render(memories):
+
+        def render_memories():
+
+            with app.test_request_context('/'):
+                flask.render_template('show_memories.html', memories=memories)
+
+        return render_memories
+
+    return {"benchmark": "records",
+            "requests": count,
+            "object_events_per_second": requests_per_second(
+                event_from_objects, count),
+            "record_events_per_second": requests_per_second(
+                event_from_records, count),
+            "objects_held_per_object_event": objects_held(
+                event_from_objects, count),
+            "objects_held_per_record_event": objects_held(
+                event_from_records, count),
+            "dict_renders_per_second": requests_per_second(
+                render(memory_dicts), count),
+            "record_renders_per_second": requests_per_second(
+                render(records), count),
+            "board_bytes_per_dict": sum(map(sys.getsizeof, memory_dicts)) /
+            len(memory_dicts),
+            "board_bytes_per_record": sum(map(sys.getsizeof, records)) /
+            len(records)}
+
+
+def bench_limiter(count, directory):
+    """Microseconds per rate limit check, for each storage
+    and strategy, by a client with a short history (10 per
+    minute) and a busy one (1000 per minute).
+
+    Each check is a hit by one of 10 clients, in turn, so
+    busy clients have up to count / 10 hits behind them.
+
+    Args:
+        directory (str): Where the sqlite storage goes.
+
+    Returns:
+        dict: Results of the run.
+
+    """
+
+    import limits
+    import limits.storage
+    import limits.strategies
+
+    import ratelimit  # registers "sqlite" and "token-bucket"
+
+    urls = {"memory": "memory://",
+            "sqlite": "sqlite:///" + os.path.join(directory, "limits.db")}
+    setups = [("memory", "fixed-window"), ("memory", "moving-window"),
+              ("sqlite", "fixed-window"), ("sqlite", "token-bucket")]
+    results = {"benchmark": "limiter", "requests": count}
+
+    for storage_name, strategy_name in setups:
+        storage = limits.storage.storage_from_string(urls[storage_name])
+        strategy = limits.strategies.STRATEGIES[strategy_name](storage)
+
+        for amount in (10, 1000):
+            item = limits.parse("%d/minute" % amount)
+            hits = iter(xrange(count))
+
+            def hit():
+                strategy.hit(item, "client%d" % (next(hits) % 10))
+
+            per_second = requests_per_second(hit, count)
+            key = "%s_%s_%d_microseconds" % (storage_name, strategy_name,
+                                             amount)
+            results[key.replace("-", "_")] = 1000000.0 / per_second
+
+        storage.reset()
+
+    return results
+
+
+def free_port():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    listener.close()
+
+    return port
+
+
+def start_worker(directory, settings=""):
+    """Serve staticfuzz from a fresh database file in
+    `directory`, in another process.
+
+    Args:
+        directory (str): Scratch space.
+        settings (str): Extra lines for the settings file.
+
+    Returns:
+        tuple[subprocess.Popen, str]: The worker and its URL.
+
+    """
+
+    port = free_port()
+    settings_path = os.path.join(directory, "bench.cfg")
+
+    with open(settings_path, "w") as settings_file:
+        settings_file.write("SQLALCHEMY_DATABASE_URI = 'sqlite:///%s'\n"
+                            "RATELIMIT_ENABLED = False\n"
+                            "PORT = %d\n" %
+                            (os.path.join(directory, "staticfuzz.db"), port) +
+                            settings)
+
+    environment = dict(os.environ, STATICFUZZ_SETTINGS=settings_path)
+    devnull = open(os.devnull, "w")
+    subprocess.check_call([sys.executable, "staticfuzz.py", "init_db"],
+                          env=environment, cwd=HERE, stderr=devnull)
+    process = subprocess.Popen([sys.executable, "staticfuzz.py", "serve"],
+                               env=environment, cwd=HERE, stderr=devnull)
+    url = "http://127.0.0.1:%d" % port
+
+    for __ in range(100):
+
+        try:
+            requests.get(url + "/")
+
+            break
+
+        except requests.exceptions.ConnectionError:
+            time.sleep(0.1)
+
+    return process, url
+
+
+def bench_sqlite(settings, posters, listeners, posts):
+    """Post from `posters` clients at once while `listeners`
+    clients stream, against a worker using a database file.
+
+    Args:
+        settings (str): Extra settings, e.g., the profile.
+
+    Returns:
+        dict: Results of the run.
+
+    """
+
+    directory = tempfile.mkdtemp()
+    process, url = start_worker(directory, settings)
+    latencies = []
+    frames = [0]
+    streams = []
+
+    def listen():
+        stream = requests.get(url + "/stream/", stream=True)
+        streams.append(stream)
+
+        try:
+
+            for line in stream.iter_lines():
+
+                if line.startswith("data: "):
+                    frames[0] += 1
+
+        except requests.exceptions.RequestException:
+            pass
+
+    def post(poster):
+
+        for index in range(posts):
+            started = time.time()
+            requests.post(url + "/new_memory",
+                          data={"text": "bench %d %d" % (poster, index)},
+                          allow_redirects=False)
+            latencies.append(time.time() - started)
+
+    try:
+        listening = [gevent.spawn(listen) for __ in range(listeners)]
+        gevent.sleep(1)
+        started = time.time()
+        gevent.joinall([gevent.spawn(post, poster)
+                        for poster in range(posters)])
+        gevent.sleep(0.5)  # let the last frames arrive
+        elapsed = time.time() - started
+
+        gevent.killall(listening)
+
+        for stream in streams:
+            stream.close()
+
+    finally:
+        process.kill()
+        process.wait()
+        shutil.rmtree(directory)
+
+    return {"benchmark": "sqlite",
+            "settings": settings.strip(),
+            "posters": posters,
+            "listeners": listeners,
+            "posts": posters * posts,
+            "post_p50_ms": percentile(latencies, 0.5) * 1000,
+            "post_p99_ms": percentile(latencies, 0.99) * 1000,
+            "posts_per_second": len(latencies) / elapsed,
+            "frames_per_second": frames[0] / elapsed}
+
+
+def process_cpu_seconds(pid):
+    """User plus system CPU time used by process `pid` so far."""
+
+    with open("/proc/%d/stat" % pid) as stat_file:
+        fields = stat_file.read().rsplit(")", 1)[1].split()
+
+    return (int(fields[11]) + int(fields[12])) / float(
+        os.sysconf("SC_CLK_TCK"))
+
+
+def process_rss_bytes(pid):
+    """Resident memory of process `pid`."""
+
+    with open("/proc/%d/status" % pid) as status_file:
+
+        for line in status_file:
+
+            if line.startswith("VmRSS:"):
+
+                return int(line.split()[1]) * 1024
+
+    return 0
+
+
+def parse_timestamp(timestamp):
+    """Seconds since the epoch, from `Memory.to_dict()`'s
+    timestamp.
+
+    """
+
+    timestamp = timestamp.rstrip("Z")
+    date_format = "%Y-%m-%dT%H:%M:%S.%f" if "." in timestamp else \
+                  "%Y-%m-%dT%H:%M:%S"
+    moment = datetime.datetime.strptime(timestamp, date_format)
+
+    return calendar.timegm(moment.utctimetuple()) + moment.microsecond / 1e6
+
+
+def serve_images():
+    """Serve a small PNG at every path, like an image host.
+
+    Returns:
+        tuple[gevent.pywsgi.WSGIServer, str]: The server and
+            its URL.
+
+    """
+
+    image_io = StringIO()
+    noise_image(64).save(image_io, "PNG")
+    body = image_io.getvalue()
+
+    def application(environ, start_response):
+        start_response("200 OK", [("Content-Type", "image/png"),
+                                  ("Content-Length", str(len(body)))])
+
+        return [body]
+
+    server = gevent.pywsgi.WSGIServer(("127.0.0.1", 0), application, log=None)
+    server.start()
+
+    return server, "http://127.0.0.1:%d" % server.server_port
+
+
+def bench_load(settings, posters, listeners, posts, images):
+    """Drive a real worker with `listeners` streams open while
+    `posters` clients post at once, some of them links to
+    images on a local server.
+
+    Event latency is from the memory's timestamp, taken as
+    it's written, to the moment each listener reads it.
+    Worker CPU and memory are read from /proc, so this only
+    runs on Linux.
+
+    Args:
+        settings (str): Extra settings for the worker.
+        posters (int): Clients posting at once.
+        listeners (int): Streams open during the run.
+        posts (int): Posts per poster.
+        images (float): Fraction of posts which are images.
+
+    Returns:
+        dict: Results of the run.
+
+    """
+
+    directory = tempfile.mkdtemp()
+    image_server, image_url = serve_images()
+    process, url = start_worker(directory, settings)
+    generator = random.Random(0)
+    post_latencies = []
+    event_latencies = []
+    statuses = {}
+    streams = []
+    connected = gevent.event.Event()
+
+    def listen():
+        stream = requests.get(url + "/stream/", stream=True,
+                              timeout=REQUEST_TIMEOUT)
+        streams.append(stream)
+
+        if len(streams) == listeners:
+            connected.set()
+
+        try:
+
+            for line in stream.iter_lines():
+
+                if not line.startswith("data: "):
+                    continue
+
+                received_at = time.time()
+                data = json.loads(line[len("data: "):])
+
+                if isinstance(data, list):  # new memories
+
+                    for memory in data:
+                        event_latencies.append(
+                            received_at - parse_timestamp(memory["timestamp"]))
+
+        except requests.exceptions.RequestException:
+            pass
+
+    def post(poster):
+
+        for index in range(posts):
+
+            if generator.random() < images:
+                text = "%s/%d-%d.png" % (image_url, poster, index)
+            else:
+                text = "load %d %d" % (poster, index)
+
+            started = time.time()
+
+            try:
+                status = requests.post(url + "/new_memory",
+                                       data={"text": text},
+                                       allow_redirects=False,
+                                       timeout=REQUEST_TIMEOUT).status_code
+            except requests.exceptions.Timeout:
+                status = "timeout"
+
+            post_latencies.append(time.time() - started)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    try:
+        idle_rss = process_rss_bytes(process.pid)
+        listening = [gevent.spawn(listen) for __ in range(listeners)]
+        connected.wait(30)
+        gevent.sleep(0.5)
+        connected_rss = process_rss_bytes(process.pid)
+
+        cpu_started = process_cpu_seconds(process.pid)
+        started = time.time()
+        gevent.joinall([gevent.spawn(post, poster)
+                        for poster in range(posters)])
+        gevent.sleep(1)  # let the last frames and thumbnails arrive
+        elapsed = time.time() - started
+        cpu_used = process_cpu_seconds(process.pid) - cpu_started
+
+        gevent.killall(listening)
+
+        for stream in streams:
+            stream.close()
+
+    finally:
+        process.kill()
+        process.wait()
+        image_server.stop()
+        shutil.rmtree(directory)
+
+    return {"benchmark": "load",
+            "settings": settings.strip(),
+            "posters": posters,
+            "listeners": listeners,
+            "posts": posters * posts,
+            "images": images,
+            "statuses": statuses,
+            "post_p50_ms": percentile(post_latencies, 0.5) * 1000,
+            "post_p99_ms": percentile(post_latencies, 0.99) * 1000,
+            "event_p50_ms": percentile(event_latencies, 0.5) * 1000,
+            "event_p99_ms": percentile(event_latencies, 0.99) * 1000,
+            "events_delivered": len(event_latencies),
+            "worker_cpu_ms_per_listener": cpu_used * 1000 / max(1, listeners),
+            "worker_cpu_ms_per_post": cpu_used * 1000 / (posters * posts),
+            "rss_bytes_per_connection": (connected_rss - idle_rss) /
+            max(1, listeners),
+            "seconds": elapsed}
+
+
+if __name__ == '__main__':
+    arguments = docopt.docopt(__doc__)
+
+    if arguments["hub"]:
+        listener_counts = [int(n) for n in arguments["<listeners>"]]
+
+        for listeners in listener_counts or [100, 1000, 10000]:
+            print(json.dumps(bench_hub(listeners,
+                                       int(arguments["--messages"]))))
+
+    if arguments["dither"]:
+        sizes = [int(n) for n in arguments["<sizes>"]]
+
+        for size in sizes or [90, 180, 360]:
+            print(json.dumps(bench_dither(size)))
+
+    if arguments["index"]:
+        print(json.dumps(bench_index(int(arguments["--requests"]))))
+
+    if arguments["records"]:
+        print(json.dumps(bench_records(int(arguments["--requests"]))))
+
+    if arguments["limiter"]:
+        directory = tempfile.mkdtemp()
+
+        try:
+            print(json.dumps(bench_limiter(int(arguments["--requests"]),
+                                           directory)))
+        finally:
+            shutil.rmtree(directory)
+
+    if arguments["sqlite"]:
+
+        for settings in ("SQLITE_TUNED = False\n", "SQLITE_TUNED = True\n"):
+            print(json.dumps(bench_sqlite(settings,
+                                          int(arguments["--posters"]),
+                                          int(arguments["--listeners"]),
+                                          int(arguments["--posts"]))))
+
+    if arguments["load"]:
+        settings = ""
+
+        if arguments["--settings"]:
+
+            with open(arguments["--settings"]) as settings_file:
+                settings = settings_file.read()
+
+        print(json.dumps(bench_load(settings,
+                                    int(arguments["--posters"]),
+                                    int(arguments["--listeners"]),
+                                    int(arguments["--posts"]),
+                                    float(arguments["--images"]))))
@@ -0,0 +1,160 @@
+"""The memories currently on the board, kept in memory.
+
+The board only ever holds a handful of memories, so each
+worker keeps its own copy. Showing the board and checking
+for reposts then never touch the database, which is only
+written to.
+
+Memories on the board, and on their way to the stream,
+are MemoryRecord tuples rather than ORM objects: they are
+read-only, carry no session state, and their timestamp is
+formatted once, when they are loaded.
+
+"""
+
+import collections
+
+
+class MemoryRecord(collections.namedtuple("MemoryRecord",
+                                          ["id", "text", "timestamp",
+                                           "thumbnail_url",
+                                           "image_status"])):
+    """A memory as it is shown and streamed.
+
+    Attributes:
+        id (int): --
+        text (unicode): --
+        timestamp (str): ISO 8601, in UTC.
+        thumbnail_url (str|None): Where its glitched
+            thumbnail is served, if it has one.
+        image_status (str|None): See `Memory`.
+
+    """
+
+    __slots__ = ()
+
+    @classmethod
+    def from_row(cls, row):
+        """Make a record from the columns `id`, `text`,
+        `timestamp` (datetime), `thumbnail` (ID or None) and
+        `image_status`, of a row or a Memory.
+
+        """
+
+        return cls(row.id, row.text, row.timestamp.isoformat("T") + "Z",
+                   row.thumbnail and "/thumb/" + row.thumbnail,
+                   row.image_status)
+
+    def to_dict(self):
+        """For sending as an event.
+
+        Returns:
+            dict: Looks something like this:
+
+                >>> {'text': "foo", "thumbnail_url": None,
+                ...  "image_status": None, ...}
+
+        """
+
+        return dict(zip(self._fields, self))
+
+
+class Board(object):
+    """Fixed-size, ordered collection of memories.
+
+    Memories are MemoryRecords, added oldest first; adding
+    one to a full board evicts the oldest.
+
+    Attributes:
+        size (int): How many memories fit on the board.
+        memories (OrderedDict): Memory ID to MemoryRecord,
+            oldest first.
+        texts (set[str]): The text of every memory on the
+            board, for checking reposts.
+        loaded (bool): False until `load()` is called.
+        version (int): Changes whenever the board does.
+
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.memories = collections.OrderedDict()
+        self.texts = set()
+        self.loaded = False
+        self.version = 0
+
+    def load(self, records):
+        """Replace the whole board, e.g., from the database.
+
+        Args:
+            records (list[MemoryRecord]): Oldest first.
+
+        """
+
+        self.memories.clear()
+        self.texts.clear()
+        self.loaded = True
+        self.version += 1
+
+        for record in records:
+            self.add(record)
+
+    def add(self, record):
+        """Put a new memory on the board, or update it if it's
+        already there.
+
+        Returns:
+            list[MemoryRecord]: Memories evicted to make room.
+
+        """
+
+        if record.id in self.memories:
+            self.update(record)
+
+            return []
+
+        self.memories[record.id] = record
+        self.texts.add(record.text)
+        self.version += 1
+        evicted = []
+
+        while len(self.memories) > self.size:
+            __, oldest = self.memories.popitem(last=False)
+            self.texts.discard(oldest.text)
+            evicted.append(oldest)
+
+        return evicted
+
+    def update(self, record):
+        """Replace a memory (e.g., its thumbnail is ready), if
+        it's still on the board.
+
+        """
+
+        if record.id in self.memories:
+            self.memories[record.id] = record
+            self.version += 1
+
+    def remove(self, memory_id):
+        """Take a memory off the board, if it's there."""
+
+        record = self.memories.pop(memory_id, None)
+
+        if record is not None:
+            self.texts.discard(record.text)
+            self.version += 1
+
+    def has_text(self, text):
+        """True if some memory on the board says `text`."""
+
+        return text in self.texts
+
+    def to_list(self):
+        """The memories, oldest first.
+
+        Returns:
+            list[MemoryRecord]: --
+
+        """
+
+        return list(self.memories.values())
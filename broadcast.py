@@ -0,0 +1,441 @@
+"""Fan new memories out to everyone who is listening.
+
+A single Hub lives in each worker. Every /stream/
+connection blocks on its own queue until something is
+published, so idle listeners never touch the database.
+
+Routes don't publish to the Hub directly. They publish
+small messages, like {"event": "memory", "id": 5}, to a
+Backend, which hands them to every worker. Each worker
+then turns the message into frames for its own Hub.
+
+"""
+
+import logging
+import socket
+import fcntl
+import json
+import os
+
+import gevent
+import gevent.lock
+import gevent.queue
+
+
+logger = logging.getLogger(__name__)
+
+
+def sse_frame(data, event=None, event_id=None):
+    """Build the bytes of one server-sent event.
+
+    Args:
+        data (str): The event's data field, already serialized.
+        event (str|None): Optional event name. Unnamed events
+            are delivered to the client's `onmessage`.
+        event_id (int|None): Optional ID; the client sends the
+            last one it saw as Last-Event-ID when reconnecting.
+
+    Returns:
+        str: A complete frame, ending in a blank line.
+
+    """
+
+    frame = "data: " + data + "\n\n"
+
+    if event:
+        frame = "event: " + event + "\n" + frame
+
+    if event_id is not None:
+        frame = "id: %d\n" % event_id + frame
+
+    return frame
+
+
+def memory_frame(memory_dict):
+    """Serialize a memory into the frame `onmessage` expects.
+
+    Args:
+        memory_dict (dict): From `MemoryRecord.to_dict()`.
+
+    Returns:
+        str: An unnamed event, with the memory's ID as its
+            ID, whose data is a JSON list of one memory.
+
+    """
+
+    return sse_frame(json.dumps([memory_dict]), event_id=memory_dict["id"])
+
+
+def retry_frame(milliseconds):
+    """Tell the client how long to wait before reconnecting."""
+
+    return "retry: %d\n\n" % milliseconds
+
+
+def heartbeat_frame():
+    """A comment, which clients ignore; writing it is how a
+    stream notices its client is gone.
+
+    """
+
+    return ":\n\n"
+
+
+def forget_frame(memory_id):
+    """Serialize the event telling clients a memory is gone.
+
+    Args:
+        memory_id (int): ID of the forgotten memory.
+
+    Returns:
+        str: A "forget" event.
+
+    """
+
+    return sse_frame(json.dumps({"id": memory_id}), event="forget")
+
+
+def thumbnail_frame(memory_dict):
+    """Serialize the event carrying a finished thumbnail.
+
+    Args:
+        memory_dict (dict): From `MemoryRecord.to_dict()`.
+
+    Returns:
+        str: A "thumbnail" event.
+
+    """
+
+    return sse_frame(json.dumps(memory_dict), event="thumbnail")
+
+
+def command_frame(ticket, message, status):
+    """Serialize the outcome of a slash command which ran in
+    the background.
+
+    Args:
+        ticket (str): Given to whoever posted the command.
+        message (str): e.g., "No matches!"
+        status (int): HTTP status it would have been answered
+            with, had it not run in the background.
+
+    Returns:
+        str: A "command" event.
+
+    """
+
+    return sse_frame(json.dumps({"ticket": ticket, "message": message,
+                                 "status": status}), event="command")
+
+
+class Hub(object):
+    """In-process broadcast hub.
+
+    Payloads are serialized once by the publisher and the
+    very same string is put on every subscriber's queue.
+
+    A subscriber which falls `max_queued` payloads behind
+    (its client stopped reading) is dropped rather than
+    queued for without end.
+
+    Attributes:
+        subscribers (set[gevent.queue.Queue]): One queue
+            per open stream.
+        max_queued (int|None): None queues without limit.
+        dropped (int): Subscribers dropped for falling
+            behind, so far.
+
+    """
+
+    def __init__(self, max_queued=None):
+        self.subscribers = set()
+        self.max_queued = max_queued
+        self.dropped = 0
+
+    def subscribe(self):
+        """Start listening.
+
+        Returns:
+            gevent.queue.Queue: Every published payload is
+                put on this queue until `unsubscribe()`, or
+                until it's full and dropped.
+
+        """
+
+        queue = gevent.queue.Queue(self.max_queued)
+        self.subscribers.add(queue)
+
+        return queue
+
+    def unsubscribe(self, queue):
+        """Stop delivering payloads to `queue`.
+
+        Args:
+            queue (gevent.queue.Queue): From `subscribe()`.
+
+        """
+
+        self.subscribers.discard(queue)
+
+    def publish(self, payload):
+        """Deliver `payload` to every subscriber.
+
+        Args:
+            payload (str): Already serialized frame(s).
+
+        Returns:
+            int: How many subscribers it was delivered to.
+
+        """
+
+        subscribers = tuple(self.subscribers)
+        delivered = 0
+
+        for queue in subscribers:
+
+            try:
+                queue.put_nowait(payload)
+            except gevent.queue.Full:
+                self.unsubscribe(queue)
+                self.dropped += 1
+                continue
+
+            delivered += 1
+
+        return delivered
+
+
+class Backend(object):
+    """Pub/sub between workers; subclass to add a broker.
+
+    A backend must deliver every published message to the
+    handler of every listening worker (including the one
+    which published it), in the same order for everyone.
+
+    """
+
+    def publish(self, message):
+        """Send `message` to every listening worker.
+
+        Args:
+            message (dict): Must be JSON serializable.
+
+        """
+
+        raise NotImplementedError
+
+    def listen(self, handler):
+        """Start calling `handler(message)` for each message.
+
+        Args:
+            handler (callable): Takes one message (dict).
+
+        """
+
+        raise NotImplementedError
+
+
+class InProcessBackend(Backend):
+    """Single worker; messages go straight to the handler."""
+
+    def __init__(self):
+        self.handlers = []
+
+    def publish(self, message):
+
+        for handler in self.handlers:
+            handler(message)
+
+    def listen(self, handler):
+        self.handlers.append(handler)
+
+
+class UnixSocketBackend(Backend):
+    """Workers on one host, relayed over a Unix domain socket.
+
+    Whichever worker manages to lock `path + ".lock"` binds
+    the socket and becomes the broker; every worker,
+    including that one, connects to it as a client. The
+    broker relays each line it reads to every client. The
+    lock is released when the broker's process dies, at
+    which point another worker takes over.
+
+    Messages are newline-delimited JSON.
+
+    """
+
+    RETRY_DELAY = 0.1
+
+    def __init__(self, path):
+        self.path = path
+        self.lock_path = path + ".lock"
+        self.connection = None
+        self.connecting = gevent.lock.Semaphore()
+        self.broker = None
+
+    def publish(self, message):
+        line = json.dumps(message) + "\n"
+
+        while True:
+            connection = self.connect()
+
+            try:
+                connection.sendall(line)
+
+                return
+
+            except socket.error:
+                self.disconnect(connection)
+
+    def listen(self, handler):
+        gevent.spawn(self.receive, handler)
+
+    def connect(self):
+        """Return the connection to the broker, (re)connecting
+        and, if there is no broker, becoming it as needed.
+
+        """
+
+        with self.connecting:
+
+            while self.connection is None:
+                self.elect()
+                connection = socket.socket(socket.AF_UNIX,
+                                           socket.SOCK_STREAM)
+
+                try:
+                    connection.connect(self.path)
+                    self.connection = connection
+
+                except socket.error:
+                    connection.close()
+                    gevent.sleep(self.RETRY_DELAY)
+
+        return self.connection
+
+    def disconnect(self, connection):
+
+        if self.connection is connection:
+            self.connection = None
+
+        connection.close()
+
+    def receive(self, handler):
+        """Read messages from the broker forever."""
+
+        while True:
+            connection = self.connect()
+            lines = connection.makefile("rb")
+
+            try:
+
+                for line in lines:
+
+                    try:
+                        handler(json.loads(line))
+                    except Exception:
+                        logger.exception("broadcast handler failed")
+
+            except socket.error:
+                pass
+
+            lines.close()
+            self.disconnect(connection)
+
+    def elect(self):
+        """Become the broker, unless some process already is."""
+
+        if self.broker is not None:
+
+            return
+
+        lock = open(self.lock_path, "a")
+
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+        except IOError:
+            lock.close()
+
+            return
+
+        # we hold the lock, so any socket file left behind
+        # belongs to a broker which has since died
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(self.path)
+        server.listen(128)
+        self.broker = gevent.spawn(self.serve, server, lock)
+
+    def serve(self, server, lock):
+        """Broker: relay every line from any client to all.
+
+        Lines from every client go through one queue, so all
+        clients receive them in the same order. `lock` is only
+        held on to; closing it would let another broker in.
+
+        """
+
+        clients = set()
+        lines = gevent.queue.Queue()
+
+        def read(client):
+            incoming = client.makefile("rb")
+
+            try:
+
+                for line in incoming:
+                    lines.put(line)
+
+            except socket.error:
+                pass
+
+            clients.discard(client)
+            incoming.close()
+            client.close()
+
+        def write():
+
+            for line in lines:
+
+                for client in tuple(clients):
+
+                    try:
+                        client.sendall(line)
+                    except socket.error:
+                        clients.discard(client)
+
+        gevent.spawn(write)
+
+        while True:
+            client, __ = server.accept()
+            clients.add(client)
+            gevent.spawn(read, client)
+
+
+def backend_from_uri(uri):
+    """Build the backend described by `uri`.
+
+    Args:
+        uri (str): Either "memory://" for a single worker, or
+            "unix:///path/to/socket" for workers on one host.
+
+    Returns:
+        Backend: --
+
+    Raises:
+        ValueError: The scheme isn't supported.
+
+    """
+
+    if uri == "memory://":
+
+        return InProcessBackend()
+
+    if uri.startswith("unix://"):
+
+        return UnixSocketBackend(uri[len("unix://"):])
+
+    raise ValueError("Unsupported broadcast backend: %s" % uri)
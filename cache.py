@@ -0,0 +1,278 @@
+"""Small, bounded caches with counters.
+
+"""
+
+import collections
+import time
+import os
+
+
+# Pruning the disk tier leaves it this full.
+PRUNE_FRACTION = 0.9
+
+
+class LRUCache(object):
+    """Least recently used cache of strings, bounded in bytes.
+
+    Optionally backed by a directory: everything put in the
+    cache is also written there, and a miss in memory falls
+    back to disk before giving up. The directory is bounded
+    separately and pruned oldest-first.
+
+    Listing the directory costs as much as it has files, so
+    it's only done when the bytes written since it was last
+    listed may put it over max_disk_bytes; pruning then
+    leaves room (PRUNE_FRACTION of it) for a while of
+    writes. Processes sharing a directory only count their
+    own writes, so it may overshoot by what the others wrote
+    since this one last listed it.
+
+    Attributes:
+        max_bytes (int): Memory tier limit.
+        directory (str|None): Disk tier, if any.
+        max_disk_bytes (int|None): Disk tier limit.
+        disk_size (int|None): The disk tier's size when last
+            listed, plus what was written since; None until
+            the first write.
+        counters (dict): hits, disk_hits, misses, evictions
+            and disk_evictions so far.
+
+    """
+
+    def __init__(self, max_bytes, directory=None, max_disk_bytes=None):
+        self.max_bytes = max_bytes
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+        self.disk_size = None
+        self.entries = collections.OrderedDict()
+        self.size = 0
+        self.counters = {"hits": 0,
+                         "disk_hits": 0,
+                         "misses": 0,
+                         "evictions": 0,
+                         "disk_evictions": 0}
+
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get(self, key):
+        """Return the value cached for `key`, or None."""
+
+        value = self.entries.pop(key, None)
+
+        if value is not None:
+            self.entries[key] = value  # most recently used
+            self.counters["hits"] += 1
+
+            return value
+
+        value = self.read(key)
+
+        if value is None:
+            self.counters["misses"] += 1
+
+            return None
+
+        self.counters["disk_hits"] += 1
+        self.remember(key, value)
+
+        return value
+
+    def put(self, key, value):
+        """Cache `value` (str) under `key` (a filename-safe str)."""
+
+        self.remember(key, value)
+
+        if self.directory:
+            self.write(key, value)
+
+    def remember(self, key, value):
+        """Put in the memory tier, evicting as needed."""
+
+        old_value = self.entries.pop(key, None)
+
+        if old_value is not None:
+            self.size -= len(old_value)
+
+        if len(value) > self.max_bytes:
+
+            return
+
+        self.entries[key] = value
+        self.size += len(value)
+
+        while self.size > self.max_bytes:
+            __, evicted = self.entries.popitem(last=False)
+            self.size -= len(evicted)
+            self.counters["evictions"] += 1
+
+    def read(self, key):
+
+        if not self.directory:
+
+            return None
+
+        path = os.path.join(self.directory, key)
+
+        try:
+
+            with open(path, "rb") as cached_file:
+                value = cached_file.read()
+
+        except (IOError, OSError):
+
+            return None
+
+        os.utime(path, None)  # so pruning sees it was used
+
+        return value
+
+    def write(self, key, value):
+        path = os.path.join(self.directory, key)
+        partial_path = path + ".partial"
+
+        with open(partial_path, "wb") as cached_file:
+            cached_file.write(value)
+
+        os.rename(partial_path, path)
+
+        if self.max_disk_bytes is None:
+
+            return
+
+        if self.disk_size is not None:
+            self.disk_size += len(value)
+
+        if self.disk_size is None or self.disk_size > self.max_disk_bytes:
+            self.prune()
+
+    def prune(self):
+        """Delete the least recently used files until the disk
+        tier fits in PRUNE_FRACTION of max_disk_bytes.
+
+        """
+
+        files = []
+
+        for name in os.listdir(self.directory):
+            path = os.path.join(self.directory, name)
+
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+
+            files.append((stat.st_mtime, stat.st_size, path))
+
+        total = sum(size for __, size, __ in files)
+        target = self.max_disk_bytes * PRUNE_FRACTION
+
+        if total <= self.max_disk_bytes:
+            target = total  # over only by this process's count
+
+        for __, size, path in sorted(files):
+
+            if total <= target:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            total -= size
+            self.counters["disk_evictions"] += 1
+
+        self.disk_size = total
+
+    def stats(self):
+        """Counters, plus the memory tier's size.
+
+        Returns:
+            dict: Something like this:
+
+                >>> {"entries": 3, "bytes": 412000, "hits": 5,
+                ...  "disk_hits": 0, "misses": 3, "evictions": 0,
+                ...  "disk_evictions": 0}
+
+        """
+
+        stats = dict(self.counters)
+        stats["entries"] = len(self.entries)
+        stats["bytes"] = self.size
+
+        return stats
+
+
+class TTLCache(object):
+    """Least recently used cache of anything, bounded in
+    entries, whose entries also expire.
+
+    Attributes:
+        max_entries (int): --
+        ttl (float): Seconds an entry stays fresh.
+        counters (dict): hits, misses, expirations and
+            evictions so far.
+
+    """
+
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.entries = collections.OrderedDict()
+        self.counters = {"hits": 0,
+                         "misses": 0,
+                         "expirations": 0,
+                         "evictions": 0}
+
+    def get(self, key):
+        """Return the value cached for `key`, or None if there
+        isn't one or it has expired.
+
+        """
+
+        entry = self.entries.pop(key, None)
+
+        if entry is None:
+            self.counters["misses"] += 1
+
+            return None
+
+        expires, value = entry
+
+        if expires < time.time():
+            self.counters["expirations"] += 1
+            self.counters["misses"] += 1
+
+            return None
+
+        self.entries[key] = entry  # most recently used
+        self.counters["hits"] += 1
+
+        return value
+
+    def put(self, key, value):
+        """Cache `value` under `key`, fresh for `ttl` seconds."""
+
+        self.entries.pop(key, None)
+        self.entries[key] = (time.time() + self.ttl, value)
+
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+            self.counters["evictions"] += 1
+
+    def stats(self):
+        """Counters, plus how many entries there are.
+
+        Returns:
+            dict: Something like this:
+
+                >>> {"entries": 3, "hits": 5, "misses": 3,
+                ...  "expirations": 1, "evictions": 0}
+
+        """
+
+        stats = dict(self.counters)
+        stats["entries"] = len(self.entries)
+
+        return stats
@@ -0,0 +1,161 @@
+"""IRC-like slash commands, like "/login secret".
+
+Commands are classes, registered by name with a
+SlashCommandRegistry. A post is only parsed if it starts
+with a slash, and then only once: the leading /word picks
+the command out of a dict, and the rest are its args.
+
+Commands marked ASYNC (because they do slow network or
+CPU work) don't run while the poster waits; the app runs
+them in the background and tells the poster how it went
+over the event stream.
+
+"""
+
+import inspect
+
+
+class SlashCommandResponse(object):
+    """All SlashCommand.callback() methods must return this.
+
+    Attributes:
+        create_memory (bool): If True create a memory using
+            value attribute. Otherwise serve value as a
+            response.
+        value (tuple[str, int]|str): Either a tuple which
+            holds a status message and an HTTP error code,
+            or a string to create a memory. Example values:
+
+                >>> "some memory text"
+                >>> ("Bad ID", 400)
+
+    See Also:
+        SlashCommand
+
+    """
+
+    def __init__(self, create_memory, value):
+        """The result of a slash command.
+
+        Args:
+            create_memory (bool): If True the value will be
+                used to create a memory. If False value will be
+                sent as a response, e.g., "Invalid URI," 400.
+            value (any): A string to be used for creating a
+                memory, or a response to be sent like:
+
+                >>> ("Invalid Shipping Address", 400)
+
+        Examples:
+
+            >>> SlashCommandResponse(False, ("Bad thing!", 400))
+            >>> SlashCommandResponse(True, "some kinda memory text")
+
+        """
+
+        self.create_memory = create_memory
+        self.value = value
+
+
+class SlashCommand(object):
+    """IRC-like command; a more complicated memory.
+
+    Subclasses set NAME, override callback() and are added
+    to a SlashCommandRegistry.
+
+    Attributes:
+        NAME (str): What comes after the slash.
+        ASYNC (bool): If True, callback() runs in the
+            background, outside of any request: it can't use
+            the session, and any response other than a memory
+            must be a (message, status) tuple.
+
+    """
+
+    NAME = str()
+    ASYNC = False
+
+    @staticmethod
+    def callback(*args):
+        """Ovverride this with another staticmethod; do something
+        with the args, return a SlashCommandResponse.
+
+        Use any number of args you please (including 0) or *args
+        (variable length).
+
+        """
+
+        pass
+
+    @classmethod
+    def accepts(cls, arg_count):
+        """True if callback() can be called with `arg_count`
+        args, so errors inside it are never mistaken for the
+        poster's.
+
+        """
+
+        arg_names, varargs, __, defaults = inspect.getargspec(cls.callback)
+        fewest = len(arg_names) - len(defaults or ())
+
+        if arg_count < fewest:
+
+            return False
+
+        return varargs is not None or arg_count <= len(arg_names)
+
+
+class SlashCommandRegistry(object):
+    """Every slash command, by name.
+
+    Attributes:
+        commands (dict): NAME to SlashCommand subclass.
+
+    """
+
+    def __init__(self):
+        self.commands = {}
+
+    def register(self, command):
+        """Class decorator: make /NAME run `command`.
+
+        >>> @slash_commands.register
+        ... class SlashPing(SlashCommand):
+        ...     NAME = u"ping"
+
+        """
+
+        if command.NAME in self.commands:
+
+            raise ValueError("/%s is already a command" % command.NAME)
+
+        self.commands[command.NAME] = command
+
+        return command
+
+    def find(self, text):
+        """The command `text` runs, and its args.
+
+        Like the command's name, the args are lowercase.
+
+        Args:
+            text (str): A post, stripped.
+
+        Returns:
+            tuple[type, list[str]]|None: None if `text`
+                doesn't start with a registered /NAME.
+
+        """
+
+        if not text.startswith("/"):
+
+            return None
+
+        words = text.lower().split()
+        command = self.commands.get(words[0][1:])
+
+        if command is None:
+
+            return None
+
+        return command, words[1:]
@@ -10,6 +10,36 @@
 # Use sqlite memory database (never touches disk):
 SQLALCHEMY_DATABASE_URI = 'sqlite:///:memory:'
 
+# Tune a sqlite database file for serving: write-ahead
+# logging (readers don't wait for the writer), only
+# syncing at checkpoints, memory-mapped reads, waiting
+# SQLITE_BUSY_TIMEOUT_MS for locks instead of failing,
+# and a pool of SQLITE_POOL_SIZE reused connections.
+# Has no effect on other databases, or :memory:.
+SQLITE_TUNED = False
+SQLITE_BUSY_TIMEOUT_MS = 5000
+SQLITE_MMAP_BYTES = 64 * 1024 * 1024
+SQLITE_POOL_SIZE = 5
+
+# Where rate limits are counted. 'memory://' counts in
+# each worker, so with several workers a client gets
+# each limit once per worker. Workers on one host can
+# share a sqlite file instead (see ratelimit.py):
+#
+#   RATELIMIT_STORAGE_URL = 'sqlite:////tmp/staticfuzz-limits.db'
+#   RATELIMIT_STORAGE_OPTIONS = {"cleanup_seconds": 60}
+#
+# RATELIMIT_STRATEGY is 'fixed-window', 'moving-window'
+# (remembers every hit, so costs more the busier a client
+# is) or, with sqlite storage, 'token-bucket' (one
+# number per client and limit, whatever the traffic).
+RATELIMIT_STORAGE_URL = 'memory://'
+RATELIMIT_STRATEGY = 'fixed-window'
+
+# Serve counters and timings at /metrics, in Prometheus'
+# text format.
+METRICS_ENABLED = True
+
 # Port to listen on when serving
 PORT = 5000
 
@@ -25,24 +55,130 @@ FIRST_MESSAGE = u'scream into the void'
 THUMB_MAX_HEIGHT = 360
 THUMB_MAX_WIDTH = 360
 
+# Linked images bigger than this many bytes, or which
+# take longer than this many seconds to download, are
+# treated as plain text.
+IMAGE_MAX_BYTES = 4 * 1024 * 1024
+IMAGE_FETCH_TIMEOUT = 5
+
+# Images claiming more pixels than this are refused as
+# soon as their header is downloaded: a small file can
+# decode to gigabytes.
+IMAGE_MAX_PIXELS = 25 * 1000 * 1000
+
+# Thumbnails are glitched in the background by this
+# many workers per process. At most THUMBNAIL_QUEUE_SIZE
+# images may be waiting; beyond that, image memories are
+# refused with ERROR_BUSY. A job taking longer than
+# THUMBNAIL_TIMEOUT seconds is given up on.
+THUMBNAIL_WORKERS = 2
+THUMBNAIL_QUEUE_SIZE = 32
+THUMBNAIL_TIMEOUT = 30
+
+# Slow slash commands (like /danbooru) run in the
+# background, on this many workers per process, with at
+# most COMMAND_QUEUE_SIZE waiting; their outcome is sent
+# over the event stream. One taking longer than
+# COMMAND_TIMEOUT seconds is given up on.
+COMMAND_WORKERS = 4
+COMMAND_QUEUE_SIZE = 32
+COMMAND_TIMEOUT = 30
+
+# Glitching is CPU work, which would stall every stream
+# the worker serves, so it's done in GLITCH_PROCESSES
+# child processes (0 glitches in the worker itself). A
+# glitch taking over GLITCH_TIMEOUT seconds is given up on
+# and its process replaced.
+GLITCH_PROCESSES = 2
+GLITCH_TIMEOUT = 20
+
+# /danbooru searches DANBOORU_URL, giving up after
+# DANBOORU_TIMEOUT seconds. Results are cached for
+# DANBOORU_CACHE_SECONDS, up to DANBOORU_CACHE_SIZE
+# searches, and the DANBOORU_PREFETCH most popular
+# searches are refreshed before they expire (0 doesn't).
+DANBOORU_URL = 'https://danbooru.donmai.us'
+DANBOORU_TIMEOUT = 5
+DANBOORU_CACHE_SECONDS = 5 * 60
+DANBOORU_CACHE_SIZE = 256
+DANBOORU_PREFETCH = 8
+
+# Resized source images are cached, so reposts of the
+# same image only redo the random part of the glitch.
+# The cache holds up to GLITCH_CACHE_BYTES in memory
+# and, if GLITCH_CACHE_DIRECTORY is set, up to
+# GLITCH_CACHE_DISK_BYTES on disk.
+#
+# Each of the GLITCH_PROCESSES has its own memory tier,
+# and they take turns, so a repost usually lands on a
+# process which hasn't seen the image: set a directory
+# for them to share (each prunes it by its own count, so
+# it may grow to GLITCH_PROCESSES times the limit).
+GLITCH_CACHE_BYTES = 32 * 1024 * 1024
+GLITCH_CACHE_DIRECTORY = None
+GLITCH_CACHE_DISK_BYTES = 256 * 1024 * 1024
+
 # Images are indexed to a random number of colors
 # between MIN_COLORS and MAX_COLORS.
 MIN_COLORS = 2
 MAX_COLORS = 10
 
-# How long to wait before the server checks for new
-# memories/sends an event. 
+# Glitch with one of glitch.PRESETS ("gentle", "harsh" or
+# "mono"), fixing some of the parameters which would
+# otherwise be random. None picks them all at random.
+GLITCH_PRESET = None
+
+# How workers tell each other about new and forgotten
+# memories. A single worker can keep it in-process:
+#
+#   BROADCAST_BACKEND = 'memory://'
+#
+# Several workers on one host (gunicorn -w 4) need
+# to share a Unix domain socket:
 #
-# The time to wait between each iteration in the
-# server event loop. How long before the server
-# checks for new memories and sends a new event.
-SLEEP_RATE = 0.2
+#   BROADCAST_BACKEND = 'unix:///tmp/staticfuzz-broadcast.sock'
+BROADCAST_BACKEND = 'memory://'
 
 # When EventSource (javascript) is disconnected
 # from the server, it will wait these many MS
 # before trying to connect to it again.
 RETRY_TIME_MS = 3000
 
+# Every failed reconnect doubles the wait, up to this
+# many MS, so a worker coming back up isn't stampeded.
+STREAM_MAX_RETRY_MS = 60000
+
+# Each worker serves at most STREAM_MAX_CONNECTIONS
+# streams; more are refused at once with a 503, asking
+# the client to retry in STREAM_BUSY_RETRY_MS (with both
+# Retry-After and a retry: field). Browsers can't read
+# either from a 503, so the page waits at least
+# STREAM_BUSY_RETRY_MS whenever a stream fails to open.
+STREAM_MAX_CONNECTIONS = 1000
+STREAM_BUSY_RETRY_MS = 10000
+
+# A stream with nothing to send for this many seconds
+# sends a comment instead, keeping proxies from timing it
+# out and noticing clients which are gone.
+STREAM_HEARTBEAT_SECONDS = 15
+
+# A stream which falls this many events behind (its
+# client stopped reading) is closed; the client catches
+# up when it reconnects.
+STREAM_QUEUE_SIZE = 100
+
+# A stream whose client doesn't take a write for this
+# many seconds (it stopped reading) is closed.
+STREAM_WRITE_TIMEOUT = 60
+
+# How many memories are kept; posting another forgets
+# the oldest.
+BOARD_SIZE = 10
+
+# How many of the latest memories each worker keeps,
+# ready to send, for clients resuming their stream.
+SSE_REPLAY_SIZE = 20
+
 # If you submit `/login lain` (or whatever your
 # secret is) it will log you in (refresh to see)
 # and you can delete memories.
@@ -74,11 +210,33 @@ ERROR_TOO_LONG = u"Too long!"
 ERROR_UNORIGINAL = u"Unoriginal!"
 ERROR_RATE_EXCEEDED = u"Not so fast!"
 ERROR_DANBOORU = u"No matches!"
+ERROR_BUSY = u"Too busy, try again!"
 
 # Used for backgrounds right now! Path to directory
 # of images to rotate.
 RANDOM_IMAGE_DIRECTORY = "static/backgrounds/"
 
+# The directory is only listed again if it changed,
+# which is checked at most every this many seconds.
+RANDOM_IMAGE_RESCAN_SECONDS = 10
+
+# If True, /random_image redirects to a stable URL for
+# the chosen image, which browsers keep in their cache
+# for BACKGROUND_CACHE_SECONDS, instead of downloading
+# a whole new image for every message.
+RANDOM_IMAGE_REDIRECT = True
+BACKGROUND_CACHE_SECONDS = 24 * 60 * 60
+
+# `staticfuzz.py optimize_backgrounds` writes smaller
+# versions of every background here: at most
+# BACKGROUND_MAX_WIDTH wide, BACKGROUND_COLORS colors
+# and only every BACKGROUND_FRAME_STEP-th frame. Those
+# are served instead of the originals when they exist.
+BACKGROUND_VARIANT_DIRECTORY = "static/backgrounds-optimized/"
+BACKGROUND_MAX_WIDTH = 400
+BACKGROUND_COLORS = 32
+BACKGROUND_FRAME_STEP = 2
+
 # This is the placeholder used in the memory diamond
 # (text input) for submitting memories.
 PLACEHOLDER = "tell me a memory"
@@ -0,0 +1,211 @@
+"""Search Danbooru for /danbooru, without waiting on it twice.
+
+Results are cached for a while by their tags, in any
+order or case, so repeating a command doesn't touch the
+network. A search which is already under way is waited
+on rather than sent again, and the most popular searches
+are refreshed in the background before they expire.
+
+Every request goes through one pool of keep-alive
+connections, and gives up after a timeout.
+
+"""
+
+import collections
+import urlparse
+
+import gevent
+import gevent.event
+import requests
+import requests.adapters
+
+import ingest
+
+
+# How many posts a search asks for.
+PAGE_SIZE = 10
+
+session = requests.Session()
+session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=8))
+session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=8))
+
+
+class DanbooruUnavailable(Exception):
+    """Danbooru didn't answer, or answered nonsense."""
+
+    pass
+
+
+def normalize_tags(tags):
+    """The cache key for a search.
+
+    >>> normalize_tags(["Goo_Girl", "1girl", "goo_girl"])
+    '1girl goo_girl'
+
+    """
+
+    return " ".join(sorted(set(tag.lower() for tag in tags)))
+
+
+class Danbooru(object):
+    """Cached searches of one Danbooru site.
+
+    Attributes:
+        base_url (str): e.g., "https://danbooru.donmai.us"
+        timeout (float): Seconds to wait for it to connect or
+            respond.
+        results (cache.TTLCache): Search key (see
+            `normalize_tags()`) to image links.
+        prefetch_count (int): How many of the most popular
+            searches to keep fresh; 0 doesn't start the
+            prefetching greenlet at all.
+        searches (Counter): Search key to how often it was
+            searched for since the last prefetch.
+        counters (dict): requests, failed and prefetched so far.
+
+    """
+
+    def __init__(self, base_url, timeout, results, prefetch_count=0):
+        self.base_url = base_url
+        self.timeout = timeout
+        self.results = results
+        self.prefetch_count = prefetch_count
+        self.searches = collections.Counter()
+        self.pending = {}
+        self.prefetcher = None
+        self.counters = {"requests": 0, "failed": 0, "prefetched": 0}
+
+    def search(self, tags):
+        """Links to images from the first page of posts tagged
+        with every one of `tags`.
+
+        Args:
+            tags (list[str]): e.g., ["goo_girl"]
+
+        Returns:
+            list[str]: Absolute links, maybe none.
+
+        Raises:
+            DanbooruUnavailable: Not cached, and Danbooru
+                couldn't be asked.
+
+        """
+
+        key = normalize_tags(tags)
+        self.searches[key] += 1
+        self.start()
+        image_links = self.results.get(key)
+
+        if image_links is not None:
+
+            return image_links
+
+        return self.fetch(key)
+
+    def fetch(self, key):
+        """Ask Danbooru, or wait for the answer to whoever is
+        already asking, and cache it.
+
+        If whoever is asking fails in any way, even by being
+        killed, everyone waiting gets a DanbooruUnavailable.
+
+        """
+
+        pending = self.pending.get(key)
+
+        if pending is not None:
+
+            return pending.get()
+
+        pending = self.pending[key] = gevent.event.AsyncResult()
+
+        try:
+            image_links = self.request(key)
+
+        except BaseException as error:
+            # whatever it was (a timeout killing this greenlet,
+            # too), whoever is waiting mustn't wait forever
+            if not isinstance(error, DanbooruUnavailable):
+                error = DanbooruUnavailable(error)
+
+            pending.set_exception(error)
+
+            raise
+
+        finally:
+            del self.pending[key]
+
+        self.results.put(key, image_links)
+        pending.set(image_links)
+
+        return image_links
+
+    def request(self, key):
+        self.counters["requests"] += 1
+
+        try:
+            response = session.get(self.base_url + "/posts.json",
+                                   params={"tags": key, "limit": PAGE_SIZE},
+                                   headers=ingest.HEADERS,
+                                   timeout=self.timeout)
+            response.raise_for_status()
+            posts = response.json()
+
+            if not isinstance(posts, list):
+
+                raise ValueError("not a list of posts: %r" % posts)
+
+        except (requests.exceptions.RequestException, ValueError) as error:
+            self.counters["failed"] += 1
+
+            raise DanbooruUnavailable(error)
+
+        # some posts are hidden, or videos
+        file_urls = [post.get("file_url") for post in posts]
+
+        return [urlparse.urljoin(self.base_url, file_url)
+                for file_url in file_urls
+                if file_url and ingest.looks_like_image_uri(file_url)]
+
+    def start(self):
+        """Start prefetching, if it should and hasn't yet."""
+
+        if self.prefetch_count and self.prefetcher is None:
+            self.prefetcher = gevent.spawn(self.prefetch)
+
+    def prefetch(self):
+        """Forever refresh the most popular searches, twice as
+        often as results expire.
+
+        """
+
+        while True:
+            gevent.sleep(self.results.ttl / 2.0)
+            popular = self.searches.most_common(self.prefetch_count)
+            self.searches.clear()
+
+            for key, __ in popular:
+
+                try:
+                    self.fetch(key)
+                except DanbooruUnavailable:
+                    continue
+
+                self.counters["prefetched"] += 1
+
+    def stats(self):
+        """Counters, plus those of the results cache.
+
+        Returns:
+            dict: Something like this:
+
+                >>> {"requests": 4, "failed": 0, "prefetched": 2,
+                ...  "entries": 2, "hits": 9, "misses": 2,
+                ...  "expirations": 0, "evictions": 0}
+
+        """
+
+        stats = self.results.stats()
+        stats.update(self.counters)
+
+        return stats
@@ -1,28 +1,52 @@
 """Glitch an image and make it look all cool. :3
 
+GlitchEngine makes every random choice from a seed, so a
+glitch can be reproduced, cached or benchmarked; the app
+just picks a random seed for each new thumbnail.
+
+Every step of the glitch runs as a named stage, which
+StageHook objects in `stage_hooks` can watch: the
+default one times each stage for /metrics, and
+StageProfiler is used by `staticfuzz.py profile_glitch`.
+
 """
 
-import io
-import sys
-import urllib2
+import collections
+import contextlib
 import random
-import base64
+import hashlib
+import time
+import io
 
 from flask import current_app as app
 from PIL import Image, ImageOps
+
+import cache
+import metrics
 try:
     from cStringIO import StringIO
 except ImportError:
     from StringIO import StringIO
+try:
+    import numpy
+except ImportError:
+    numpy = None
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None  # Python 2
 
 
-def atkinson_dither(pil_image):
-    """Classic Mac 1 bit dither.
+def atkinson_dither_reference(pil_image):
+    """Classic Mac 1 bit dither, one pixel at a time.
 
     Credit goes to Michal Migurski.
 
     http://mike.teczno.com/notes/atkinson.html
 
+    This is the original, slow implementation; every other
+    atkinson_dither_* must produce byte-identical output.
+
     """
 
     img = pil_image.convert('L')
@@ -50,69 +74,543 @@ def atkinson_dither(pil_image):
     return img
 
 
-def glitch_from_url(url_string):
-    """This is the thumbnail generating function.
+def atkinson_dither_python(pil_image):
+    """Same dither as atkinson_dither_reference(), on a list.
+
+    Quirks of the reference which must be kept: PIL clamps
+    every putpixel() to 0-255, and a negative x wraps
+    around, so the error pushed to (x - 1, y + 1) from the
+    first column lands on the last column of the next row.
+
+    """
+
+    img = pil_image.convert('L')
+    width, height = img.size
+    pixels = list(img.getdata())
+    length = len(pixels)
+
+    for y in range(height):
+        row = y * width
+
+        for x in range(width):
+            i = row + x
+            old = pixels[i]
+            new = 255 if old >= 128 else 0
+            err = (old - new) >> 3  # divide by 8
+            pixels[i] = new
+
+            if not err:
+                continue
+
+            neighbors = [i + width - 1 if x else i + 2 * width - 1,
+                         i + width, i + 2 * width]
+
+            if x + 1 < width:
+                neighbors += [i + 1, i + width + 1]
+
+            if x + 2 < width:
+                neighbors.append(i + 2)
+
+            for n in neighbors:
+
+                if n < length:
+                    value = pixels[n] + err
+                    pixels[n] = 0 if value < 0 else 255 if value > 255 else value
+
+    img.putdata(pixels)
+
+    return img
+
+
+def atkinson_dither_numpy(pil_image):
+    """Same dither as atkinson_dither_reference(), vectorized.
+
+    Pixel (x, y) only takes error from pixels with a smaller
+    x + 2y, so every pixel on the line x + 2y = t can be
+    done at once. Each pixel pulls the error of its sources
+    in the order the reference would have pushed it, which
+    matters because of the clamping.
+
+    """
+
+    img = pil_image.convert('L')
+    width, height = img.size
+    padded_width = width + 3  # two columns left, one right
+
+    # errors, padded with zeros: two rows above and the
+    # columns either side, so missing sources add nothing
+    errors = numpy.zeros((height + 2) * padded_width, dtype=numpy.int32)
+    pixels = numpy.asarray(img, dtype=numpy.int32)
+    output = numpy.empty((height, width), dtype=numpy.uint8)
+
+    # offsets of each source from its target, in the order
+    # the reference visits them (raster order)
+    offsets = [-2 * padded_width,      # (x, y - 2)
+               -padded_width - 1,      # (x - 1, y - 1)
+               -padded_width,          # (x, y - 1)
+               -padded_width + 1,      # (x + 1, y - 1)
+               -2,                     # (x - 2, y)
+               -1]                     # (x - 1, y)
+
+    for t in range(width + 2 * (height - 1)):
+        ys = numpy.arange(max(0, (t - width + 2) // 2),
+                          min(height - 1, t // 2) + 1)
+
+        if not len(ys):
+            continue
+
+        xs = t - 2 * ys
+        targets = (ys + 2) * padded_width + xs + 2
+        values = pixels[ys, xs]
+
+        for number, offset in enumerate(offsets):
+            values += errors.take(targets + offset)
+            numpy.clip(values, 0, 255, out=values)
+
+            if number == 0 and xs[0] == width - 1:
+                # (0, y - 1) wraps around onto (width - 1, y)
+                wrapped = errors[targets[0] - padded_width - width + 1]
+                values[0] = min(255, max(0, values[0] + wrapped))
+
+        new = numpy.where(values >= 128, 255, 0)
+        errors[targets] = (values - new) >> 3  # divide by 8
+        output[ys, xs] = new
+
+    return Image.fromarray(output, 'L')
+
+
+if numpy is None:
+    atkinson_dither = atkinson_dither_python
+else:
+    atkinson_dither = atkinson_dither_numpy
+
+
+# Modes the cached intermediate can be saved as PNG in.
+PNG_MODES = ("1", "L", "LA", "I", "P", "RGB", "RGBA")
+
+thumbnail_cache = None
+
+
+class ImageTooLarge(ValueError):
+    """The image has more pixels than we're willing to decode."""
+
+    pass
+
+
+def open_image(image_bytes, max_size, max_pixels=None):
+    """Open a source image to be shrunk to `max_size`, without
+    decoding any more of it than that needs.
+
+    Only the header is read here, so the dimensions are
+    checked before any pixels are. JPEGs are set to decode
+    straight to 1/2, 1/4 or 1/8 scale, if that's still
+    bigger than `max_size`. Only the first frame of an
+    animated image is ever decoded.
+
+    Args:
+        image_bytes (str): The source image.
+        max_size (tuple[int, int]): What it'll be shrunk to.
+        max_pixels (int|None): Refuse anything bigger.
+
+    Returns:
+        PIL.Image.Image: Not loaded yet.
+
+    Raises:
+        ImageTooLarge: --
+
+    """
+
+    image = Image.open(io.BytesIO(image_bytes))
+    width, height = image.size
+
+    if max_pixels is not None and width * height > max_pixels:
+
+        raise ImageTooLarge("%dx%d is over %d pixels" %
+                            (width, height, max_pixels))
+
+    image.draft(None, max_size)
+
+    return image
+
+
+stage_seconds = metrics.registry.histogram(
+    "staticfuzz_glitch_stage_seconds",
+    "Time spent in each step of glitching an image.",
+    ["stage"])
+
+
+class StageHook(object):
+    """Watches the stages of `glitch_from_bytes()`.
+
+    Subclass it, and put an instance in `stage_hooks`.
+
+    """
+
+    def start(self, stage):
+        """`stage` (str) is about to run."""
+
+        pass
+
+    def finish(self, stage, seconds):
+        """`stage` (str) ran for `seconds` (float)."""
+
+        pass
+
+
+class StageTimer(StageHook):
+    """Observe how long each stage takes in a histogram.
+
+    Attributes:
+        histogram (metrics.Histogram): With a "stage" label.
+
+    """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+
+    def finish(self, stage, seconds):
+        self.histogram.observe(seconds, stage=stage)
+
+
+def allocated_bytes():
+    """Memory allocated by Python so far, or None unless
+    tracemalloc is tracing (it never is on Python 2).
+
+    """
+
+    if tracemalloc is not None and tracemalloc.is_tracing():
+
+        return tracemalloc.get_traced_memory()[0]
+
+    return None
+
+
+class StageProfiler(StageHook):
+    """Add up the time and memory each stage takes.
+
+    A stage which runs more than once per glitch (equalize)
+    is added up too.
+
+    Attributes:
+        stages (OrderedDict): Stage to a dict of "calls",
+            "seconds" and "allocated_bytes", in the order
+            the stages first ran. "allocated_bytes" is None
+            if tracemalloc isn't tracing.
+
+    """
+
+    def __init__(self):
+        self.stages = collections.OrderedDict()
+        self.allocated_at_start = None
+
+    def start(self, stage):
+        self.allocated_at_start = allocated_bytes()
+
+    def finish(self, stage, seconds):
+        totals = self.stages.setdefault(stage, {"calls": 0,
+                                                "seconds": 0.0,
+                                                "allocated_bytes": 0})
+        totals["calls"] += 1
+        totals["seconds"] += seconds
+        allocated = allocated_bytes()
+
+        if allocated is None or self.allocated_at_start is None:
+            totals["allocated_bytes"] = None
+        elif totals["allocated_bytes"] is not None:
+            totals["allocated_bytes"] += max(0, allocated -
+                                             self.allocated_at_start)
+
+
+stage_hooks = [StageTimer(stage_seconds)]
+
+
+@contextlib.contextmanager
+def stage(name):
+    """Run the `with` block as the stage `name`, letting every
+    hook in `stage_hooks` know.
+
+    """
+
+    for hook in stage_hooks:
+        hook.start(name)
+
+    started = time.time()
+
+    try:
+        yield
+    finally:
+        seconds = time.time() - started
+
+        for hook in stage_hooks:
+            hook.finish(name, seconds)
+
+
+def get_thumbnail_cache():
+    """The cache of resized source images, set up from the
+    app's config on first use.
+
+    Returns:
+        cache.LRUCache: --
+
+    """
+
+    global thumbnail_cache
+
+    if thumbnail_cache is None:
+        thumbnail_cache = cache.LRUCache(
+            app.config['GLITCH_CACHE_BYTES'],
+            app.config['GLITCH_CACHE_DIRECTORY'],
+            app.config['GLITCH_CACHE_DISK_BYTES'])
+
+    return thumbnail_cache
+
+
+# Named parameter sets for GlitchEngine.glitch(); whatever a
+# preset leaves out is still chosen from the seed.
+PRESETS = {
+    "gentle": {"jpeg_quality": 20, "solarize_threshold": 200,
+               "equalize_again": False},
+    "harsh": {"jpeg_quality": 5, "solarize_threshold": 1,
+              "equalize_again": True},
+    "mono": {"dark": (0, 0, 0), "light": (255, 255, 255)},
+}
+
+
+def preset(name):
+    """The parameters of the preset `name`, e.g., GLITCH_PRESET.
+
+    Args:
+        name (str|None): A key of PRESETS, or None for every
+            parameter to be chosen from the seed.
+
+    Returns:
+        dict|None: --
+
+    Raises:
+        ValueError: There's no such preset.
+
+    """
+
+    if name is None:
+
+        return None
+
+    if name not in PRESETS:
+
+        raise ValueError("no glitch preset %r; there's %s" %
+                         (name, ", ".join(sorted(PRESETS))))
+
+    return PRESETS[name]
+
+
+class GlitchEngine(object):
+    """Glitches images from bytes, as a pure function of the
+    image, the seed and the parameters.
+
+    Doesn't need an app: everything it needs is passed in.
+
+    Attributes:
+        max_size (tuple[int, int]): Thumbnails fit in this.
+        min_colors (int): Fewest colors to quantize to.
+        max_colors (int): Most colors to quantize to.
+        thumbnail_cache (cache.LRUCache|None): Where resized
+            sources are kept between glitches, if anywhere.
+        max_pixels (int|None): Sources with more pixels than
+            this aren't glitched, see `open_image()`.
+
+    """
+
+    def __init__(self, max_size, min_colors, max_colors,
+                 thumbnail_cache=None, max_pixels=None):
+        self.max_size = tuple(max_size)
+        self.min_colors = min_colors
+        self.max_colors = max_colors
+        self.thumbnail_cache = thumbnail_cache
+        self.max_pixels = max_pixels
+
+    @classmethod
+    def from_config(cls, config, thumbnail_cache=None):
+        """An engine set up like the app's config says.
+
+        Args:
+            config (dict): THUMB_MAX_WIDTH, THUMB_MAX_HEIGHT,
+                MIN_COLORS, MAX_COLORS and IMAGE_MAX_PIXELS are
+                used.
+
+        """
+
+        return cls((config['THUMB_MAX_WIDTH'], config['THUMB_MAX_HEIGHT']),
+                   config['MIN_COLORS'], config['MAX_COLORS'],
+                   thumbnail_cache, config['IMAGE_MAX_PIXELS'])
+
+    def choose(self, seed, fixed=None):
+        """Every random choice of a glitch, made from `seed`.
+
+        Args:
+            seed (int): Same seed, same choices.
+            fixed (dict|None): Parameters not to choose, e.g.,
+                a preset from PRESETS.
+
+        Returns:
+            dict: Something like this:
+
+                >>> {"seed": 1, "jpeg_quality": 12,
+                ...  "solarize_threshold": 80, "mirror": True,
+                ...  "equalize_again": False, "colors": 7,
+                ...  "dark": (20, 200, 3), "light": (235, 55, 252)}
+
+        """
+
+        generator = random.Random(seed)
+
+        # drawn in this order whether or not they're fixed,
+        # so fixing one doesn't change the others
+        parameters = {"seed": seed,
+                      "jpeg_quality": generator.randint(5, 20),
+                      "solarize_threshold": generator.randint(1, 200),
+                      "mirror": bool(generator.randint(0, 4)),
+                      "equalize_again": bool(generator.randint(0, 4)),
+                      "colors": generator.randint(self.min_colors,
+                                                  self.max_colors)}
+        dark = (generator.randint(0, 255),
+                generator.randint(0, 255),
+                generator.randint(0, 255))
+        parameters["dark"] = dark
+        parameters["light"] = tuple(abs(channel - 255) for channel in dark)
+        parameters.update(fixed or {})
+
+        return parameters
+
+    def thumbnail(self, image_bytes):
+        """Decode and resize a source image.
+
+        This is the only deterministic part of the glitch, so
+        it's cached, keyed by a hash of the source and the
+        thumbnail size: reposts skip straight to the random part.
+
+        Args:
+            image_bytes (str): The downloaded image.
+
+        Returns:
+            PIL.Image.Image: Fits in `max_size`.
+
+        Raises:
+            ImageTooLarge: Over `max_pixels`.
+
+        """
+
+        key = "%s-%dx%d" % ((hashlib.sha1(image_bytes).hexdigest(),) +
+                            self.max_size)
+
+        if self.thumbnail_cache is not None:
+            cached = self.thumbnail_cache.get(key)
+
+            if cached is not None:
+
+                return Image.open(io.BytesIO(cached))
+
+        # open, resize...
+        thumbnail = open_image(image_bytes, self.max_size, self.max_pixels)
+        thumbnail.thumbnail(self.max_size)
+
+        if thumbnail.mode not in PNG_MODES:
+            thumbnail = thumbnail.convert("RGB")
+
+        if self.thumbnail_cache is not None:
+            thumbnail_io = StringIO()
+            thumbnail.save(thumbnail_io, "PNG", compress_level=1)
+            self.thumbnail_cache.put(key, thumbnail_io.getvalue())
+
+        return thumbnail
+
+    def glitch(self, image_bytes, seed, fixed=None):
+        """Glitch an image.
+
+        Args:
+            image_bytes (str): The source image.
+            seed (int): See `choose()`.
+            fixed (dict|None): See `choose()`.
+
+        Returns:
+            tuple[str, dict]: The glitched thumbnail, as PNG,
+                and the parameters it was made with; passing
+                those as `fixed` makes it again.
+
+        """
+
+        parameters = self.choose(seed, fixed)
+
+        # open and tweak the image
+        with stage("thumbnail"):
+            tweaked_image = self.thumbnail(image_bytes)
+
+        # add artifacts/save as low quality jpeg
+        # save as low quality jpg
+        with stage("jpeg"):
+            tweaked_image_io = StringIO()
+            tweaked_image.save(tweaked_image_io, format="JPEG",
+                               quality=parameters["jpeg_quality"])
+            tweaked_image = Image.open(tweaked_image_io)
+            tweaked_image.load()
+
+        # autocontrast
+        with stage("autocontrast"):
+            tweaked_image = ImageOps.autocontrast(tweaked_image)
+
+        with stage("equalize"):
+            tweaked_image = ImageOps.equalize(tweaked_image)
+
+        # solarize
+        with stage("solarize"):
+            tweaked_image = ImageOps.solarize(
+                tweaked_image, parameters["solarize_threshold"])
+
+        # random chance to flip
+        if parameters["mirror"]:
+
+            with stage("mirror"):
+                tweaked_image = ImageOps.mirror(tweaked_image)
+
+        if parameters["equalize_again"]:
+
+            with stage("equalize"):
+                tweaked_image = ImageOps.equalize(tweaked_image)
+
+        with stage("quantize"):
+            tweaked_image = tweaked_image.convert(
+                mode='P', palette=Image.ADAPTIVE, colors=parameters["colors"])
+
+        with stage("dither"):
+            tweaked_image = atkinson_dither(tweaked_image)
+
+        # we have a 1-bit image because of the atkinson dither,
+        # now color it in with a random color and its inverse
+        with stage("colorize"):
+            tweaked_image = ImageOps.colorize(tweaked_image,
+                                              parameters["dark"],
+                                              parameters["light"])
+
+        # save the image as PNG
+        with stage("png"):
+            glitch_image = StringIO()
+            tweaked_image.save(glitch_image, "PNG", optimize=True)
+
+        return glitch_image.getvalue(), parameters
+
+
+def glitch_from_bytes(image_bytes, fixed=None):
+    """This is the thumbnail generating function: a glitch
+    with a random seed, set up from the app's config.
+
+    Args:
+        image_bytes (str): The downloaded image.
+        fixed (dict|None): See `GlitchEngine.choose()`.
+
+    Returns:
+        str: The glitched thumbnail, as PNG.
 
     """
 
-    # get the image from the net
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    req = urllib2.Request(url_string, None, headers)
-    urlopen_result = urllib2.urlopen(req)
-    urlopen_result_io = io.BytesIO(urlopen_result.read())
-
-    # open and tweak the image
-    # open, resize...
-    tweaked_image = Image.open(urlopen_result_io)
-    tweaked_image.thumbnail([app.config['THUMB_MAX_WIDTH'],
-                             app.config['THUMB_MAX_HEIGHT']])
-
-    # add artifacts/save as low quality jpeg
-    # save as low quality jpg
-    tweaked_image_io = StringIO()
-    tweaked_image.save(tweaked_image_io, format="JPEG",
-                       quality=random.randint(5, 20))
-    tweaked_image = Image.open(tweaked_image_io)
-
-    # autocontrast
-    tweaked_image = ImageOps.autocontrast(tweaked_image)
-    tweaked_image = ImageOps.equalize(tweaked_image)
-
-    # solarize
-    tweaked_image = ImageOps.solarize(tweaked_image,
-                                      random.randint(1, 200))
-
-    # random chance to flip
-    if random.randint(0, 4):
-        tweaked_image = ImageOps.mirror(tweaked_image)
-
-    if random.randint(0, 4):
-        tweaked_image = ImageOps.equalize(tweaked_image)
-
-    max_colors = random.randint(app.config['MIN_COLORS'],
-                                app.config['MAX_COLORS'])
-    tweaked_image = tweaked_image.convert(mode='P',
-                                          palette=Image.ADAPTIVE,
-                                          colors=max_colors)
-    tweaked_image = atkinson_dither(tweaked_image)
-
-    # we have a 1-bit image because of the atkinson dither,
-    # now we must generate a random color and get its inverse
-    first_color = (random.randint(0, 255),
-                   random.randint(0, 255),
-                   random.randint(0, 255))
-    inverse_color = (abs(first_color[0] - 255),
-                     abs(first_color[1] - 255),
-                     abs(first_color[2] - 255))
-                       
-    tweaked_image = ImageOps.colorize(tweaked_image,
-                                      first_color,
-                                      inverse_color)
-
-    # save the image as base64 HTML image
-    glitch_image = StringIO()
-    tweaked_image.save(glitch_image, "PNG", optimize=True)
-    glitch_string = glitch_image.getvalue()
-    base64_string = base64.b64encode(glitch_string)
-
-    return base64_string
+    engine = GlitchEngine.from_config(app.config, get_thumbnail_cache())
+
+    return engine.glitch(image_bytes, random.getrandbits(32), fixed)[0]
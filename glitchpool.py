@@ -0,0 +1,304 @@
+"""Glitch in separate processes, off the event loop.
+
+Glitching is pure CPU work: run in a worker, it would
+stall every greenlet, including every open stream, for as
+long as it takes. A GlitchPool keeps a few child
+processes, each running a GlitchEngine, and talks to them
+over pipes, which gevent waits on cooperatively.
+
+A child which takes too long, or dies, is killed and
+replaced; only the glitch it was working on fails.
+
+Each child has its own thumbnail cache, and children are
+handed out in turn, so a repost usually goes to another
+child than the first post did: only a shared disk tier
+(GLITCH_CACHE_DIRECTORY) makes it a hit. Children send
+their cache's stats back with every reply, and the pool
+adds them up.
+
+Requests and replies are frames: the lengths of a small
+JSON header and of a bytes body, then both.
+
+"""
+
+import struct
+import json
+import sys
+import os
+
+import gevent
+import gevent.queue
+import gevent.subprocess
+
+import cache
+import glitch
+
+
+FRAME_LENGTHS = struct.Struct("!II")
+
+# Children yield the CPU to the workers serving requests.
+CHILD_NICENESS = 10
+
+# Cache stats which are sizes rather than counters: they
+# go with a replaced child instead of adding up.
+CACHE_SIZE_STATS = ("entries", "bytes")
+
+
+class GlitchFailed(Exception):
+    """The glitch errored, timed out or crashed its process."""
+
+    pass
+
+
+def write_frame(stream, header, body):
+    header = json.dumps(header)
+    stream.write(FRAME_LENGTHS.pack(len(header), len(body)) + header + body)
+    stream.flush()
+
+
+def read_exactly(stream, size):
+    chunks = []
+
+    while size:
+        chunk = stream.read(size)
+
+        if not chunk:
+
+            return None
+
+        chunks.append(chunk)
+        size -= len(chunk)
+
+    return "".join(chunks)
+
+
+def read_frame(stream):
+    """The next (header, body) from `stream`, or None if it
+    has ended.
+
+    """
+
+    lengths = read_exactly(stream, FRAME_LENGTHS.size)
+
+    if lengths is None:
+
+        return None
+
+    header_length, body_length = FRAME_LENGTHS.unpack(lengths)
+    header = read_exactly(stream, header_length)
+    body = read_exactly(stream, body_length) if body_length else ""
+
+    if header is None or body is None:
+
+        return None
+
+    return json.loads(header), body
+
+
+class GlitchPool(object):
+    """A fixed number of glitching child processes.
+
+    Children are started on first use.
+
+    Attributes:
+        size (int): How many children.
+        engine_arguments (dict): How each child sets up its
+            GlitchEngine; see `child_main()`.
+        timeout (float): Seconds before a glitch is given up
+            on and its child replaced.
+        counters (dict): glitched, failed and replaced so far.
+        cache_stats (dict): The latest `LRUCache.stats()` of
+            each running child, by process id.
+        retired_cache_counters (dict): What replaced children
+            had counted, so the totals don't go backwards.
+
+    """
+
+    def __init__(self, size, engine_arguments, timeout):
+        self.size = size
+        self.engine_arguments = engine_arguments
+        self.timeout = timeout
+        self.idle = gevent.queue.Queue()
+        self.started = False
+        self.counters = {"glitched": 0, "failed": 0, "replaced": 0}
+        self.cache_stats = {}
+        self.retired_cache_counters = {}
+
+    def start(self):
+        """Spawn the children, if they aren't running yet."""
+
+        if not self.started:
+            self.started = True
+
+            for __ in range(self.size):
+                self.idle.put(self.spawn())
+
+    def spawn(self):
+
+        return gevent.subprocess.Popen(
+            [sys.executable, "-m", "glitchpool",
+             json.dumps(self.engine_arguments)],
+            stdin=gevent.subprocess.PIPE, stdout=gevent.subprocess.PIPE,
+            cwd=os.path.dirname(os.path.abspath(__file__)))
+
+    def replace(self, process):
+        """Kill `process` and put a fresh child in its place."""
+
+        try:
+            process.kill()
+        except OSError:
+            pass  # already gone
+
+        process.wait()
+        retired = self.cache_stats.pop(process.pid, {})
+
+        for stat, value in retired.items():
+
+            if stat not in CACHE_SIZE_STATS:
+                self.retired_cache_counters[stat] = (
+                    self.retired_cache_counters.get(stat, 0) + value)
+
+        self.counters["replaced"] += 1
+        self.idle.put(self.spawn())
+
+    def glitch(self, image_bytes, seed, fixed=None):
+        """Like `GlitchEngine.glitch()`, in a child process.
+
+        Blocks only the calling greenlet, until a child is
+        free and has finished. The child's stage timings are
+        passed on to this process's `glitch.stage_hooks`.
+
+        Raises:
+            GlitchFailed: Whatever went wrong.
+
+        """
+
+        self.start()
+        process = self.idle.get()
+
+        try:
+
+            with gevent.Timeout(self.timeout, GlitchFailed("timed out")):
+                write_frame(process.stdin, {"seed": seed, "fixed": fixed},
+                            image_bytes)
+                reply = read_frame(process.stdout)
+
+        except BaseException:
+            self.counters["failed"] += 1
+            self.replace(process)
+
+            raise
+
+        if reply is None:
+            self.counters["failed"] += 1
+            self.replace(process)
+
+            raise GlitchFailed("glitch process died")
+
+        self.idle.put(process)
+        header, glitched = reply
+        self.cache_stats[process.pid] = header["cache"]
+
+        if "error" in header:
+            self.counters["failed"] += 1
+
+            raise GlitchFailed(header["error"])
+
+        for stage, seconds in header["stages"]:
+
+            for hook in glitch.stage_hooks:
+                hook.finish(stage, seconds)
+
+        self.counters["glitched"] += 1
+
+        return glitched, header["parameters"]
+
+    def stats(self):
+        """Counters, plus how many children are idle, and the
+        children's thumbnail caches' stats added up.
+
+        Returns:
+            dict: Something like this:
+
+                >>> {"idle": 2, "glitched": 40, "failed": 1,
+                ...  "replaced": 1,
+                ...  "cache": {"entries": 3, "bytes": 412000,
+                ...            "hits": 5, "disk_hits": 0,
+                ...            "misses": 35, "evictions": 0,
+                ...            "disk_evictions": 0}}
+
+        """
+
+        cache_stats = dict(self.retired_cache_counters)
+
+        for child_stats in self.cache_stats.values():
+
+            for stat, value in child_stats.items():
+                cache_stats[stat] = cache_stats.get(stat, 0) + value
+
+        stats = dict(self.counters)
+        stats["idle"] = self.idle.qsize()
+        stats["cache"] = cache_stats
+
+        return stats
+
+
+def child_main(engine_arguments):
+    """Glitch every request read from stdin, replying on stdout,
+    until stdin closes.
+
+    Args:
+        engine_arguments (dict): max_size, min_colors,
+            max_colors and max_pixels for the GlitchEngine, and
+            cache_bytes, cache_directory and cache_disk_bytes
+            for its thumbnail cache.
+
+    """
+
+    os.nice(CHILD_NICENESS)
+    thumbnail_cache = cache.LRUCache(engine_arguments["cache_bytes"],
+                                     engine_arguments["cache_directory"],
+                                     engine_arguments["cache_disk_bytes"])
+    engine = glitch.GlitchEngine(engine_arguments["max_size"],
+                                 engine_arguments["min_colors"],
+                                 engine_arguments["max_colors"],
+                                 thumbnail_cache,
+                                 engine_arguments["max_pixels"])
+    timings = StageRecorder()
+    glitch.stage_hooks[:] = [timings]
+
+    while True:
+        request = read_frame(sys.stdin)
+
+        if request is None:
+
+            return
+
+        header, image_bytes = request
+        del timings.stages[:]
+
+        try:
+            glitched, parameters = engine.glitch(image_bytes, header["seed"],
+                                                 header["fixed"])
+            reply = {"parameters": parameters, "stages": timings.stages}
+
+        except Exception as error:
+            glitched = ""
+            reply = {"error": repr(error)}
+
+        reply["cache"] = thumbnail_cache.stats()
+        write_frame(sys.stdout, reply, glitched)
+
+
+class StageRecorder(glitch.StageHook):
+    """Lists (stage, seconds) as they finish."""
+
+    def __init__(self):
+        self.stages = []
+
+    def finish(self, stage, seconds):
+        self.stages.append((stage, seconds))
+
+
+if __name__ == '__main__':
+    child_main(json.loads(sys.argv[1]))
@@ -0,0 +1,180 @@
+"""Download the images people link to, exactly once.
+
+The response is streamed: the status, Content-Type and
+magic bytes are checked as soon as the first chunk
+arrives, the image's dimensions as soon as its header
+has, and the download is abandoned as soon as it grows
+past the byte limit. The bytes which were read are
+handed straight to the glitch step.
+
+"""
+
+import time
+import io
+
+import requests
+import requests.adapters
+from PIL import Image
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".gif")
+
+# The first bytes of every image format we accept.
+MAGIC_NUMBERS = ("\xff\xd8\xff",  # JPEG
+                 "\x89PNG\r\n\x1a\n",
+                 "GIF87a",
+                 "GIF89a")
+MAGIC_NUMBER_BYTES = max(len(magic) for magic in MAGIC_NUMBERS)
+
+# Servers which don't know better send images as these.
+CONTENT_TYPES = ("image/", "application/octet-stream")
+
+CHUNK_SIZE = 16 * 1024
+
+# Where to stop looking for the dimensions; the glitch
+# step checks them again anyway.
+HEADER_MAX_BYTES = 256 * 1024
+
+HEADERS = {'User-Agent': 'Mozilla/5.0'}
+
+# One pool of keep-alive connections shared by every request.
+session = requests.Session()
+session.mount("http://", requests.adapters.HTTPAdapter(pool_maxsize=32))
+session.mount("https://", requests.adapters.HTTPAdapter(pool_maxsize=32))
+
+
+def looks_like_image_uri(uri):
+    """Check `uri` against the extension whitelist, without
+    touching the network.
+
+    """
+
+    return uri.lower().endswith(IMAGE_EXTENSIONS)
+
+
+def image_pixels(data):
+    """How many pixels the image starting with `data` has.
+
+    Returns:
+        int|float|None: None if `data` doesn't get as far as
+            the dimensions yet.
+
+    """
+
+    try:
+        width, height = Image.open(io.BytesIO(data)).size
+
+    except Image.DecompressionBombError:
+        # too big for PIL to even open
+        return float("inf")
+
+    except Exception:
+
+        return None
+
+    return width * height
+
+
+def fetch_image(uri, max_bytes, timeout, max_pixels=None):
+    """Download the image at `uri`, if it is one.
+
+    Args:
+        uri (str): Link to an image.
+        max_bytes (int): Give up on anything bigger.
+        timeout (float): Seconds to wait for the server to
+            connect or respond, and for the whole download.
+        max_pixels (int|None): Give up on anything whose
+            header says it's bigger.
+
+    Returns:
+        str|None: The image's bytes, or None if `uri` isn't
+            a reachable image within the limits.
+
+    """
+
+    if not looks_like_image_uri(uri):
+
+        return None
+
+    try:
+        response = session.get(uri, headers=HEADERS, stream=True,
+                               timeout=timeout)
+
+    except (requests.exceptions.RequestException, ValueError):
+
+        return None
+
+    try:
+
+        return read_image(response, max_bytes, time.time() + timeout,
+                          max_pixels)
+
+    except requests.exceptions.RequestException:
+
+        return None
+
+    finally:
+        response.close()
+
+
+def read_image(response, max_bytes, deadline, max_pixels=None):
+    """Read the body of `response` if it's an image within the
+    limits, otherwise return None as early as possible.
+
+    """
+
+    if response.status_code != 200:
+
+        return None
+
+    content_type = response.headers.get("Content-Type", "image/")
+
+    if not content_type.lower().startswith(CONTENT_TYPES):
+
+        return None
+
+    try:
+        content_length = int(response.headers.get("Content-Length") or 0)
+    except ValueError:
+        content_length = 0
+
+    if content_length > max_bytes:
+
+        return None
+
+    chunks = []
+    size = 0
+    pixels = None
+
+    for chunk in response.iter_content(CHUNK_SIZE):
+
+        # chunks may be tiny; check once there's enough
+        if (size < MAGIC_NUMBER_BYTES <= size + len(chunk) and
+                not "".join(chunks + [chunk]).startswith(MAGIC_NUMBERS)):
+
+            return None
+
+        size += len(chunk)
+
+        if size > max_bytes or time.time() > deadline:
+
+            return None
+
+        chunks.append(chunk)
+
+        if (max_pixels is not None and pixels is None and
+                size <= HEADER_MAX_BYTES):
+            pixels = image_pixels("".join(chunks))
+
+            if pixels is not None and pixels > max_pixels:
+
+                return None
+
+    image_bytes = "".join(chunks)
+
+    # never checked above, if the whole body is that short
+    if size < MAGIC_NUMBER_BYTES and not image_bytes.startswith(MAGIC_NUMBERS):
+
+        return None
+
+    return image_bytes
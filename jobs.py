@@ -0,0 +1,129 @@
+"""Run slow work in the background, off the request.
+
+A JobQueue is a bounded queue drained by a fixed number
+of worker greenlets. When the queue is full, submit()
+refuses the job instead of letting work pile up, so the
+route can tell the user to try again later.
+
+"""
+
+import logging
+import time
+
+import gevent
+import gevent.queue
+
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFull(Exception):
+    """The job queue is at capacity; try again later."""
+
+    pass
+
+
+class JobQueue(object):
+    """Bounded pool of background workers.
+
+    Note:
+        The timeout can only interrupt a job when it
+        yields to gevent (network, sleep, ...); pure CPU
+        work runs to completion.
+
+    Attributes:
+        workers (int): How many jobs run at once.
+        timeout (float|None): Seconds before a job is killed.
+        counters (dict): Running totals, see `stats()`.
+
+    """
+
+    def __init__(self, workers, maxsize, timeout=None):
+        self.workers = workers
+        self.timeout = timeout
+        self.queue = gevent.queue.JoinableQueue(maxsize)
+        self.greenlets = []
+        self.counters = {"submitted": 0,
+                         "rejected": 0,
+                         "completed": 0,
+                         "failed": 0,
+                         "timed_out": 0,
+                         "processing_seconds": 0.0}
+
+    def full(self):
+        """True if submit() would raise QueueFull."""
+
+        return self.queue.full()
+
+    def submit(self, function, *args):
+        """Queue `function(*args)` to run in the background.
+
+        Raises:
+            QueueFull: There is no room for another job.
+
+        """
+
+        self.start()
+
+        try:
+            self.queue.put_nowait((function, args))
+
+        except gevent.queue.Full:
+            self.counters["rejected"] += 1
+
+            raise QueueFull()
+
+        self.counters["submitted"] += 1
+
+    def start(self):
+        """Spawn the workers, if they aren't running yet."""
+
+        if not self.greenlets:
+            self.greenlets = [gevent.spawn(self.work)
+                              for __ in range(self.workers)]
+
+    def join(self):
+        """Block until every queued job has finished."""
+
+        self.queue.join()
+
+    def work(self):
+
+        for function, args in self.queue:
+            started = time.time()
+
+            try:
+
+                with gevent.Timeout(self.timeout):
+                    function(*args)
+
+                self.counters["completed"] += 1
+
+            except gevent.Timeout:
+                self.counters["timed_out"] += 1
+                logger.warning("job %s%r timed out", function.__name__, args)
+
+            except Exception:
+                self.counters["failed"] += 1
+                logger.exception("job %s%r failed", function.__name__, args)
+
+            finally:
+                self.counters["processing_seconds"] += time.time() - started
+                self.queue.task_done()
+
+    def stats(self):
+        """Counters, plus how many jobs are waiting.
+
+        Returns:
+            dict: Something like this:
+
+                >>> {"depth": 2, "submitted": 10, "rejected": 0,
+                ...  "completed": 7, "failed": 1, "timed_out": 0,
+                ...  "processing_seconds": 4.2}
+
+        """
+
+        stats = dict(self.counters)
+        stats["depth"] = self.queue.qsize()
+
+        return stats
@@ -0,0 +1,239 @@
+"""Counters, gauges and histograms for /metrics.
+
+Each worker keeps its own, in memory, and renders them in
+Prometheus' text format when scraped. Recording one is a
+dict lookup and an addition or two (plus a bisect, for
+histograms), so they can stay on under load.
+
+Metrics are declared once, at import time, next to the
+code which records them:
+
+    >>> seconds = registry.histogram("staticfuzz_example_seconds",
+    ...                              "How long examples take.",
+    ...                              ["kind"])
+    >>> seconds.observe(0.02, kind="short")
+
+"""
+
+import contextlib
+import bisect
+import time
+
+
+# Upper bounds, in seconds, for timing histograms.
+SECONDS_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25,
+                   0.5, 1.0, 2.5, 5.0, 10.0)
+
+# Upper bounds for histograms of small counts.
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 21)
+
+
+def escape(label_value):
+    """Escape a label value for the text format."""
+
+    return (unicode(label_value).replace("\\", "\\\\").
+            replace("\n", "\\n").replace('"', '\\"'))
+
+
+def format_labels(names, values, extra=()):
+    """Render label names and values as {name="value",...}."""
+
+    pairs = list(zip(names, values)) + list(extra)
+
+    if not pairs:
+
+        return ""
+
+    return "{%s}" % ",".join('%s="%s"' % (name, escape(value))
+                             for name, value in pairs)
+
+
+def format_value(value):
+
+    if value == float("inf"):
+
+        return "+Inf"
+
+    return repr(float(value))
+
+
+class Metric(object):
+    """One named metric, possibly split by labels.
+
+    Attributes:
+        name (str): Prometheus metric name.
+        documentation (str): Its HELP line.
+        label_names (tuple[str]): Every recording must give a
+            value for each of these, as keyword arguments.
+        values (dict): Label values (tuple) to the value.
+
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name, documentation, label_names=()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self.values = {}
+
+    def key(self, labels):
+
+        return tuple(labels[name] for name in self.label_names)
+
+    def samples(self):
+        """Yield (line prefix, value) for every sample."""
+
+        for key, value in sorted(self.values.items()):
+            yield self.name + format_labels(self.label_names, key), value
+
+    def render(self):
+        """The metric in the text format.
+
+        Returns:
+            list[str]: Lines, without newlines.
+
+        """
+
+        lines = ["# HELP %s %s" % (self.name, self.documentation),
+                 "# TYPE %s %s" % (self.name, self.kind)]
+
+        for prefix, value in self.samples():
+            lines.append("%s %s" % (prefix, format_value(value)))
+
+        return lines
+
+
+class Counter(Metric):
+    """Only ever goes up."""
+
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Goes up and down, or is set when scraped."""
+
+    kind = "gauge"
+
+    def set(self, value, **labels):
+        self.values[self.key(labels)] = value
+
+    def inc(self, amount=1, **labels):
+        key = self.key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def dec(self, amount=1, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    """Counts observations in buckets, plus their sum.
+
+    Attributes:
+        buckets (tuple[float]): Upper bounds, ascending; +Inf
+            is implied.
+
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, label_names=(),
+                 buckets=SECONDS_BUCKETS):
+        super(Histogram, self).__init__(name, documentation, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        counts = self.values.get(key)
+
+        if counts is None:
+            # one count per bucket, +Inf, then the sum
+            counts = self.values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe how long the `with` block takes."""
+
+        started = time.time()
+
+        try:
+            yield
+        finally:
+            self.observe(time.time() - started, **labels)
+
+    def samples(self):
+
+        for key, counts in sorted(self.values.items()):
+            total = 0
+
+            for bound, count in zip(self.buckets + (float("inf"),),
+                                    counts[:-1]):
+                total += count
+                labels = format_labels(self.label_names, key,
+                                       [("le", format_value(bound))])
+                yield self.name + "_bucket" + labels, total
+
+            labels = format_labels(self.label_names, key)
+            yield self.name + "_sum" + labels, counts[-1]
+            yield self.name + "_count" + labels, total
+
+
+class Registry(object):
+    """Every metric of this worker.
+
+    Attributes:
+        metrics (list[Metric]): In order of declaration.
+
+    """
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+
+        if any(existing.name == metric.name for existing in self.metrics):
+
+            raise ValueError("metric %s already exists" % metric.name)
+
+        self.metrics.append(metric)
+
+        return metric
+
+    def counter(self, name, documentation, label_names=()):
+
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name, documentation, label_names=()):
+
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name, documentation, label_names=(),
+                  buckets=SECONDS_BUCKETS):
+
+        return self.register(Histogram(name, documentation, label_names,
+                                       buckets))
+
+    def render(self):
+        """Everything, in Prometheus' text format.
+
+        Returns:
+            str: --
+
+        """
+
+        lines = []
+
+        for metric in self.metrics:
+            lines.extend(metric.render())
+
+        return "\n".join(lines) + "\n"
+
+
+registry = Registry()
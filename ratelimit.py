@@ -0,0 +1,232 @@
+"""Rate limiting which holds across workers.
+
+Flask-Limiter keeps its counters in the worker by default,
+so each worker enforces every limit on its own. Importing
+this module adds two things it can be configured with:
+
+  * "sqlite:///path" as RATELIMIT_STORAGE_URL: counters in
+    a small database file every worker on the host shares.
+    Expired counters are deleted every so often.
+
+  * "token-bucket" as RATELIMIT_STRATEGY, for "sqlite://"
+    storage: a limit of N per period refills one hit every
+    period / N seconds and holds at most N. Unlike the
+    moving window, which keeps a timestamp per hit, each
+    key is a single number (when its bucket is full again),
+    so a check costs the same however busy the client is.
+
+"""
+
+import sqlite3
+import time
+
+import limits.storage
+import limits.strategies
+
+
+class SQLiteStorage(limits.storage.Storage):
+    """Counters and token buckets in a sqlite database file.
+
+    Each worker has its own connection; anything read and
+    then written happens in one immediate transaction, so
+    workers never lose each other's hits.
+
+    Attributes:
+        path (str): The database file.
+        cleanup_seconds (float): How often expired counters
+            and full buckets are deleted.
+
+    """
+
+    STORAGE_SCHEME = ["sqlite"]
+
+    def __init__(self, uri, busy_timeout=5.0, cleanup_seconds=60.0, **_):
+        super(SQLiteStorage, self).__init__(uri)
+        # like SQLAlchemy: sqlite:///relative, sqlite:////absolute
+        self.path = uri.split("://", 1)[1][1:]
+        self.cleanup_seconds = cleanup_seconds
+        self.cleaned_at = 0
+        self.connection = sqlite3.connect(self.path, timeout=busy_timeout,
+                                          isolation_level=None,
+                                          check_same_thread=False)
+        # limits are worth losing in a crash, not waiting for
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=OFF")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS counters "
+                                "(key TEXT PRIMARY KEY, count INTEGER, "
+                                "expires REAL) WITHOUT ROWID")
+        self.connection.execute("CREATE TABLE IF NOT EXISTS buckets "
+                                "(key TEXT PRIMARY KEY, full_at REAL) "
+                                "WITHOUT ROWID")
+
+    def update(self, function, *args):
+        """Call `function(cursor, now, *args)` in an immediate
+        transaction, deleting whatever has expired first if
+        it's time to.
+
+        """
+
+        now = time.time()
+
+        with self.lock:
+            cursor = self.connection.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+
+            try:
+
+                if now - self.cleaned_at > self.cleanup_seconds:
+                    self.cleaned_at = now
+                    self.expire(cursor, now)
+
+                result = function(cursor, now, *args)
+                cursor.execute("COMMIT")
+
+            except BaseException:
+                cursor.execute("ROLLBACK")
+
+                raise
+
+        return result
+
+    def expire(self, cursor, now):
+        """Delete every counter which has expired and every
+        bucket which is full by `now`; both are as good as
+        never used.
+
+        """
+
+        cursor.execute("DELETE FROM counters WHERE expires <= ?", (now,))
+        cursor.execute("DELETE FROM buckets WHERE full_at <= ?", (now,))
+
+    def incr(self, key, expiry, elastic_expiry=False):
+
+        return self.update(self.increment, key, expiry, elastic_expiry)
+
+    def increment(self, cursor, now, key, expiry, elastic_expiry):
+        row = cursor.execute("SELECT count, expires FROM counters "
+                             "WHERE key = ? AND expires > ?",
+                             (key, now)).fetchone()
+        # an expired counter starts over
+        count, expires = row or (0, now + expiry)
+
+        if elastic_expiry:
+            expires = now + expiry
+
+        cursor.execute("INSERT OR REPLACE INTO counters VALUES (?, ?, ?)",
+                       (key, count + 1, expires))
+
+        return count + 1
+
+    def get(self, key):
+        row = self.connection.execute("SELECT count FROM counters "
+                                      "WHERE key = ? AND expires > ?",
+                                      (key, time.time())).fetchone()
+
+        return row[0] if row else 0
+
+    def get_expiry(self, key):
+        row = self.connection.execute("SELECT expires FROM counters "
+                                      "WHERE key = ?", (key,)).fetchone()
+
+        return int(row[0]) if row else -1
+
+    def acquire_token(self, key, interval, capacity):
+        """Take a hit out of a token bucket, if there's one left.
+
+        Args:
+            key (str): --
+            interval (float): Seconds to refill one hit.
+            capacity (int): Most hits the bucket holds.
+
+        Returns:
+            bool: True if there was.
+
+        """
+
+        return self.update(self.take_token, key, interval, capacity)
+
+    def take_token(self, cursor, now, key, interval, capacity):
+        full_at = max(self.get_full_at(key, cursor), now) + interval
+
+        if full_at - now > capacity * interval:
+
+            return False
+
+        cursor.execute("INSERT OR REPLACE INTO buckets VALUES (?, ?)",
+                       (key, full_at))
+
+        return True
+
+    def get_full_at(self, key, cursor=None):
+        """When the bucket `key` will be full again; 0 if it
+        already is.
+
+        """
+
+        row = (cursor or self.connection).execute(
+            "SELECT full_at FROM buckets WHERE key = ?", (key,)).fetchone()
+
+        return row[0] if row else 0
+
+    def check(self):
+
+        return self.connection.execute("SELECT 1").fetchone() == (1,)
+
+    def reset(self):
+
+        with self.lock:
+            self.connection.execute("DELETE FROM counters")
+            self.connection.execute("DELETE FROM buckets")
+
+    def clear(self, key):
+
+        with self.lock:
+            self.connection.execute("DELETE FROM counters WHERE key = ?",
+                                    (key,))
+            self.connection.execute("DELETE FROM buckets WHERE key = ?",
+                                    (key,))
+
+
+class TokenBucketRateLimiter(limits.strategies.RateLimiter):
+    """N hits per period as a bucket of N, refilled at one hit
+    every period / N seconds.
+
+    Refused hits don't count, like the moving window.
+
+    """
+
+    def __init__(self, storage):
+
+        if not hasattr(storage, "acquire_token"):
+
+            raise NotImplementedError("token buckets aren't implemented for "
+                                      "storage of type %s" % type(storage))
+
+        super(TokenBucketRateLimiter, self).__init__(storage)
+
+    def hit(self, item, *identifiers):
+
+        return self.storage().acquire_token(
+            item.key_for(*identifiers),
+            item.get_expiry() / float(item.amount), item.amount)
+
+    def test(self, item, *identifiers):
+
+        return self.get_window_stats(item, *identifiers)[1] > 0
+
+    def get_window_stats(self, item, *identifiers):
+        """When the bucket is full again, and how many hits
+        are left in it.
+
+        """
+
+        now = time.time()
+        interval = item.get_expiry() / float(item.amount)
+        full_at = max(self.storage().get_full_at(item.key_for(*identifiers)),
+                      now)
+        remaining = int(item.amount - (full_at - now) / interval)
+
+        return int(full_at), max(0, remaining)
+
+
+limits.strategies.STRATEGIES["token-bucket"] = TokenBucketRateLimiter
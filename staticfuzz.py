@@ -6,47 +6,193 @@ If this script is invoked directly, it can be used
 as a CLI for managing staticfuzz.
 
 You can test this by running:
-    gunicorn -b 127.0.0.1:5000 -k gevent main:app
+    gunicorn -b 127.0.0.1:5000 -k gevent staticfuzz:app
+
+If you run more than one worker, set BROADCAST_BACKEND
+so that every worker hears about every new memory.
 
 Usage:
     staticfuzz.py init_db
     staticfuzz.py serve
+    staticfuzz.py optimize_backgrounds
+    staticfuzz.py profile_glitch <files>... [--seed=<n>] [--repeat=<n>]
+                                 [--preset=<name>] [--pstats=<file>]
     staticfuzz.py -h | --help
 
 Options:
-    -h --help    Show this screen.
+    -h --help          Show this screen.
+    --seed=<n>         Seed of the first glitch of each file [default: 0].
+    --repeat=<n>       Glitches per file, seeds counting up [default: 5].
+    --preset=<name>    Glitch with this preset (see glitch.PRESETS)
+                       rather than GLITCH_PRESET.
+    --pstats=<file>    Also save cProfile statistics of every glitch
+                       here, for pstats or snakeviz.
 
 """
 
-import mimetypes
+# First, before anything imports threading or socket:
+# libraries which create locks at import time (urllib3's
+# pool lock, for one) would otherwise get real locks,
+# which deadlock the whole worker when greenlets contend.
+from gevent import monkey
+monkey.patch_all()
+
+import collections
 import datetime
+import cProfile
+import hashlib
+import gzip
 import random
-import urllib
-import json
+import socket
+import time
 import os
 import re
 
 import flask
 import docopt
-import gevent
-import requests
 import markupsafe
+import sqlalchemy
+import gevent
+import gevent.pool
+import gevent.queue
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+try:
+    import brotli
+except ImportError:
+    brotli = None
 from flask_limiter import Limiter
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy.exc import IntegrityError
 from gevent.pywsgi import WSGIServer
-from gevent import monkey
 
+import jobs
+import board
 import glitch
+import backgrounds
+import ingest
+import broadcast
+import storage
+import glitchpool
+import danbooru
+import commands
+import metrics
+import cache
+import ratelimit  # registers its storage and strategy with Limiter
 
 
-monkey.patch_all()  # NOTE: totally cargo culting this one
-
 # Create and init the staticfuzz
 app = flask.Flask(__name__)
 app.config.from_object("config")
+app.config.from_envvar("STATICFUZZ_SETTINGS", silent=True)
 limiter = Limiter(app)
 
-db = SQLAlchemy(app)
+db = SQLAlchemy(app, engine_options=storage.engine_options(app.config))
+
+with app.app_context():
+    engine = db.get_engine()
+
+if storage.is_tuned(app.config):
+    storage.tune(engine, app.config)
+
+hub = broadcast.Hub(app.config["STREAM_QUEUE_SIZE"])
+memory_board = board.Board(app.config["BOARD_SIZE"])
+backend = broadcast.backend_from_uri(app.config["BROADCAST_BACKEND"])
+background_index = backgrounds.BackgroundIndex(
+    os.path.join(app.root_path, app.config["RANDOM_IMAGE_DIRECTORY"]),
+    app.config["RANDOM_IMAGE_RESCAN_SECONDS"])
+variant_index = backgrounds.BackgroundIndex(
+    os.path.join(app.root_path, app.config["BACKGROUND_VARIANT_DIRECTORY"]),
+    app.config["RANDOM_IMAGE_RESCAN_SECONDS"])
+thumbnail_jobs = jobs.JobQueue(app.config["THUMBNAIL_WORKERS"],
+                               app.config["THUMBNAIL_QUEUE_SIZE"],
+                               app.config["THUMBNAIL_TIMEOUT"])
+command_jobs = jobs.JobQueue(app.config["COMMAND_WORKERS"],
+                             app.config["COMMAND_QUEUE_SIZE"],
+                             app.config["COMMAND_TIMEOUT"])
+
+glitch_preset = glitch.preset(app.config["GLITCH_PRESET"])
+
+if app.config["GLITCH_PROCESSES"]:
+    glitch_pool = glitchpool.GlitchPool(
+        app.config["GLITCH_PROCESSES"],
+        {"max_size": [app.config["THUMB_MAX_WIDTH"],
+                      app.config["THUMB_MAX_HEIGHT"]],
+         "min_colors": app.config["MIN_COLORS"],
+         "max_colors": app.config["MAX_COLORS"],
+         "max_pixels": app.config["IMAGE_MAX_PIXELS"],
+         "cache_bytes": app.config["GLITCH_CACHE_BYTES"],
+         "cache_directory": app.config["GLITCH_CACHE_DIRECTORY"],
+         "cache_disk_bytes": app.config["GLITCH_CACHE_DISK_BYTES"]},
+        app.config["GLITCH_TIMEOUT"])
+else:
+    glitch_pool = None
+
+danbooru_search = danbooru.Danbooru(
+    app.config["DANBOORU_URL"],
+    app.config["DANBOORU_TIMEOUT"],
+    cache.TTLCache(app.config["DANBOORU_CACHE_SIZE"],
+                   app.config["DANBOORU_CACHE_SECONDS"]),
+    app.config["DANBOORU_PREFETCH"])
+
+# What /metrics reports, besides glitch.stage_seconds.
+request_seconds = metrics.registry.histogram(
+    "staticfuzz_request_seconds",
+    "Time to handle a request, up to its first byte.",
+    ["endpoint"])
+request_queries = metrics.registry.histogram(
+    "staticfuzz_request_queries",
+    "Database queries made while handling a request.",
+    ["endpoint"], buckets=metrics.COUNT_BUCKETS)
+queries_total = metrics.registry.counter(
+    "staticfuzz_queries_total",
+    "Database queries, in and out of requests.")
+ratelimited_total = metrics.registry.counter(
+    "staticfuzz_ratelimited_total",
+    "Requests refused with 429.",
+    ["endpoint"])
+streams_open = metrics.registry.gauge(
+    "staticfuzz_streams_open",
+    "Event streams currently connected to this worker.")
+streams_refused_total = metrics.registry.counter(
+    "staticfuzz_streams_refused_total",
+    "Event streams refused with 503, STREAM_MAX_CONNECTIONS being open.")
+streams_dropped_total = metrics.registry.counter(
+    "staticfuzz_streams_dropped_total",
+    "Event streams closed for falling STREAM_QUEUE_SIZE events behind.")
+connections_open = metrics.registry.gauge(
+    "staticfuzz_connections_open",
+    "HTTP connections to `staticfuzz.py serve`, streams included.")
+events_published_total = metrics.registry.counter(
+    "staticfuzz_events_published_total",
+    "Events this worker sent to its streams.",
+    ["event"])
+events_delivered_total = metrics.registry.counter(
+    "staticfuzz_events_delivered_total",
+    "Events put on a stream's queue; one per event per stream.",
+    ["event"])
+thumbnail_job_stats = metrics.registry.gauge(
+    "staticfuzz_thumbnail_jobs",
+    "Thumbnail job queue statistics, see JobQueue.stats().",
+    ["stat"])
+command_job_stats = metrics.registry.gauge(
+    "staticfuzz_command_jobs",
+    "Slash command job queue statistics, see JobQueue.stats().",
+    ["stat"])
+glitch_pool_stats = metrics.registry.gauge(
+    "staticfuzz_glitch_pool",
+    "Glitch process pool statistics, see GlitchPool.stats().",
+    ["stat"])
+glitch_cache_stats = metrics.registry.gauge(
+    "staticfuzz_glitch_cache",
+    "Glitch thumbnail cache statistics, see LRUCache.stats().",
+    ["stat"])
+danbooru_stats = metrics.registry.gauge(
+    "staticfuzz_danbooru",
+    "Danbooru search statistics, see Danbooru.stats().",
+    ["stat"])
 
 
 class Memory(db.Model):
@@ -58,9 +204,11 @@ class Memory(db.Model):
         id (int): Unique identifier, never resets.
         text (str): String, the text of the memory, the
             memory itself.
-        base64_image str): if `text` is a URI to an image,
-            then this is the base64 encoding of said
-            image. Used as thumbnail.
+        thumbnail (str|None): if `text` is a URI to an image,
+            then this is the ID of its glitched Thumbnail.
+        image_status (str|None): None if `text` isn't a link
+            to an image, otherwise "pending" until the
+            thumbnail job is done, then "ready" or "failed".
 
     """
 
@@ -69,26 +217,27 @@ class Memory(db.Model):
     timestamp = db.Column(db.DateTime,
                           default=datetime.datetime.utcnow)
     text = db.Column(db.Unicode(140), unique=True)
-    base64_image = db.Column(db.String())
+    thumbnail = db.Column(db.String(40))
+    image_status = db.Column(db.String(8))
 
     def __init__(self, text):
-        """Create a new memory with text and optionally base64
-        representation of the image content found at the URI in
-        the text argument.
+        """Create a new memory with text.
 
         Args:
             text (str): This is required for all memories. If this
-                is a link to an image, a base64_image thumbnail will
-                be generated for said image.
+                looks like a link to an image, the memory starts
+                out "pending"; submit make_thumbnail() once it's
+                committed to generate its thumbnail.
 
         """
 
         self.text = text
+        self.thumbnail = None
 
-        if uri_valid_image(text):  # valid uri to image?
-            self.base64_image = glitch.glitch_from_url(text)
+        if ingest.looks_like_image_uri(text):
+            self.image_status = "pending"
         else:
-            self.base64_image = None
+            self.image_status = None
 
     def __repr__(self):
 
@@ -100,123 +249,165 @@ class Memory(db.Model):
         This is for sending as an event.
 
         Returns:
-            dict: Looks something like this:
-
-                >>> {'text': "foo", "base64_image": None}
+            dict: See `board.MemoryRecord.to_dict()`.
 
         """
 
-        timestamp = self.timestamp.isoformat("T") + 'Z'
+        return board.MemoryRecord.from_row(self).to_dict()
 
-        return {"text": self.text,
-                "timestamp": timestamp,
-                "base64_image": self.base64_image,
-                "id": self.id}
 
+# Only the columns a MemoryRecord needs, oldest first.
+MEMORY_RECORD_SELECT = (sqlalchemy.
+                        select([Memory.id, Memory.text, Memory.timestamp,
+                                Memory.thumbnail, Memory.image_status]).
+                        order_by(Memory.id))
 
-class SlashCommandResponse(object):
-    """All SlashCommand.callback() methods must return this.
 
-    Attributes:
-        create_memory (bool): If True create a memory using
-            value attribute. Otherwise serve value as a
-            response.
-        value (tuple[str, int]|str): Either a tuple which
-            holds a status message and an HTTP error code,
-            or a string to create a memory. Example values:
+def memory_records(*criteria):
+    """Load memories as MemoryRecords, straight from the rows
+    of a plain SELECT: no ORM objects are made.
 
-                >>> "some memory text"
-                >>> ("Bad ID", 400)
+    Args:
+        *criteria: For the WHERE clause, e.g., `Memory.id > 5`.
 
-    See Also:
-        SlashCommand
+    Returns:
+        list[board.MemoryRecord]: Oldest first.
 
     """
 
-    def __init__(self, create_memory, value):
-        """The result of a slash command.
+    statement = MEMORY_RECORD_SELECT
 
-        Args:
-            create_memory (bool): If True the value will be
-                used to create a memory. If False value will be
-                sent as a response, e.g., "Invalid URI," 400.
-            value (any): A string to be used for creating a
-                memory, or a response to be sent like:
+    for criterion in criteria:
+        statement = statement.where(criterion)
 
-                >>> ("Invalid Shipping Address", 400)
+    return [board.MemoryRecord.from_row(row)
+            for row in db.session.execute(statement)]
 
-        Examples:
 
-            >>> SlashCommandResponse(False, ("Bad thing!", 400))
-            >>> SlashCommandResponse(True, "some kinda memory text")
+class Thumbnail(db.Model):
+    """A glitched image, as PNG, kept apart from the memories
+    so that it's only ever sent to browsers by /thumb/.
 
-        """
+    Thumbnails are content-addressed: the ID is the SHA-1
+    of the PNG, so it never changes and can be cached
+    forever, and reposts of the same image share a row.
+
+    Fields/attributes:
+        id (str): Hex SHA-1 digest of `png`.
+        png (str): The image itself.
 
-        self.create_memory = create_memory
-        self.value = value
+    """
+
+    __tablename__ = "thumbnails"
+    id = db.Column(db.String(40), primary_key=True)
+    png = db.Column(db.LargeBinary)
+
+    def __init__(self, png):
+        self.id = hashlib.sha1(png).hexdigest()
+        self.png = png
 
 
-class SlashCommand(object):
-    """IRC-like command; a more complicated memory.
+def forget_orphaned_thumbnails():
+    """Delete the thumbnails no memory uses anymore.
 
-    When input text is received, it is also sent to each
-    slash command's attempt() method. The first attempt
-    to return a SlashCommandResponse gets used either to
-    create a memory or serve a response (like a 400).
+    Does not commit.
 
     """
 
-    NAME = str()
+    in_use = (db.session.query(Memory.thumbnail).
+              filter(Memory.thumbnail.isnot(None)))
+    (Thumbnail.query.filter(~Thumbnail.id.in_(in_use)).
+     delete(synchronize_session=False))
 
-    @classmethod
-    def attempt(cls, text):
-        """Return either None or the SlashCommandResponse
-        associated with running the command.
 
-        Returns:
-            SlashCommandResponse|None: Returns None if
-                `text` is not even this command. Otherwise
-                return the result of executing this command.
+def forget_memories_off_board(board_size):
+    """Delete every memory but the newest `board_size`, in one
+    statement.
 
-        """
+    Does not commit.
 
-        text = text.lower().strip()
-        pattern = "/" + cls.NAME
+    """
 
-        if not (text.startswith(pattern + " ") or
-                text == pattern):
+    newest = (db.session.query(Memory.id).order_by(Memory.id.desc()).
+              limit(board_size).subquery())
+    (Memory.query.filter(~Memory.id.in_(db.session.query(newest.c.id))).
+     delete(synchronize_session=False))
 
-            return None
 
-        text = text.replace(pattern, u"")
-        args = [arg.strip() for arg in text.split(" ") if arg.strip()]
+def glitch_image(image_bytes):
+    """Glitch with a random seed and the GLITCH_PRESET, in the
+    glitch pool if there is one.
 
-        try:
+    Args:
+        image_bytes (str): The downloaded image.
 
-            return cls.callback(*args)
+    Returns:
+        str: The glitched thumbnail, as PNG.
 
-        # NOTE: what if typeerror is raised because of something
-        # in the callback. Seems like a bad approach... could
-        # cause debugging headaches.
-        except TypeError:
+    Raises:
+        glitchpool.GlitchFailed: In the pool, anything which
+            goes wrong, including timing out.
 
-            return SlashCommandResponse(False, ("%s incorrect args" %
-                                                cls.NAME, 400))
+    """
 
-    @staticmethod
-    def callback(*args):
-        """Ovverride this with another staticmethod; do something
-        with the args, return a SlashCommandResponse.
+    if glitch_pool is None:
 
-        Use any number of args you please (including 0) or *args
-        (variable length).
+        return glitch.glitch_from_bytes(image_bytes, glitch_preset)
 
-        """
+    return glitch_pool.glitch(image_bytes, random.getrandbits(32),
+                              glitch_preset)[0]
+
+
+def make_thumbnail(memory_id, uri):
+    """Background job: download and glitch the image a memory
+    links to, then let everyone know it's ready.
+
+    The memory is marked "failed" if anything goes wrong,
+    including the job timing out.
+
+    Args:
+        memory_id (int): The pending memory.
+        uri (str): Its text; a link to an image.
+
+    """
+
+    thumbnail = None
+
+    try:
+        image_bytes = ingest.fetch_image(uri,
+                                         app.config["IMAGE_MAX_BYTES"],
+                                         app.config["IMAGE_FETCH_TIMEOUT"],
+                                         app.config["IMAGE_MAX_PIXELS"])
+
+        if image_bytes:
+
+            with app.app_context():
+                thumbnail = Thumbnail(glitch_image(image_bytes))
+
+    finally:
 
-        pass
+        with app.app_context():
+
+            if thumbnail:
+                db.session.merge(thumbnail)
+
+            updated = (Memory.query.filter_by(id=memory_id).
+                       update({"thumbnail": thumbnail and thumbnail.id,
+                               "image_status": ("ready" if thumbnail
+                                                else "failed")}))
+            forget_orphaned_thumbnails()
+            db.session.commit()
+
+        # it may have been forgotten in the meantime
+        if updated:
+            backend.publish({"event": "thumbnail", "id": memory_id})
+
+
+slash_commands = commands.SlashCommandRegistry()
 
 
-class SlashLogin(SlashCommand):
+@slash_commands.register
+class SlashLogin(commands.SlashCommand):
     """Login as deity if the secret is correct.
 
     Note:
@@ -250,14 +441,16 @@ class SlashLogin(SlashCommand):
             flask.flash(app.config["DEITY_GREET"])
             redirect = flask.redirect(flask.url_for('show_memories'))
 
-            return SlashCommandResponse(False, redirect)
+            return commands.SlashCommandResponse(False, redirect)
 
         else:
 
-            return SlashCommandResponse(False, (app.config["LOGIN_FAIL"], 401))
+            return commands.SlashCommandResponse(
+                False, (app.config["LOGIN_FAIL"], 401))
 
 
-class SlashLogout(SlashCommand):
+@slash_commands.register
+class SlashLogout(commands.SlashCommand):
     """Stop being a deity.
 
     Note:
@@ -280,12 +473,16 @@ class SlashLogout(SlashCommand):
         flask.flash(app.config["DEITY_GOODBYE"])
         redirect = flask.redirect(flask.url_for('show_memories'))
 
-        return SlashCommandResponse(False, redirect)
+        return commands.SlashCommandResponse(False, redirect)
 
 
-class SlashDanbooru(SlashCommand):
+@slash_commands.register
+class SlashDanbooru(commands.SlashCommand):
     """Get a random image from the first page of a search
-    for specific tags on danbooru.donmai.us.
+    for specific tags on Danbooru.
+
+    Runs in the background, since a search which isn't
+    cached (see `danbooru.Danbooru`) waits on Danbooru.
 
     See Also:
         http://danbooru.donmai.us/wiki_pages/43568 
@@ -293,6 +490,7 @@ class SlashDanbooru(SlashCommand):
     """
 
     NAME = u"danbooru"
+    ASYNC = True
 
     @staticmethod
     def callback(*args):
@@ -304,99 +502,332 @@ class SlashDanbooru(SlashCommand):
 
         Returns:
             SlashCommandResponse: Either the random image found,
-                or a 400 for whatever error encountered while
-                attempting to get a random image.
+                a 400 if there were no results, or a 503 if
+                Danbooru couldn't be reached.
 
         """
 
-        tags = urllib.quote_plus(' '.join(args))
-        endpoint = ('http://danbooru.donmai.us/posts.json?'
-                    'tags=%s&limit=10&page1' % tags)
-        results = requests.get(endpoint).json()
-
         try:
-            selected_image = ("http://danbooru.donmai.us" +
-                              random.choice(results)["file_url"])
+            image_links = danbooru_search.search(args)
+
+        except danbooru.DanbooruUnavailable:
 
-            return SlashCommandResponse(True, selected_image)
+            return commands.SlashCommandResponse(
+                False, (app.config["ERROR_BUSY"], 503))
 
-        except IndexError:
+        if not image_links:
 
             # There were no results!
-            return SlashCommandResponse(False,
-                                        (app.config["ERROR_DANBOORU"], 400))
+            return commands.SlashCommandResponse(
+                False, (app.config["ERROR_DANBOORU"], 400))
+
+        return commands.SlashCommandResponse(True, random.choice(image_links))
+
+
+NUMBER_LINK_PATTERN = re.compile("(?<!&)(#\d+)")
 
 
 @app.template_filter('number_links')
 def number_links(string_being_filtered):
     escaped_string = markupsafe.escape(string_being_filtered)
     unicode_escaped_string = unicode(escaped_string)
-    pattern = re.compile("(?<!&)(#\d+)")
-    final_string = pattern.subn(r'<a href="\1">\1</a>',
-                                unicode_escaped_string)[0]
+    final_string = NUMBER_LINK_PATTERN.subn(r'<a href="\1">\1</a>',
+                                            unicode_escaped_string)[0]
 
     return final_string
 
 
-def uri_valid_image(uri):
-    """Check if provided `uri` is a valid URI to
-    an image, as allowed by the extension whitelist.
+@app.errorhandler(429)
+def ratelimit_handler(error):
+    """Handle rate exceeding error message.
 
-    Returns:
-        bool: True if `uri` is both an accessible
-            URI without any errors *and* the file
-            extension is in the whitelist.
+    Args:
+        error (?): automagically provided
 
     """
 
-    image_extension_whitelist = (".jpg", ".jpeg", ".png", ".gif")
+    ratelimited_total.inc(endpoint=flask.request.endpoint or "none")
 
-    if not uri.lower().endswith(image_extension_whitelist):
+    return app.config["ERROR_RATE_EXCEEDED"], 429
 
-        return False
 
-    # actually fetch the resource to see if it's real or not
-    try:
-        request = requests.get(uri)
-        assert request.status_code == 200
+@app.before_request
+def start_request_metrics():
+    flask.g.started = time.time()
+    flask.g.queries = 0
 
-    except (requests.exceptions.InvalidSchema,
-            requests.exceptions.MissingSchema,
-            requests.exceptions.ConnectionError,
-            AssertionError):
 
-        return False
+@app.teardown_request
+def record_request_metrics(exception):
 
-    return True
+    # e.g., refused by the limiter before we started
+    if "started" not in flask.g:
 
+        return
 
-@app.errorhandler(429)
-def ratelimit_handler(error):
-    """Handle rate exceeding error message.
+    endpoint = flask.request.endpoint or "none"
+    request_seconds.observe(time.time() - flask.g.started, endpoint=endpoint)
+    request_queries.observe(flask.g.queries, endpoint=endpoint)
 
-    Args:
-        error (?): automagically provided
+
+def count_query(connection, cursor, statement, parameters, context,
+                executemany):
+    """SQLAlchemy "before_cursor_execute" listener."""
+
+    queries_total.inc()
+
+    if flask.has_request_context() and "queries" in flask.g:
+        flask.g.queries += 1
+
+
+sqlalchemy.event.listen(engine, "before_cursor_execute", count_query)
+
+
+@app.route('/metrics')
+@limiter.exempt
+def show_metrics():
+    """This worker's metrics, in Prometheus' text format.
+
+    Every worker keeps its own, so scrape each of them.
 
     """
 
-    return app.config["ERROR_RATE_EXCEEDED"], 429
+    if not app.config["METRICS_ENABLED"]:
+        flask.abort(404)
+
+    streams_open.set(len(hub.subscribers))
+
+    if connections is not None:
+        connections_open.set(len(connections))
+
+    for stat, value in thumbnail_jobs.stats().items():
+        thumbnail_job_stats.set(value, stat=stat)
+
+    for stat, value in command_jobs.stats().items():
+        command_job_stats.set(value, stat=stat)
+
+    if glitch_pool is not None:
+        pool_stats = glitch_pool.stats()
+
+        for stat, value in pool_stats.pop("cache").items():
+            glitch_cache_stats.set(value, stat=stat)
+
+        for stat, value in pool_stats.items():
+            glitch_pool_stats.set(value, stat=stat)
+
+    elif glitch.thumbnail_cache is not None:
+
+        for stat, value in glitch.thumbnail_cache.stats().items():
+            glitch_cache_stats.set(value, stat=stat)
+
+    for stat, value in danbooru_search.stats().items():
+        danbooru_stats.set(value, stat=stat)
+
+    return flask.Response(metrics.registry.render(),
+                          mimetype="text/plain; version=0.0.4")
+
+
+def send_background(found, cache_timeout):
+    """Serve a Background, supporting ETag and Range requests.
+
+    The best optimized variant the client accepts is sent
+    instead, if there is one. If USE_X_SENDFILE is set, the
+    frontend server sends the file itself.
+
+    """
+
+    accept = flask.request.headers.get("Accept", "")
+    found = variant_index.variant(found.name, accept) or found
+    response = flask.send_file(found.path, mimetype=found.mimetype,
+                               add_etags=False, conditional=False,
+                               cache_timeout=cache_timeout)
+    response.set_etag(found.etag)
+    response.last_modified = found.mtime
+    response.vary.add("Accept")
+
+    return response.make_conditional(flask.request, accept_ranges=True,
+                                     complete_length=found.size)
 
 
 @app.route('/random_image', methods=['GET', 'POST'])
 @limiter.limit("2/second")
 def random_image():
-    # NOTE: should be a config var
-    image_directory = app.config["RANDOM_IMAGE_DIRECTORY"]
-    image_path = os.path.join(image_directory,
-                              random.choice(os.listdir(image_directory)))
-            
-    return flask.send_file(image_path, mimetypes.guess_type(image_path)[0])
+    """A random background image.
+
+    With RANDOM_IMAGE_REDIRECT, redirect to the image's
+    own URL, which browsers can cache, instead of sending
+    the image itself.
+
+    """
+
+    found = background_index.choice()
+
+    if found is None:
+        flask.abort(404)
+
+    if not app.config["RANDOM_IMAGE_REDIRECT"]:
+
+        return send_background(found, cache_timeout=0)
+
+    response = flask.redirect(flask.url_for('background', name=found.name))
+    response.headers["Cache-Control"] = "no-store"
+
+    return response
+
+
+@app.route('/backgrounds/<name>')
+def background(name):
+    """One background image, at a stable URL."""
+
+    found = background_index.get(name)
+
+    if found is None:
+        flask.abort(404)
+
+    return send_background(found, app.config["BACKGROUND_CACHE_SECONDS"])
+
+
+def optimize_backgrounds():
+    """For use on command line: make lightweight variants of
+    every background and report how much smaller they are.
+
+    """
+
+    print("%-44s %10s %10s %10s" % ("background", "original",
+                                     "gif", "webp"))
+    total = {"original": 0, ".gif": 0, ".webp": 0}
+
+    for found in background_index.backgrounds:
+        sizes = backgrounds.optimize(found, variant_index.directory,
+                                     app.config["BACKGROUND_MAX_WIDTH"],
+                                     app.config["BACKGROUND_COLORS"],
+                                     app.config["BACKGROUND_FRAME_STEP"])
+        total["original"] += found.size
+
+        for extension in (".gif", ".webp"):
+            total[extension] += sizes.get(extension, found.size)
+
+        print("%-44s %10d %10s %10s" % (found.name, found.size,
+                                        percent_of(sizes.get(".gif"),
+                                                   found.size),
+                                        percent_of(sizes.get(".webp"),
+                                                   found.size)))
+
+    print("%-44s %10d %10s %10s" % ("total", total["original"],
+                                    percent_of(total[".gif"],
+                                               total["original"]),
+                                    percent_of(total[".webp"],
+                                               total["original"])))
+
+
+def profile_glitch(paths, seed, repeat, pstats_path=None, preset=None):
+    """For use on command line: glitch local images with fixed
+    seeds and report what each stage of the glitch costs.
+
+    The thumbnail cache isn't used, so decoding and resizing
+    are measured every time. Allocations are only measured
+    where there's tracemalloc (Python 3); otherwise they're
+    reported as n/a.
+
+    Args:
+        paths (list[str]): Image files.
+        seed (int): Seed of each file's first glitch.
+        repeat (int): Glitches per file.
+        pstats_path (str|None): Where to save cProfile stats.
+        preset (str|None): A key of glitch.PRESETS; None uses
+            GLITCH_PRESET.
+
+    """
+
+    engine = glitch.GlitchEngine.from_config(app.config)
+    fixed = glitch.preset(preset) if preset else glitch_preset
+    profiler = glitch.StageProfiler()
+    glitch.stage_hooks.append(profiler)
+    code_profile = cProfile.Profile() if pstats_path else None
+    tracing = glitch.tracemalloc is not None
+    tracing = tracing and not glitch.tracemalloc.is_tracing()
+
+    if tracing:
+        glitch.tracemalloc.start()
+
+    try:
+
+        for path in paths:
+
+            with open(path, "rb") as image_file:
+                image_bytes = image_file.read()
+
+            profiler.stages.clear()
+            output_bytes = 0
+
+            try:
+
+                for run in range(repeat):
+
+                    if code_profile:
+                        code_profile.enable()
+
+                    glitched, __ = engine.glitch(image_bytes, seed + run,
+                                                 fixed)
+                    output_bytes += len(glitched)
+
+                    if code_profile:
+                        code_profile.disable()
+
+            except Exception as error:
+
+                if code_profile:
+                    code_profile.disable()
+
+                print("%s: can't be glitched (%r)" % (path, error))
+
+                continue
+
+            print("%s: %d bytes in, %d bytes out on average" %
+                  (path, len(image_bytes), output_bytes // repeat))
+            print("  %-14s %6s %10s %14s" % ("stage", "calls", "ms/call",
+                                              "alloc KiB/call"))
+
+            for name, totals in profiler.stages.items():
+
+                if totals["allocated_bytes"] is None:
+                    allocated = "n/a"
+                else:
+                    allocated = "%.1f" % (totals["allocated_bytes"] / 1024.0 /
+                                          totals["calls"])
+
+                print("  %-14s %6d %10.2f %14s" %
+                      (name, totals["calls"],
+                       1000 * totals["seconds"] / totals["calls"],
+                       allocated))
+
+    finally:
+        glitch.stage_hooks.remove(profiler)
+
+        if tracing:
+            glitch.tracemalloc.stop()
+
+    if code_profile:
+        code_profile.dump_stats(pstats_path)
+
+
+def percent_of(size, original_size):
+    """Format `size` as a percentage of `original_size`."""
+
+    if size is None:
+
+        return "-"
+
+    return "%.1f%%" % (100.0 * size / original_size)
 
 
 def init_db():
     """For use on command line for setting up
     the database.
 
+    With SQLITE_TUNED, this also switches the database
+    file to write-ahead logging, which sticks.
+
     """
 
     db.drop_all()
@@ -407,10 +838,211 @@ def init_db():
     db.session.commit()
 
 
-def event():
+class Relay(object):
+    """Turn backend messages into frames for this worker's hub.
+
+    However many streams this worker serves, each message
+    costs at most one query, and each memory is serialized
+    once. The frames of the most recent memories are kept
+    so reconnecting clients can catch up without a query,
+    along with those of the most recent forgets.
+
+    Attributes:
+        latest_memory_id (int|None): The newest memory this
+            worker has published; None until the first one.
+        frames (OrderedDict): Memory ID to its frame, for the
+            last `replay_size` memories still on the board,
+            oldest first.
+        forgotten (OrderedDict): Memory ID to its forget
+            frame, for the last `replay_size` forgets.
+
+    """
+
+    def __init__(self, replay_size):
+        self.latest_memory_id = None
+        self.replay_size = replay_size
+        self.frames = collections.OrderedDict()
+        self.forgotten = collections.OrderedDict()
+
+    def remember(self, memory_id, frame):
+        """Keep `frame` around for replay."""
+
+        self.frames[memory_id] = frame
+
+        while len(self.frames) > self.replay_size:
+            self.frames.popitem(last=False)
+
+    def forget(self, memory_id, frame):
+        """Never replay the memory `memory_id` again, and
+        replay its forget `frame` instead.
+
+        """
+
+        self.frames.pop(memory_id, None)
+        self.forgotten[memory_id] = frame
+
+        while len(self.forgotten) > self.replay_size:
+            self.forgotten.popitem(last=False)
+
+    def frames_after(self, memory_id):
+        """What a client which saw up to `memory_id` missed:
+        the forgets of memories it may have seen, then the
+        frames of newer memories, oldest first.
+
+        A client older than every remembered frame (this
+        worker only just started, say) gets the newer
+        memories on the board instead, serialized afresh.
+
+        """
+
+        forgets = [frame for frame_id, frame in self.forgotten.items()
+                   if frame_id <= memory_id]
+
+        if self.frames and next(iter(self.frames)) <= memory_id:
+
+            return forgets + [frame for frame_id, frame in self.frames.items()
+                              if frame_id > memory_id]
+
+        return forgets + [self.frames.get(record.id) or
+                          broadcast.memory_frame(record.to_dict())
+                          for record in memory_board.to_list()
+                          if record.id > memory_id]
+
+    def send(self, event, frames):
+        """Publish `frames` (a list of str) of the kind `event`
+        to the hub, all at once.
+
+        """
+
+        delivered = hub.publish("".join(frames))
+        events_published_total.inc(len(frames), event=event)
+        events_delivered_total.inc(len(frames) * delivered, event=event)
+
+    def __call__(self, message):
+        """Handle one message from the backend.
+
+        Args:
+            message (dict): Like {"event": "memory", "id": 5};
+                the event is "memory", "thumbnail", "forget" or
+                "command".
+
+        """
+
+        if message["event"] == "command":
+            self.send("command", [broadcast.command_frame(
+                message["ticket"], message["message"], message["status"])])
+
+            return
+
+        if message["event"] == "forget":
+            memory_board.remove(message["id"])
+            frame = broadcast.forget_frame(message["id"])
+            self.forget(message["id"], frame)
+            self.send("forget", [frame])
+
+            return
+
+        if message["event"] == "thumbnail":
+
+            with app.app_context():
+                records = memory_records(Memory.id == message["id"])
+
+            for record in records:
+                memory_board.update(record)
+                memory_dict = record.to_dict()
+
+                # replay the memory with its thumbnail from now on
+                if record.id in self.frames:
+                    self.frames[record.id] = broadcast.memory_frame(
+                        memory_dict)
+
+                self.send("thumbnail",
+                          [broadcast.thumbnail_frame(memory_dict)])
+
+            return
+
+        # Anything newer than what we've already sent, which
+        # may include memories from other, slower messages.
+        if self.latest_memory_id is None:
+            newer_than = message["id"] - 1
+        else:
+            newer_than = self.latest_memory_id
+
+        with app.app_context():
+            records = memory_records(Memory.id > newer_than)
+
+        frames = []
+
+        for record in records:
+
+            for evicted in memory_board.add(record):
+                self.frames.pop(evicted.id, None)
+
+            frame = broadcast.memory_frame(record.to_dict())
+            self.remember(record.id, frame)
+            frames.append(frame)
+
+        if frames:
+            self.latest_memory_id = records[-1].id
+            self.send("memory", frames)
+
+
+def loaded_board():
+    """The board of memories, loaded from the database the
+    first time it's needed; the relay keeps it current.
+
+    Returns:
+        board.Board: --
+
+    """
+
+    if not memory_board.loaded:
+        memory_board.load(memory_records())
+
+    return memory_board
+
+
+def write_deadline(seconds):
+    """A gevent.Timeout raising socket.timeout, for a write
+    to a client.
+
+    """
+
+    return gevent.Timeout(seconds, socket.timeout("client stopped reading"))
+
+
+def event(last_event_id, retry_time_ms, heartbeat_seconds,
+          write_timeout):
     """EventSource stream; server side events. Used for
     sending out new memories.
 
+    Blocks on this stream's hub queue, so nothing is
+    queried while nothing is happening. If nothing happens
+    for `heartbeat_seconds`, a comment is sent anyway: a
+    client which is gone only shows when writing to it
+    fails, which then ends the stream.
+
+    A client which stopped reading (but is still connected)
+    makes the server's write block once the socket buffer
+    is full. Each yield arms a timer for `write_timeout`
+    seconds, which raises socket.timeout into the server's
+    write if it doesn't return by then; gevent's WSGI
+    server and gunicorn alike take that as the client
+    being gone.
+
+    If the hub drops this stream for falling behind, the
+    stream ends, and the client catches up by reconnecting.
+
+    Args:
+        last_event_id (int|None): ID of the last memory the
+            client saw; newer ones the relay still remembers
+            are sent first.
+        retry_time_ms (int): How long the client should wait
+            before reconnecting.
+        heartbeat_seconds (float): Longest the stream goes
+            without writing anything.
+        write_timeout (float): Longest a write may take.
+
     Returns:
         json event (str): --
 
@@ -419,28 +1051,67 @@ def event():
 
     """
 
-    with app.app_context():
+    # Subscribing and taking the frames to replay happen
+    # without yielding to other greenlets, so no memory can
+    # be missed or sent twice in between.
+    queue = hub.subscribe()
 
-        try:
-            latest_memory_id = Memory.query.order_by(Memory.id.desc()).first().id
-        except AttributeError:
-            # .id will raise AttributeError if the query doesn't match anything
-            latest_memory_id = 0
+    if last_event_id is None:
+        replay = []
+    else:
+        replay = relay.frames_after(last_event_id)
 
-    while True:
+    try:
+        # Also lets the client know it's connected before
+        # the first memory arrives.
+        with write_deadline(write_timeout):
+            yield broadcast.retry_frame(retry_time_ms)
 
-        with app.app_context():
-            memories = (Memory.query.filter(Memory.id > latest_memory_id).
-                        order_by(Memory.id.asc()).all())
+        for frame in replay:
 
-        if memories:
-            latest_memory_id = memories[-1].id
-            newer_memories = [memory.to_dict() for memory in memories]
+            with write_deadline(write_timeout):
+                yield frame
 
-            yield "data: " + json.dumps(newer_memories) + "\n\n"
+        while True:
 
-        with app.app_context():
-            gevent.sleep(app.config['SLEEP_RATE'])
+            try:
+                frame = queue.get(timeout=heartbeat_seconds)
+            except gevent.queue.Empty:
+                frame = broadcast.heartbeat_frame()
+
+            if queue not in hub.subscribers:
+                streams_dropped_total.inc()
+
+                return
+
+            with write_deadline(write_timeout):
+                yield frame
+
+    finally:
+        hub.unsubscribe(queue)
+
+
+@app.route('/thumb/<thumbnail_id>')
+def thumbnail(thumbnail_id):
+    """Serve a glitched thumbnail.
+
+    Its ID is the hash of its content, so browsers may
+    cache it forever; if they ask whether it changed, the
+    answer is no without even looking it up.
+
+    """
+
+    if thumbnail_id in flask.request.if_none_match:
+        response = flask.Response(status=304)
+    else:
+        found = Thumbnail.query.get_or_404(thumbnail_id)
+        response = flask.Response(found.png, mimetype="image/png")
+
+    response.set_etag(thumbnail_id)
+    response.headers["Cache-Control"] = ("public, max-age=31536000, "
+                                         "immutable")
+
+    return response
 
 
 @app.route('/stream/', methods=['GET', 'POST'])
@@ -449,12 +1120,43 @@ def stream():
     """SSE (Server Side Events), for an EventSource. Send
     the event of a new message.
 
+    Clients resuming a stream may say which memory they
+    saw last with either the Last-Event-ID header or the
+    last_event_id parameter.
+
+    With STREAM_MAX_CONNECTIONS streams open, more are
+    refused straight away with a 503, telling the client to
+    retry after STREAM_BUSY_RETRY_MS (in both a Retry-After
+    header and a retry: field).
+
     See Also:
         event()
 
     """
 
-    return flask.Response(event(), mimetype="text/event-stream")
+    if len(hub.subscribers) >= app.config["STREAM_MAX_CONNECTIONS"]:
+        streams_refused_total.inc()
+        retry_time_ms = app.config["STREAM_BUSY_RETRY_MS"]
+        response = flask.Response(broadcast.retry_frame(retry_time_ms),
+                                  status=503, mimetype="text/event-stream")
+        response.headers["Retry-After"] = str((retry_time_ms + 999) // 1000)
+
+        return response
+
+    last_event_id = (flask.request.headers.get("Last-Event-ID") or
+                     flask.request.args.get("last_event_id"))
+
+    try:
+        last_event_id = int(last_event_id)
+    except (TypeError, ValueError):
+        last_event_id = None
+    else:
+        loaded_board()  # for resuming from before the relay's frames
+
+    return flask.Response(event(last_event_id, app.config["RETRY_TIME_MS"],
+                                app.config["STREAM_HEARTBEAT_SECONDS"],
+                                app.config["STREAM_WRITE_TIMEOUT"]),
+                          mimetype="text/event-stream")
 
 
 @app.route('/')
@@ -464,11 +1166,92 @@ def show_memories():
 
     """
 
-    memories = Memory.query.order_by(Memory.id.asc()).all()
-    memories_for_jinja = [memory.to_dict() for memory in memories]
+    # Flashed messages are for one person only.
+    if '_flashes' in flask.session:
+
+        return flask.render_template('show_memories.html',
+                                     memories=loaded_board().to_list())
+
+    page = rendered_index(bool(flask.session.get('deity')))
+    encodings = flask.request.accept_encodings
+    encoding = next((encoding for encoding in page.encoded
+                     if encodings[encoding]), None)
+
+    # Each encoding is its own representation, with its own ETag.
+    etag = page.etag + "-" + encoding if encoding else page.etag
+
+    if etag in flask.request.if_none_match:
+        response = flask.Response(status=304)
+    elif encoding:
+        response = flask.Response(page.encoded[encoding],
+                                  mimetype="text/html")
+        response.content_encoding = encoding
+    else:
+        response = flask.Response(page.body, mimetype="text/html")
+
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    response.vary.update(["Accept-Encoding", "Cookie"])
+
+    return response
+
+
+class RenderedPage(object):
+    """A page rendered once and served many times.
+
+    Attributes:
+        body (str): UTF-8 HTML.
+        encoded (OrderedDict): Content-Encoding to the body
+            compressed with it, best first.
+        etag (str): Hash of the body.
+
+    """
+
+    def __init__(self, html):
+        self.body = html.encode("utf-8")
+        self.etag = hashlib.sha1(self.body).hexdigest()
+        self.encoded = collections.OrderedDict()
+
+        if brotli is not None:
+            self.encoded["br"] = brotli.compress(self.body)
+
+        gzip_io = StringIO()
+
+        with gzip.GzipFile(fileobj=gzip_io, mode="wb", mtime=0) as gzipped:
+            gzipped.write(self.body)
+
+        self.encoded["gzip"] = gzip_io.getvalue()
+
+
+# Board version the pages below were rendered from, and
+# the pages themselves: one for deities, one for the rest.
+rendered_pages = {"version": None}
+
+
+def rendered_index(deity):
+    """The index page, only rendered again when the board has
+    changed since.
+
+    Args:
+        deity (bool): Deities see a "Forget" button.
+
+    Returns:
+        RenderedPage: --
+
+    """
+
+    current_board = loaded_board()
+
+    if rendered_pages["version"] != current_board.version:
+        rendered_pages.clear()
+        rendered_pages["version"] = current_board.version
+
+    if deity not in rendered_pages:
+        html = flask.render_template('show_memories.html',
+                                     memories=current_board.to_list())
+        rendered_pages[deity] = RenderedPage(html)
 
-    return flask.render_template('show_memories.html',
-                                 memories=memories_for_jinja)
+    return rendered_pages[deity]
 
 
 def validate(memory_text):
@@ -488,7 +1271,7 @@ def validate(memory_text):
         return app.config["ERROR_TOO_LONG"], 400
 
     # you cannot repost something already in the memories
-    if Memory.query.filter_by(text=memory_text).all():
+    if loaded_board().has_text(memory_text):
 
         return app.config["ERROR_UNORIGINAL"], 400
 
@@ -501,7 +1284,7 @@ def validate(memory_text):
 def new_memory():
     """Attempt to add a new memory.
 
-    Forget the 11th oldest memory.
+    Forget whichever memories no longer fit on the board.
 
     The memory must meet these requirements:
 
@@ -509,65 +1292,160 @@ def new_memory():
       * 140 characters or less
       * Cannot already exist in the database
 
-    The memory is checked for possible SlashCommand(s).
+    The memory is checked for a slash command, see
+    `slash_commands`; ASYNC ones are answered with a 202
+    right away, see `start_command()`.
 
     """
 
     memory_text = flask.request.form['text'].strip()
-    original_memory_text = memory_text
     validation_payload = validate(memory_text)
 
     if validation_payload:
 
         return validation_payload
 
-    # commands
-    slash_commands = [SlashLogin, SlashLogout, SlashDanbooru]
+    command = slash_commands.find(memory_text)
 
-    for slash_command in slash_commands:
-        result = slash_command.attempt(memory_text)
+    if command is not None:
+        slash_command, args = command
 
-        if result is None:
+        if not slash_command.accepts(len(args)):
 
-            # only happens if it is a non-match
-            continue
+            return "%s incorrect args" % slash_command.NAME, 400
 
-        elif result.create_memory is True:
-            memory_text = result.value
+        if slash_command.ASYNC:
 
-            break
+            return start_command(slash_command, args)
 
-        elif result.create_memory is False:
+        result = slash_command.callback(*args)
+
+        if result.create_memory is False:
 
             return result.value
 
+        memory_text = result.value
+
     # We do not want to submit anything that didn't execute
     # a slash command, but starts with a slash! This is in
     # case of an event like "/logni password", so it's not
     # broadcasted to the entire world.
-    #
-    # At this point, either we have made a change to the
-    # database and return'd out, or we modified the memory
-    # text, in which it'll differ from original_memory.
-    if memory_text[0] == '/' and memory_text == original_memory_text:
+    elif memory_text[0] == '/':
 
         return "Invalid Slash Command", 400
 
-    # If there are ten memories already, delete the oldest
-    # to make room!
-    memories_to_delete = (Memory.query.order_by(Memory.id.desc()).
-                          offset(9))
+    error = remember(memory_text)
+
+    if error:
 
-    if memories_to_delete:
+        return error
 
-        for memory in memories_to_delete:
-            db.session.delete(memory)
+    return flask.redirect(flask.url_for('show_memories'))
+
+
+def remember(memory_text):
+    """Create a memory, and forget whichever memories no
+    longer fit on the board.
+
+    Args:
+        memory_text (str): Already validated.
+
+    Returns:
+        tuple[str, int]|None: The error response, if it
+            couldn't be created.
+
+    """
 
     new_memory = Memory(text=memory_text)
+
+    # Don't even start on an image if we couldn't glitch it.
+    if new_memory.image_status and thumbnail_jobs.full():
+
+        return app.config["ERROR_BUSY"], 503
+
+    # One transaction: insert, then forget everything which
+    # fell off the board, in a single DELETE.
     db.session.add(new_memory)
+
+    try:
+        db.session.flush()
+
+    except IntegrityError:
+        # someone beat us to it, maybe through another worker;
+        # the database has the final say on what's unoriginal.
+        db.session.rollback()
+
+        return app.config["ERROR_UNORIGINAL"], 400
+
+    forget_memories_off_board(app.config["BOARD_SIZE"])
+    forget_orphaned_thumbnails()
     db.session.commit()
 
-    return flask.redirect(flask.url_for('show_memories'))
+    if new_memory.image_status:
+
+        try:
+            thumbnail_jobs.submit(make_thumbnail, new_memory.id,
+                                  new_memory.text)
+
+        except jobs.QueueFull:
+            # it filled up while we were committing; the memory
+            # stays, as a link without a thumbnail
+            new_memory.image_status = "failed"
+            db.session.commit()
+
+    backend.publish({"event": "memory", "id": new_memory.id})
+
+    return None
+
+
+def start_command(slash_command, args):
+    """Run an ASYNC slash command in the background.
+
+    Returns:
+        flask.Response: 202, with the ticket the command's
+            "command" event will carry, so the poster can
+            tell it's theirs:
+
+                >>> {"ticket": "9b2f6c1ed4a0a873"}
+
+    """
+
+    ticket = os.urandom(8).encode("hex")
+
+    try:
+        command_jobs.submit(run_command, slash_command, args, ticket)
+
+    except jobs.QueueFull:
+
+        return app.config["ERROR_BUSY"], 503
+
+    return flask.jsonify(ticket=ticket), 202
+
+
+def run_command(slash_command, args, ticket):
+    """Background job: run an ASYNC slash command, and let
+    everyone know how it went; the poster knows the ticket.
+
+    A memory it creates is streamed like any other.
+
+    """
+
+    outcome = (app.config["ERROR_BUSY"], 503)  # unless it gets further
+
+    try:
+        result = slash_command.callback(*args)
+
+        if result.create_memory:
+
+            with app.app_context():
+                outcome = remember(result.value) or ("", 201)
+
+        else:
+            outcome = result.value
+
+    finally:
+        backend.publish({"event": "command", "ticket": ticket,
+                         "message": outcome[0], "status": outcome[1]})
 
 
 @app.route('/forget', methods=['POST'])
@@ -585,8 +1463,15 @@ def forget():
     if not flask.session.get('deity'):
         flask.abort(401)
 
-    Memory.query.filter_by(id=flask.request.form["id"]).delete()
+    try:
+        memory_id = int(flask.request.form["id"])
+    except ValueError:
+        flask.abort(400)
+
+    Memory.query.filter_by(id=memory_id).delete()
+    forget_orphaned_thumbnails()
     db.session.commit()
+    backend.publish({"event": "forget", "id": memory_id})
 
     return flask.redirect(flask.url_for('show_memories'))
 
@@ -598,11 +1483,28 @@ if app.config["SQLALCHEMY_DATABASE_URI"] == "sqlite:///:memory:":
     # it at the beginning of every app run.
     init_db()
 
+relay = Relay(app.config["SSE_REPLAY_SIZE"])
+backend.listen(relay)
+
+# One greenlet per connection, under `staticfuzz.py serve`
+# only; None under gunicorn, which keeps its own.
+connections = None
+
 if __name__ == '__main__':
     arguments = docopt.docopt(__doc__)
 
     if arguments["init_db"]:
         init_db()
 
+    if arguments["optimize_backgrounds"]:
+        optimize_backgrounds()
+
+    if arguments["profile_glitch"]:
+        profile_glitch(arguments["<files>"], int(arguments["--seed"]),
+                       int(arguments["--repeat"]), arguments["--pstats"],
+                       arguments["--preset"])
+
     if arguments["serve"]:
-        WSGIServer(('', app.config["PORT"]), app).serve_forever()
+        connections = gevent.pool.Pool()
+        WSGIServer(('', app.config["PORT"]), app,
+                   spawn=connections).serve_forever()
@@ -0,0 +1,97 @@
+"""Storage profiles for the database.
+
+By default a file-backed sqlite database uses a rollback
+journal, and every request opens a new connection. The
+tuned profile is meant for serving from a file: the
+write-ahead log lets streams and pages read while a
+memory is being written, and connections are pooled and
+reused, each set up once when it is opened.
+
+"""
+
+import sqlalchemy
+import sqlalchemy.engine.url
+import sqlalchemy.pool
+
+
+def is_sqlite_file(uri):
+    """True if `uri` is a sqlite database on disk.
+
+    >>> is_sqlite_file("sqlite:////tmp/staticfuzz.db")
+    True
+    >>> is_sqlite_file("sqlite:///:memory:")
+    False
+
+    """
+
+    url = sqlalchemy.engine.url.make_url(uri)
+
+    return (url.drivername.startswith("sqlite") and
+            url.database not in (None, "", ":memory:"))
+
+
+def is_tuned(config):
+    """True if the tuned profile applies to this config."""
+
+    return (config["SQLITE_TUNED"] and
+            is_sqlite_file(config["SQLALCHEMY_DATABASE_URI"]))
+
+
+def engine_options(config):
+    """Keyword arguments for the engine, see `SQLAlchemy()`.
+
+    Args:
+        config (flask.Config): The app's config.
+
+    Returns:
+        dict: Empty unless `is_tuned(config)`.
+
+    """
+
+    if not is_tuned(config):
+
+        return {}
+
+    # Pooled connections are handed from greenlet to
+    # greenlet, never used by two at once.
+    return {"poolclass": sqlalchemy.pool.QueuePool,
+            "pool_size": config["SQLITE_POOL_SIZE"],
+            "connect_args": {"check_same_thread": False,
+                             "timeout": config["SQLITE_BUSY_TIMEOUT_MS"] /
+                             1000.0}}
+
+
+def pragmas(config):
+    """The statements every tuned connection starts with.
+
+    Returns:
+        list[str]: --
+
+    """
+
+    return ["PRAGMA journal_mode=WAL",
+            "PRAGMA synchronous=NORMAL",
+            "PRAGMA busy_timeout=%d" % config["SQLITE_BUSY_TIMEOUT_MS"],
+            "PRAGMA mmap_size=%d" % config["SQLITE_MMAP_BYTES"]]
+
+
+def tune(engine, config):
+    """Run `pragmas(config)` on each connection `engine` opens.
+
+    WAL sticks to the database file once set, the others
+    only last as long as the connection, which the pool
+    keeps around.
+
+    """
+
+    statements = pragmas(config)
+
+    def on_connect(dbapi_connection, connection_record):
+        cursor = dbapi_connection.cursor()
+
+        for statement in statements:
+            cursor.execute(statement)
+
+        cursor.close()
+
+    sqlalchemy.event.listen(engine, "connect", on_connect)
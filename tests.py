@@ -1,19 +1,1354 @@
+import subprocess
+import sqlite3
+import socket
+import struct
+import gzip
+import random
+import json
+import time
+import zlib
+import re
+import sys
+import os
+
+import gevent
+import gevent.pywsgi
 import pytest
+import sqlalchemy
+import limits
+import limits.storage
+import limits.strategies
+import requests
+
+from PIL import Image
+try:
+    from cStringIO import StringIO
+except ImportError:
+    from StringIO import StringIO
+
 import staticfuzz
+import backgrounds
+import glitch
+import cache
+import danbooru
+import commands
+import jobs
+import glitchpool
+import ingest
+import bench
+import metrics
+import board
+import broadcast
+import ratelimit
+
+
+HERE = os.path.dirname(os.path.abspath(__file__))
 
 
 @pytest.fixture
 def app():
+    staticfuzz.limiter.enabled = False
 
     return staticfuzz.app
 
 
+class StandInServer(object):
+    """Local HTTP server standing in for image hosts and APIs.
+
+    Attributes:
+        routes (dict): Path to (status, headers, body).
+        hits (list[str]): Path of every request received.
+
+    """
+
+    def __init__(self):
+        self.routes = {}
+        self.hits = []
+        self.server = gevent.pywsgi.WSGIServer(("127.0.0.1", 0), self,
+                                               log=None)
+        self.server.start()
+        self.url = "http://127.0.0.1:%d" % self.server.server_port
+
+    def __call__(self, environ, start_response):
+        self.hits.append(environ["PATH_INFO"])
+        status, headers, body = self.routes.get(environ["PATH_INFO"],
+                                                ("404 Not Found", [], ""))
+        start_response(status, headers)
+
+        if isinstance(body, list):
+
+            return self.trickle(body)
+
+        return [body]
+
+    def trickle(self, chunks):
+        """Send each of `chunks` on its own, a moment apart, so
+        they aren't read as one.
+
+        """
+
+        for chunk in chunks:
+            yield chunk
+            gevent.sleep(0.01)
+
+    def serve(self, path, body, content_type="image/png",
+              status="200 OK"):
+        """Serve `body` at `path`; a list of strings is sent as
+        that many chunks.
+
+        """
+
+        self.routes[path] = (status, [("Content-Type", content_type)], body)
+
+        return self.url + path
+
+
+@pytest.fixture
+def stand_in():
+    server = StandInServer()
+    yield server
+    server.server.stop()
+
+
+def png_bytes(size=(64, 48), color=(200, 30, 90)):
+    image_io = StringIO()
+    Image.new("RGB", size, color).save(image_io, "PNG")
+
+    return image_io.getvalue()
+
+
 def test_index_route(client):
     resp = client.get('/')
     assert resp.status_code == 200
 
 
-def test_new_memory(client):
-    resp = client.post('/new_memory', data={'text': '/danbooru goo_girl'},
-                       follow_redirects=True)
+def fake_danbooru(stand_in, posts):
+    """Serve `posts` as every Danbooru search's results.
+
+    Returns:
+        str: The fake Danbooru's base URL.
+
+    """
+
+    stand_in.serve("/posts.json", json.dumps(posts), "application/json")
+
+    return stand_in.url
+
+
+def command_outcome(queue):
+    """The data of the next "command" event on a hub queue."""
+
+    while True:
+        frame = queue.get(timeout=1)
+
+        if frame.startswith("event: command\n"):
+
+            return json.loads(frame.split("data: ", 1)[1])
+
+
+def test_new_memory(client, stand_in, monkeypatch):
+    stand_in.serve("/data/goo.png", png_bytes())
+    monkeypatch.setattr(staticfuzz.danbooru_search, "base_url",
+                        fake_danbooru(stand_in,
+                                      [{"file_url": "/data/goo.png"}]))
+    queue = staticfuzz.hub.subscribe()
+
+    try:
+        resp = client.post('/new_memory', data={'text': '/danbooru goo_girl'})
+        assert resp.status_code == 202
+        staticfuzz.command_jobs.join()
+        outcome = command_outcome(queue)
+    finally:
+        staticfuzz.hub.unsubscribe(queue)
+
+    assert outcome == {"ticket": resp.json["ticket"], "message": "",
+                       "status": 201}
+    assert staticfuzz.Memory.query.filter_by(
+        text=stand_in.url + "/data/goo.png").count() == 1
+
+
+def test_slow_slash_command_failure_reaches_the_poster(client, stand_in,
+                                                       monkeypatch):
+    monkeypatch.setattr(staticfuzz.danbooru_search, "base_url",
+                        fake_danbooru(stand_in, []))
+    queue = staticfuzz.hub.subscribe()
+
+    try:
+        resp = client.post('/new_memory', data={'text': '/danbooru no_such'})
+        staticfuzz.command_jobs.join()
+        outcome = command_outcome(queue)
+    finally:
+        staticfuzz.hub.unsubscribe(queue)
+
+    assert outcome == {
+        "ticket": resp.json["ticket"],
+        "message": staticfuzz.app.config["ERROR_DANBOORU"], "status": 400}
+
+
+def test_slash_commands_are_found_by_name(client):
+    registry = commands.SlashCommandRegistry()
+
+    @registry.register
+    class SlashBroken(commands.SlashCommand):
+        NAME = u"broken"
+
+        @staticmethod
+        def callback(first, second=None):
+            raise TypeError("a bug, not the poster's fault")
+
+    assert registry.find(u"just text") is None
+    assert registry.find(u"/unknown thing") is None
+    assert registry.find(u"/BROKEN  One two") == (SlashBroken,
+                                                  [u"one", u"two"])
+    assert not SlashBroken.accepts(0)
+    assert SlashBroken.accepts(2) and not SlashBroken.accepts(3)
+    assert staticfuzz.SlashDanbooru.accepts(5)
+
+    with pytest.raises(ValueError):
+        registry.register(SlashBroken)
+
+    resp = client.post('/new_memory', data={'text': '/login'})
+    assert resp.status_code == 400
+    assert resp.data == "login incorrect args"
+
+    resp = client.post('/new_memory', data={'text': '/logni lain'})
+    assert resp.status_code == 400
+
+
+def test_danbooru_searches_are_cached_and_shared(stand_in):
+    base_url = fake_danbooru(stand_in, [{"file_url": "/data/a.jpg"},
+                                        {"file_url": "/data/b.webm"},
+                                        {"id": 3},  # hidden
+                                        {"file_url": "https://cdn/c.png"}])
+    search = danbooru.Danbooru(base_url, 5, cache.TTLCache(8, 0.2))
+    searches = [gevent.spawn(search.search, tags)
+                for tags in (["goo_girl", "1girl"], ["1GIRL", "goo_girl"])]
+    gevent.joinall(searches, raise_error=True)
+
+    assert searches[0].value == [base_url + "/data/a.jpg", "https://cdn/c.png"]
+    assert searches[1].value == searches[0].value
+    assert search.search(["goo_girl", "1girl"]) == searches[0].value
+    assert stand_in.hits == ["/posts.json"]
+
+    gevent.sleep(0.25)
+    search.search(["goo_girl", "1girl"])
+    assert stand_in.hits == ["/posts.json"] * 2
+    assert search.stats()["expirations"] == 1
+
+    stand_in.serve("/posts.json", "", status="500 Internal Server Error")
+
+    with pytest.raises(danbooru.DanbooruUnavailable):
+        search.search(["goo_girl"])
+
+    assert search.stats()["failed"] == 1
+
+
+def test_danbooru_waiters_outlive_a_killed_search(monkeypatch):
+    search = danbooru.Danbooru("http://unused", 5, cache.TTLCache(8, 60))
+    monkeypatch.setattr(search, "request", lambda key: gevent.sleep(10))
+    leader = gevent.spawn(search.search, ["slow"])
+    gevent.sleep(0)
+    waiter = gevent.spawn(search.search, ["slow"])
+    gevent.sleep(0)
+
+    leader.kill()  # like the timeout of the command it ran for
+    waiter.join(timeout=1)
+    assert waiter.ready()
+    assert isinstance(waiter.exception, danbooru.DanbooruUnavailable)
+    assert not search.pending
+
+
+def test_danbooru_prefetches_popular_searches(stand_in):
+    base_url = fake_danbooru(stand_in, [{"file_url": "/data/a.png"}])
+    search = danbooru.Danbooru(base_url, 5, cache.TTLCache(8, 0.2), 1)
+
+    try:
+        search.search(["popular"])
+        search.search(["popular"])
+        search.search(["unpopular"])
+        gevent.sleep(0.15)  # prefetched once, at 0.1s
+        assert stand_in.hits == ["/posts.json"] * 3
+        assert search.counters["prefetched"] == 1
+
+        search.search(["popular"])  # would have expired at 0.2s
+        assert stand_in.hits == ["/posts.json"] * 3
+    finally:
+        search.prefetcher.kill()
+
+
+def test_new_memory_is_published(client):
+    queue = staticfuzz.hub.subscribe()
+
+    try:
+        resp = client.post('/new_memory', data={'text': 'published'})
+        assert resp.status_code == 302
+        frame = queue.get(timeout=1)
+    finally:
+        staticfuzz.hub.unsubscribe(queue)
+
+    assert frame.startswith("id: ")
+    assert '"published"' in frame
+
+
+@pytest.fixture
+def start_workers(tmpdir):
+    """A function running staticfuzz workers, which are all
+    killed when the test is over.
+
+    """
+
+    processes = []
+
+    def start(count, extra_settings=""):
+        """Run `count` staticfuzz workers sharing one database
+        and a Unix socket broadcast backend, each on its own
+        port.
+
+        Args:
+            extra_settings (str): Appended to every worker's
+                settings file.
+
+        Returns:
+            tuple[list, list[str]]: The processes and their URLs.
+
+        """
+
+        database = tmpdir.join("staticfuzz.db")
+        broadcast_socket = tmpdir.join("broadcast.sock")
+        started = []
+        urls = []
+
+        for index in range(count):
+            port = free_port()
+            settings = tmpdir.join("worker%d.cfg" % index)
+            settings.write("SQLALCHEMY_DATABASE_URI = 'sqlite:///%s'\n"
+                           "BROADCAST_BACKEND = 'unix://%s'\n"
+                           "RATELIMIT_ENABLED = False\n"
+                           "PORT = %d\n" % (database, broadcast_socket, port) +
+                           extra_settings)
+            environment = dict(os.environ, STATICFUZZ_SETTINGS=str(settings))
+
+            if index == 0:
+                subprocess.check_call([sys.executable, "staticfuzz.py",
+                                       "init_db"], env=environment, cwd=HERE)
+
+            started.append(subprocess.Popen([sys.executable, "staticfuzz.py",
+                                             "serve"],
+                                            env=environment, cwd=HERE))
+            urls.append("http://127.0.0.1:%d" % port)
+
+        processes.extend(started)
+
+        for url in urls:
+            wait_for(url)
+
+        return started, urls
+
+    yield start
+
+    for process in processes:
+        process.kill()
+        process.wait()
+
+
+def free_port():
+    listener = socket.socket()
+    listener.bind(("127.0.0.1", 0))
+    port = listener.getsockname()[1]
+    listener.close()
+
+    return port
+
+
+def wait_for(url, timeout=10):
+    deadline = time.time() + timeout
+
+    while True:
+
+        try:
+            return requests.get(url)
+        except requests.exceptions.ConnectionError:
+
+            if time.time() > deadline:
+                raise
+
+            gevent.sleep(0.05)
+
+
+def read_memory_ids(response, ids):
+    """Append the ID of every memory streamed by `response`."""
+
+    for line in response.iter_lines(chunk_size=1):
+
+        if line.startswith("data: "):
+            ids.extend(memory["id"] for memory in json.loads(line[6:]))
+
+
+def test_workers_stream_every_memory_once_in_order(start_workers):
+    processes, urls = start_workers(3)
+
+    streams = [requests.get(url + "/stream/", stream=True)
+               for url in urls for __ in range(2)]
+    seen = [[] for __ in streams]
+    readers = [gevent.spawn(read_memory_ids, response, ids)
+               for response, ids in zip(streams, seen)]
+
+    for index in range(12):
+        url = urls[index % len(urls)]
+        resp = requests.post(url + "/new_memory",
+                             data={"text": "m%d" % index},
+                             allow_redirects=False)
+        assert resp.status_code == 302
+
+    with gevent.Timeout(10):
+
+        while not all(len(ids) >= 12 for ids in seen):
+            gevent.sleep(0.05)
+
+    gevent.sleep(0.2)  # anything extra would show up by now
+    gevent.killall(readers)
+
+    expected = sorted(seen[0])
+    assert len(set(expected)) == 12
+
+    for ids in seen:
+        assert ids == expected
+
+
+@pytest.mark.parametrize("size", [(1, 1), (1, 6), (6, 1), (2, 5), (37, 23)])
+def test_atkinson_dither_matches_reference(size):
+    generator = random.Random(size)
+    image = Image.new('L', size)
+    image.putdata([generator.randint(0, 255)
+                   for __ in range(size[0] * size[1])])
+    expected = glitch.atkinson_dither_reference(image).tobytes()
+
+    assert glitch.atkinson_dither_python(image).tobytes() == expected
+    assert glitch.atkinson_dither(image).tobytes() == expected
+
+
+def test_image_memory_downloads_once(client, stand_in):
+    uri = stand_in.serve("/once.png", png_bytes())
+    resp = client.post('/new_memory', data={'text': uri})
+    assert resp.status_code == 302
+    staticfuzz.thumbnail_jobs.join()
+
+    memory = staticfuzz.Memory.query.filter_by(text=uri).one()
+    assert memory.image_status == "ready"
+    assert memory.thumbnail
+    assert stand_in.hits == ["/once.png"]
+
+
+def test_thumbnail_route_is_cacheable(client, stand_in):
+    uri = stand_in.serve("/cached.png", png_bytes())
+    client.post('/new_memory', data={'text': uri})
+    staticfuzz.thumbnail_jobs.join()
+    memory = staticfuzz.Memory.query.filter_by(text=uri).one()
+    thumbnail_url = memory.to_dict()["thumbnail_url"]
+
+    resp = client.get(thumbnail_url)
+    assert resp.status_code == 200
+    assert resp.mimetype == "image/png"
+    assert resp.data.startswith("\x89PNG")
+    assert "immutable" in resp.headers["Cache-Control"]
+    etag = resp.headers["ETag"]
+
+    resp = client.get(thumbnail_url, headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+    assert not resp.data
+
+    assert client.get("/thumb/nope").status_code == 404
+
+
+@pytest.mark.parametrize("path, body, content_type, status", [
+    ("/missing.png", "", "image/png", "404 Not Found"),
+    ("/page.png", "<html></html>", "text/html", "200 OK"),
+    ("/liar.png", "<html></html>", "image/png", "200 OK"),
+    ("/huge.png", png_bytes((4000, 4000)), "image/png", "200 OK"),
+])
+def test_fetch_image_rejects(stand_in, path, body, content_type, status):
+    uri = stand_in.serve(path, body, content_type, status)
+
+    assert ingest.fetch_image(uri, 8 * 1024, 5) is None
+
+
+def test_fetch_image_checks_magic_numbers_across_chunks(stand_in):
+    image = png_bytes()
+    uri = stand_in.serve("/chunked.png", [image[:2], image[2:5], image[5:]])
+    assert ingest.fetch_image(uri, 8 * 1024, 5) == image
+
+    uri = stand_in.serve("/chunked-liar.png", ["\x89P", "<html></html>"])
+    assert ingest.fetch_image(uri, 8 * 1024, 5) is None
+
+    uri = stand_in.serve("/short-liar.png", ["\x89P", "NG"])
+    assert ingest.fetch_image(uri, 8 * 1024, 5) is None
+
+
+def bomb_png_bytes(width, height):
+    """A PNG whose header claims `width` x `height`, but with
+    only a few rows of pixels.
+
+    """
+
+    def chunk(kind, data):
+        crc = zlib.crc32(kind + data) & 0xffffffff
+
+        return struct.pack("!I", len(data)) + kind + data + struct.pack(
+            "!I", crc)
+
+    return ("\x89PNG\r\n\x1a\n" +
+            chunk("IHDR", struct.pack("!IIBBBBB", width, height, 8, 2, 0, 0,
+                                      0)) +
+            chunk("IDAT", zlib.compress("\0" * (width * 3 + 1) * 4)) +
+            chunk("IEND", ""))
+
+
+def test_fetch_image_stops_at_huge_header(stand_in):
+    bomb = bomb_png_bytes(12000, 12000) + "\0" * 100 * 1024
+    uri = stand_in.serve("/bomb.png", bomb)
+    assert ingest.fetch_image(uri, 1024 * 1024, 5) == bomb
+
+    response = ingest.session.get(uri, stream=True)
+    assert ingest.read_image(response, 1024 * 1024, time.time() + 5,
+                             25 * 1000 * 1000) is None
+    assert response.raw.tell() < 64 * 1024  # only the first chunks
+
+    uri = stand_in.serve("/fine.png", png_bytes())
+    assert ingest.fetch_image(uri, 1024 * 1024, 5, 25 * 1000 * 1000)
+
+
+# Glitches the image in argv[1] and prints how it went and
+# how much the peak RSS grew doing it, in KiB.
+MEASURE_GLITCH = """
+import resource, sys
+import glitch
+engine = glitch.GlitchEngine((360, 360), 2, 10, None, 25 * 1000 * 1000)
+image_bytes = open(sys.argv[1], "rb").read()
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+try:
+    engine.glitch(image_bytes, 1)
+    outcome = "glitched"
+except glitch.ImageTooLarge:
+    outcome = "refused"
+grown = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - before
+print("%s %d" % (outcome, grown))
+"""
+
+
+def test_glitch_peak_memory_is_bounded(tmpdir):
+    images = {"bomb.png": bomb_png_bytes(12000, 12000)}
+    image_io = StringIO()
+    Image.new("RGB", (4800, 3600), (40, 90, 200)).save(image_io, "JPEG")
+    images["photo.jpg"] = image_io.getvalue()
+    frames = [Image.new("P", (300, 300), index) for index in range(300)]
+    image_io = StringIO()
+    frames[0].save(image_io, "GIF", save_all=True, append_images=frames[1:])
+    images["animated.gif"] = image_io.getvalue()
+    results = {}
+
+    for name, image_bytes in images.items():
+        tmpdir.join(name).write(image_bytes, "wb")
+        output = subprocess.check_output([sys.executable, "-c",
+                                          MEASURE_GLITCH,
+                                          str(tmpdir.join(name))], cwd=HERE)
+        outcome, grown = output.split()[-2:]
+        results[name] = (outcome, int(grown))
+
+    assert results["bomb.png"][0] == "refused"
+    assert results["photo.jpg"][0] == "glitched"
+    assert results["animated.gif"][0] == "glitched"
+
+    # decoded whole, the bomb is 576MiB, the photo 66MiB and
+    # the animation 26MiB
+    for name, (outcome, grown) in results.items():
+        assert grown < 16 * 1024, name
+
+
+def test_image_memory_is_committed_before_thumbnail(client, stand_in):
+    uri = stand_in.serve("/slow.png", png_bytes())
+    queue = staticfuzz.hub.subscribe()
+
+    try:
+        resp = client.post('/new_memory', data={'text': uri})
+        assert resp.status_code == 302
+        assert stand_in.hits == []
+
+        memory_frame = queue.get(timeout=1)
+        assert '"pending"' in memory_frame
+
+        staticfuzz.thumbnail_jobs.join()
+        thumbnail_frame = queue.get(timeout=1)
+    finally:
+        staticfuzz.hub.unsubscribe(queue)
+
+    assert thumbnail_frame.startswith("event: thumbnail\n")
+    assert '"ready"' in thumbnail_frame
+
+
+def test_image_memory_fails_if_thumbnails_fill_up_meanwhile(client,
+                                                            monkeypatch):
+
+    def submit(*args):
+
+        raise jobs.QueueFull()
+
+    monkeypatch.setattr(staticfuzz.thumbnail_jobs, "submit", submit)
+    queue = staticfuzz.hub.subscribe()
+
+    try:
+        resp = client.post('/new_memory',
+                           data={'text': "http://example.com/late.png"})
+        assert resp.status_code == 302
+        memory_frame = queue.get(timeout=1)
+    finally:
+        staticfuzz.hub.unsubscribe(queue)
+
+    assert '"failed"' in memory_frame
+    memory = staticfuzz.Memory.query.filter_by(
+        text="http://example.com/late.png").one()
+    assert memory.image_status == "failed"
+
+
+def test_lru_cache_lists_its_directory_only_to_prune(tmpdir, monkeypatch):
+    directory = tmpdir.join("disk")
+    lru = cache.LRUCache(max_bytes=10, directory=str(directory),
+                         max_disk_bytes=1000)
+    listings = []
+    listdir = os.listdir
+    monkeypatch.setattr(cache.os, "listdir",
+                        lambda path: listings.append(path) or listdir(path))
+
+    for index in range(200):
+        lru.put("key%03d" % index, "x" * 10)
+
+    monkeypatch.undo()
+    # once at first, then every time 100 bytes have been written
+    assert len(listings) < 20
+    assert sum(path.size() for path in directory.listdir()) <= 1000
+    assert directory.join("key199").check()
+
+
+def test_job_queue_backpressure_and_timeout():
+    job_queue = jobs.JobQueue(workers=1, maxsize=1, timeout=0.05)
+    job_queue.submit(gevent.sleep, 1)
+    gevent.sleep(0)  # the worker takes the first job
+    job_queue.submit(gevent.sleep, 0)
+
+    with pytest.raises(jobs.QueueFull):
+        job_queue.submit(gevent.sleep, 0)
+
+    job_queue.join()
+    stats = job_queue.stats()
+
+    assert stats["depth"] == 0
+    assert stats["rejected"] == 1
+    assert stats["timed_out"] == 1
+    assert stats["completed"] == 1
+
+
+def test_lru_cache_evicts_and_falls_back_to_disk(tmpdir):
+    lru = cache.LRUCache(max_bytes=10, directory=str(tmpdir.join("disk")))
+    lru.put("a", "aaaa")
+    lru.put("b", "bbbb")
+    assert lru.get("a") == "aaaa"  # now b is the oldest
+    lru.put("c", "cccc")
+
+    assert lru.stats()["evictions"] == 1
+    assert "b" not in lru.entries
+    assert lru.get("b") == "bbbb"  # from disk
+    assert lru.get("z") is None
+
+    stats = lru.stats()
+    assert (stats["hits"], stats["disk_hits"], stats["misses"]) == (1, 1, 1)
+
+
+def test_glitch_reuses_cached_thumbnail():
+    image_bytes = png_bytes((500, 300), (1, 2, 3))
+
+    with staticfuzz.app.app_context():
+        thumbnail_cache = glitch.get_thumbnail_cache()
+        hits = thumbnail_cache.counters["hits"]
+        first = glitch.glitch_from_bytes(image_bytes)
+        second = glitch.glitch_from_bytes(image_bytes)
+
+    assert first.startswith("\x89PNG") and second.startswith("\x89PNG")
+    assert thumbnail_cache.counters["hits"] == hits + 1
+
+
+def test_random_image_redirects_to_cacheable_background(client):
+    resp = client.get('/random_image?random=1')
+    assert resp.status_code == 302
+    location = resp.headers["Location"]
+    assert "/backgrounds/" in location
+
+    resp = client.get(location)
+    assert resp.status_code == 200
+    assert resp.mimetype == "image/gif"
+    assert "max-age" in resp.headers["Cache-Control"]
+    etag = resp.headers["ETag"]
+
+    resp = client.get(location, headers={"If-None-Match": etag})
+    assert resp.status_code == 304
+
+    resp = client.get(location, headers={"Range": "bytes=0-5"})
+    assert resp.status_code == 206
+    assert resp.data.startswith("GIF")
+    assert len(resp.data) == 6
+
+    assert client.get('/backgrounds/nope.gif').status_code == 404
+
+
+def test_optimized_background_variant_is_negotiated(client, tmpdir,
+                                                    monkeypatch):
+    original = staticfuzz.background_index.get("dim.gif")
+    sizes = backgrounds.optimize(original, str(tmpdir), 200, 16, 2)
+    assert sizes and all(size < original.size for size in sizes.values())
+
+    variants = backgrounds.BackgroundIndex(str(tmpdir), 0)
+    monkeypatch.setattr(staticfuzz, "variant_index", variants)
+
+    resp = client.get('/backgrounds/dim.gif',
+                      headers={"Accept": "image/webp,image/*"})
+    assert resp.headers["Vary"] == "Accept"
+
+    if ".webp" in sizes:
+        assert resp.mimetype == "image/webp"
+        assert len(resp.data) == sizes[".webp"]
+
+    resp = client.get('/backgrounds/dim.gif', headers={"Accept": "*/*"})
+    assert resp.mimetype == "image/gif"
+    assert len(resp.data) == sizes.get(".gif", original.size)
+
+
+def test_stream_resumes_from_last_event_id(client):
+    memory_ids = []
+
+    for text in ("resume one", "resume two", "resume three"):
+        client.post('/new_memory', data={'text': text})
+        memory = staticfuzz.Memory.query.filter_by(text=text).one()
+        memory_ids.append(memory.id)
+
+    resp = client.get('/stream/', buffered=False,
+                      headers={"Last-Event-ID": str(memory_ids[0])})
+    frames = iter(resp.response)
+
+    try:
+        assert next(frames) == "retry: %d\n\n" % staticfuzz.app.config[
+            "RETRY_TIME_MS"]
+        replayed = [next(frames), next(frames)]
+    finally:
+        resp.close()
+
+    for memory_id, frame in zip(memory_ids[1:], replayed):
+        assert frame.startswith("id: %d\ndata: " % memory_id)
+        assert json.loads(frame.split("data: ", 1)[1])[0]["id"] == memory_id
+
+    # serialized once, replayed as is
+    assert replayed[0] is staticfuzz.relay.frames[memory_ids[1]]
+
+
+def test_stream_resumes_from_the_board_on_a_fresh_worker(client):
+    memory_ids = []
+
+    for text in ("board one", "board two", "board three"):
+        client.post('/new_memory', data={'text': text})
+        memory = staticfuzz.Memory.query.filter_by(text=text).one()
+        memory_ids.append(memory.id)
+
+    staticfuzz.relay.frames.clear()  # as if the worker just started
+    resp = client.get('/stream/', buffered=False,
+                      headers={"Last-Event-ID": str(memory_ids[0])})
+    frames = iter(resp.response)
+
+    try:
+        next(frames)  # retry:
+        replayed = [next(frames), next(frames)]
+    finally:
+        resp.close()
+
+    for memory_id, frame in zip(memory_ids[1:], replayed):
+        assert frame.startswith("id: %d\ndata: " % memory_id)
+        assert json.loads(frame.split("data: ", 1)[1])[0]["id"] == memory_id
+
+
+def test_workers_boards_match_database_after_concurrent_posts(tmpdir,
+                                                              start_workers):
+    processes, urls = start_workers(3)
+    generator = random.Random(11)
+
+    def post(index):
+        url = generator.choice(urls)
+        text = "concurrent %d" % generator.randint(0, 14)  # reposts too
+        resp = requests.post(url + "/new_memory", data={"text": text},
+                             allow_redirects=False)
+        assert resp.status_code in (302, 400)
+
+    gevent.joinall([gevent.spawn(post, index) for index in range(45)],
+                   raise_error=True)
+    gevent.sleep(0.5)  # let every worker's relay catch up
+
+    connection = sqlite3.connect(str(tmpdir.join("staticfuzz.db")))
+    stored = connection.execute("SELECT id, text FROM memories "
+                                "ORDER BY id").fetchall()
+    connection.close()
+    assert len(stored) == 10
+    assert len(set(text for __, text in stored)) == 10
+
+    for url in urls:
+        page = requests.get(url + "/").text
+        shown = [int(memory_id) for memory_id
+                 in re.findall(r'<li id="(\d+)">', page)]
+        assert shown == [memory_id for memory_id, __ in stored]
+
+
+def test_memory_records_are_lighter_than_orm_objects(client):
+    client.post('/new_memory', data={'text': 'record me'})
+    memory = staticfuzz.Memory.query.filter_by(text='record me').one()
+    record, = staticfuzz.memory_records(staticfuzz.Memory.id == memory.id)
+    assert record.to_dict() == memory.to_dict()
+    assert record.timestamp.endswith("Z")
+    assert staticfuzz.loaded_board().to_list()[-1] == record
+
+    results = bench.bench_records(20)
+    assert (results["objects_held_per_record_event"] <
+            results["objects_held_per_object_event"])
+    assert results["board_bytes_per_record"] < results["board_bytes_per_dict"]
+
+
+def test_stream_path_loads_no_orm_objects(client):
+    client.post('/new_memory', data={'text': 'stream me'})
+    memory_id = staticfuzz.Memory.query.filter_by(text='stream me').one().id
+    staticfuzz.db.session.expunge_all()
+    loads = []
+
+    def count_load(target, context):
+        loads.append(target)
+
+    sqlalchemy.event.listen(staticfuzz.Memory, "load", count_load)
+    queries = staticfuzz.queries_total.values[()]
+
+    try:
+        staticfuzz.relay.latest_memory_id = memory_id - 1
+        staticfuzz.relay({"event": "memory", "id": memory_id})
+        staticfuzz.relay({"event": "thumbnail", "id": memory_id})
+        staticfuzz.memory_board.load(staticfuzz.memory_records())
+        assert staticfuzz.queries_total.values[()] - queries == 3
+        assert loads == []
+
+        staticfuzz.Memory.query.filter_by(id=memory_id).one()
+        assert len(loads) == 1  # the ORM path would have shown up
+
+    finally:
+        sqlalchemy.event.remove(staticfuzz.Memory, "load", count_load)
+
+    assert all(isinstance(record, board.MemoryRecord)
+               for record in staticfuzz.loaded_board().to_list())
+
+
+def test_index_is_rendered_once_and_conditional(client):
+    client.post('/new_memory', data={'text': 'index once'})
+    client.get('/')  # shows the flashed message, if any
+
+    first = client.get('/', headers={"Accept-Encoding": "identity"})
+    second = client.get('/', headers={"Accept-Encoding": "identity"})
+    assert first.status_code == 200
+    assert first.headers["ETag"] == second.headers["ETag"]
+    assert "Cookie" in first.headers["Vary"]
+
+    etag = first.headers["ETag"].strip('"')
+    resp = client.get('/', headers={"Accept-Encoding": "identity",
+                                    "If-None-Match": '"%s"' % etag})
+    assert resp.status_code == 304
+    assert resp.data == ""
+
+    resp = client.get('/', headers={"Accept-Encoding": "gzip"})
+    assert resp.headers["Content-Encoding"] == "gzip"
+    assert "Accept-Encoding" in resp.headers["Vary"]
+    assert gzip.GzipFile(fileobj=StringIO(resp.data)).read() == first.data
+
+    client.post('/new_memory', data={'text': 'index changed'})
+    client.get('/')
+    resp = client.get('/', headers={"Accept-Encoding": "identity",
+                                    "If-None-Match": '"%s"' % etag})
+    assert resp.status_code == 200
+    assert "index changed" in resp.data
+
+
+def test_board_size_holds_under_concurrent_duplicate_posts(tmpdir,
+                                                           start_workers):
+    processes, urls = start_workers(2, "BOARD_SIZE = 4\n")
+    statuses = []
+
+    def post(index):
+        # every text is posted by both workers at once
+        text = "stress %d" % (index // 2)
+        resp = requests.post(urls[index % 2] + "/new_memory",
+                             data={"text": text}, allow_redirects=False)
+        statuses.append((text, resp.status_code))
+
+    gevent.joinall([gevent.spawn(post, index) for index in range(40)],
+                   raise_error=True)
+
+    assert set(status for __, status in statuses) <= set([302, 400])
+    created = set(text for text, status in statuses if status == 302)
+    assert len(created) == 20
+
+    connection = sqlite3.connect(str(tmpdir.join("staticfuzz.db")))
+    stored = connection.execute("SELECT id, text FROM memories "
+                                "ORDER BY id").fetchall()
+    connection.close()
+    assert len(set(text for __, text in stored)) == 4
+
+    # only the newest four survived
+    newest = stored[-1][0]
+    assert [memory_id for memory_id, __ in stored] == range(newest - 3,
+                                                            newest + 1)
+
+
+def test_tuned_sqlite_profile_uses_wal(tmpdir, start_workers):
+    processes, urls = start_workers(2, "SQLITE_TUNED = True\n")
+
+    def post(index):
+        resp = requests.post(urls[index % 2] + "/new_memory",
+                             data={"text": "tuned %d" % index},
+                             allow_redirects=False)
+        assert resp.status_code == 302
+
+    gevent.joinall([gevent.spawn(post, index) for index in range(20)],
+                   raise_error=True)
+
+    connection = sqlite3.connect(str(tmpdir.join("staticfuzz.db")))
+    journal_mode, = connection.execute("PRAGMA journal_mode").fetchone()
+    count, = connection.execute("SELECT COUNT(*) FROM memories").fetchone()
+    connection.close()
+    assert journal_mode == "wal"
+    assert count == 10
+
+
+def test_load_benchmark_runs_offline():
+    # concurrent image posts used to deadlock a worker
+    results = bench.bench_load("", 8, 2, 2, 0.5)
+
+    assert results["statuses"] == {302: 16}
+    assert results["events_delivered"] == 16 * 2
+    assert results["post_p99_ms"] >= results["post_p50_ms"] > 0
+    json.dumps(results)
+
+
+def test_metrics_endpoint(client):
+    client.get('/')
+    client.post('/new_memory', data={'text': 'metrics please'})
+
+
+    with staticfuzz.app.test_request_context('/random_image'):
+        assert staticfuzz.ratelimit_handler(None)[1] == 429
+
+    resp = client.get('/metrics')
     assert resp.status_code == 200
+    assert resp.mimetype == "text/plain"
+    lines = resp.data.splitlines()
+
+    def sample(prefix):
+
+        return float(next(line for line in lines
+                          if line.startswith(prefix)).rsplit(" ", 1)[1])
+
+    assert sample('staticfuzz_request_seconds_count{endpoint="show_memories"}')
+    assert sample('staticfuzz_request_queries_bucket{endpoint="new_memory",'
+                  'le="+Inf"}')
+    assert sample('staticfuzz_queries_total') > 0
+    assert sample('staticfuzz_ratelimited_total{endpoint="random_image"}')
+    assert sample('staticfuzz_events_published_total{event="memory"}')
+    assert sample('staticfuzz_thumbnail_jobs{stat="depth"}') == 0
+    assert "# TYPE staticfuzz_glitch_stage_seconds histogram" in lines
+
+
+def test_histogram_buckets_are_cumulative():
+    histogram = metrics.Histogram("example_seconds", "Example.", ["kind"],
+                                  buckets=(0.1, 1.0))
+
+    for value in (0.05, 0.5, 0.5, 5.0):
+        histogram.observe(value, kind='say "hi"')
+
+    assert histogram.render()[2:] == [
+        'example_seconds_bucket{kind="say \\"hi\\"",le="0.1"} 1.0',
+        'example_seconds_bucket{kind="say \\"hi\\"",le="1.0"} 3.0',
+        'example_seconds_bucket{kind="say \\"hi\\"",le="+Inf"} 4.0',
+        'example_seconds_sum{kind="say \\"hi\\""} 6.05',
+        'example_seconds_count{kind="say \\"hi\\""} 4.0']
+
+
+def test_profile_glitch_reports_every_stage(app, tmpdir, capsys):
+    image_path = tmpdir.join("source.png")
+    image_path.write(png_bytes((120, 90)), mode="wb")
+    pstats_path = tmpdir.join("glitch.pstats")
+
+    staticfuzz.profile_glitch([str(image_path)], 3, 2, str(pstats_path))
+
+    report = capsys.readouterr().out
+    assert "source.png: %d bytes in" % image_path.size() in report
+
+    for stage in ("thumbnail", "jpeg", "quantize", "dither", "png"):
+        assert re.search(r"^  %s +\d+ +[\d.]+ +(n/a|[\d.]+)$" % stage,
+                         report, re.MULTILINE)
+
+    assert pstats_path.size() > 0
+    assert not [hook for hook in glitch.stage_hooks
+                if isinstance(hook, glitch.StageProfiler)]
+
+
+def test_glitch_engine_is_reproducible_without_an_app():
+    engine = glitch.GlitchEngine((90, 90), 2, 8)
+    image_bytes = png_bytes((200, 150), (90, 160, 20))
+
+    first, parameters = engine.glitch(image_bytes, 42)
+    second, __ = engine.glitch(image_bytes, 42)
+    assert first == second
+    assert parameters["seed"] == 42
+    assert 2 <= parameters["colors"] <= 8
+
+    # the parameters alone are enough to make it again
+    again, __ = engine.glitch(image_bytes, 0, fixed=parameters)
+    assert again == first
+
+    mono, used = engine.glitch(image_bytes, 42, glitch.PRESETS["mono"])
+    assert used["dark"] == (0, 0, 0) and used["light"] == (255, 255, 255)
+    assert used["colors"] == parameters["colors"]
+    assert Image.open(StringIO(mono)).size[0] <= 90
+
+
+def test_glitch_preset_comes_from_config(app, monkeypatch):
+    assert glitch.preset(None) is None
+    assert glitch.preset("harsh") is glitch.PRESETS["harsh"]
+
+    with pytest.raises(ValueError):
+        glitch.preset("nope")
+
+    monkeypatch.setattr(staticfuzz, "glitch_preset", glitch.PRESETS["mono"])
+    monkeypatch.setattr(staticfuzz, "glitch_pool", None)
+    thumbnail = staticfuzz.glitch_image(png_bytes((120, 90), (90, 160, 20)))
+    pixels = Image.open(StringIO(thumbnail)).convert("RGB").getdata()
+    assert all(red == green == blue for red, green, blue in pixels)
+
+
+def noise_png_bytes(size):
+    image_io = StringIO()
+    Image.frombytes("RGB", size, os.urandom(size[0] * size[1] * 3)).save(
+        image_io, "PNG")
+
+    return image_io.getvalue()
+
+
+def test_glitch_pool_replaces_crashed_and_slow_children():
+    pool = glitchpool.GlitchPool(1, {"max_size": [64, 64],
+                                     "min_colors": 2,
+                                     "max_colors": 4,
+                                     "max_pixels": None,
+                                     "cache_bytes": 1024 * 1024,
+                                     "cache_directory": None,
+                                     "cache_disk_bytes": 0}, 10)
+    image_bytes = png_bytes()
+    glitched, parameters = pool.glitch(image_bytes, 3)
+    engine = glitch.GlitchEngine((64, 64), 2, 4)
+    assert glitched == engine.glitch(image_bytes, 3)[0]
+    assert parameters["seed"] == 3
+
+    with pytest.raises(glitchpool.GlitchFailed):
+        pool.glitch("not an image", 3)  # the child carries on
+
+    pool.idle.peek().kill()
+
+    with pytest.raises(glitchpool.GlitchFailed):
+        pool.glitch(image_bytes, 3)
+
+    pool.timeout = 0.001
+
+    with pytest.raises(glitchpool.GlitchFailed):
+        pool.glitch(noise_png_bytes((600, 600)), 3)
+
+    pool.timeout = 10
+    assert pool.glitch(image_bytes, 3)[0] == glitched
+    assert pool.glitch(image_bytes, 4)[0] != glitched
+    stats = pool.stats()
+    cache_stats = stats.pop("cache")
+    assert stats == {"idle": 1, "glitched": 3, "failed": 3, "replaced": 2}
+
+    # the first child's misses (the image, then "not an
+    # image") outlive it; the last child missed, then hit
+    assert cache_stats["misses"] == 3 and cache_stats["hits"] == 1
+    assert cache_stats["entries"] == 1
+
+
+def test_stream_keeps_up_while_glitching(start_workers, stand_in):
+    uris = [stand_in.serve("/noise%d.png" % index,
+                           noise_png_bytes((900, 900)))
+            for index in range(6)]
+    processes, urls = start_workers(1, "GLITCH_PROCESSES = 2\n")
+    frames = []
+
+    def listen():
+        response = requests.get(urls[0] + "/stream/", stream=True)
+
+        for line in response.iter_lines(chunk_size=1):
+
+            if line.startswith("data: "):
+                frames.append((time.time(), line))
+
+    listener = gevent.spawn(listen)
+
+    for uri in uris:
+        requests.post(urls[0] + "/new_memory", data={"text": uri},
+                      allow_redirects=False)
+
+    gevent.sleep(0.2)  # the glitching is well under way
+    posted = time.time()
+    requests.post(urls[0] + "/new_memory", data={"text": "still here"},
+                  allow_redirects=False)
+
+    with gevent.Timeout(10):
+
+        while not any("still here" in line for __, line in frames):
+            gevent.sleep(0.01)
+
+    delivered = [at for at, line in frames if "still here" in line][0]
+    assert delivered - posted < 0.25  # about one glitch, in the worker
+    listener.kill()
+
+    # the children's caches are reported by the worker
+    with gevent.Timeout(30):
+
+        while not worker_metric(urls[0], 'staticfuzz_glitch_pool'
+                                '{stat="glitched"}'):
+            gevent.sleep(0.1)
+
+    assert worker_metric(urls[0],
+                         'staticfuzz_glitch_cache{stat="misses"}') >= 1
+
+
+def test_token_bucket_refills_one_hit_at_a_time(tmpdir, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "time", lambda: now[0])
+    storage = ratelimit.SQLiteStorage("sqlite:///%s" % tmpdir.join("l.db"))
+    strategy = limits.strategies.STRATEGIES["token-bucket"](storage)
+    item = limits.parse("3/minute")
+
+    assert [strategy.hit(item, "a") for __ in range(4)] == [True] * 3 + [False]
+    assert strategy.hit(item, "b")  # every client has its own bucket
+    assert strategy.get_window_stats(item, "a") == (1060, 0)
+
+    now[0] += 19
+    assert not strategy.test(item, "a")
+    now[0] += 1  # one hit every 20 seconds
+    assert strategy.get_window_stats(item, "a") == (1060, 1)
+    assert strategy.hit(item, "a")
+    assert not strategy.hit(item, "a")
+
+    with pytest.raises(NotImplementedError):
+        limits.strategies.STRATEGIES["token-bucket"](
+            limits.storage.MemoryStorage())
+
+
+def test_sqlite_rate_limit_storage_deletes_expired(tmpdir, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(ratelimit.time, "time", lambda: now[0])
+    path = tmpdir.join("l.db")
+    storage = ratelimit.SQLiteStorage("sqlite:///%s" % path,
+                                      cleanup_seconds=30)
+    item = limits.parse("5/second")
+    limits.strategies.STRATEGIES["fixed-window"](storage).hit(item, "a")
+    limits.strategies.STRATEGIES["token-bucket"](storage).hit(item, "b")
+    assert storage.get(item.key_for("a")) == 1
+
+    now[0] += 2
+    assert storage.get(item.key_for("a")) == 0  # expired, not yet deleted
+
+    def rows():
+        connection = sqlite3.connect(str(path))
+        counted = [connection.execute("SELECT count(*) FROM %s" % table).
+                   fetchone()[0] for table in ("counters", "buckets")]
+        connection.close()
+
+        return counted
+
+    assert rows() == [1, 1]
+    now[0] += 30
+    assert storage.incr("c", 1) == 1
+    assert rows() == [1, 0]
+
+
+def test_workers_share_rate_limits_through_sqlite(tmpdir, start_workers):
+    processes, urls = start_workers(
+        2,
+        "RATELIMIT_ENABLED = True\n"
+        "RATELIMIT_STORAGE_URL = 'sqlite:///%s'\n"
+        "RATELIMIT_STRATEGY = 'token-bucket'\n" % tmpdir.join("limits.db"))
+
+    statuses = [requests.post(url + "/new_memory",
+                              data={"text": "limited %s" % url},
+                              allow_redirects=False).status_code
+                for url in urls]
+    assert statuses == [302, 429]  # 1/second, whichever worker
+
+    time.sleep(1)
+    resp = requests.post(urls[1] + "/new_memory",
+                         data={"text": "limited again"},
+                         allow_redirects=False)
+    assert resp.status_code == 302
+
+
+def test_limiter_benchmark_runs(tmpdir):
+    results = bench.bench_limiter(200, str(tmpdir))
+    assert results["sqlite_token_bucket_1000_microseconds"] > 0
+    assert results["memory_moving_window_1000_microseconds"] > 0
+
+
+def test_hub_drops_subscribers_which_fall_behind():
+    hub = broadcast.Hub(max_queued=2)
+    reading, stalled = hub.subscribe(), hub.subscribe()
+
+    for index in range(3):
+        assert hub.publish("frame %d" % index) == (2 if index < 2 else 1)
+        reading.get()
+
+    assert hub.subscribers == {reading}
+    assert hub.dropped == 1
+    assert stalled.qsize() == 2  # nothing more was queued for it
+
+
+def open_stream(url):
+    """Connect to /stream/ with a bare socket, which can be
+    dropped without a goodbye; returns it once connected.
+
+    """
+
+    host, port = url.rsplit("/", 1)[1].split(":")
+    connection = socket.create_connection((host, int(port)))
+    connection.sendall("GET /stream/ HTTP/1.1\r\nHost: %s\r\n\r\n" % host)
+    received = ""
+
+    while "retry: " not in received:
+        received += connection.recv(4096)
+
+    return connection
+
+
+def worker_metric(url, name):
+    lines = requests.get(url + "/metrics").text.splitlines()
+
+    return float(next(line for line in lines
+                      if line.startswith(name + " ")).split(" ")[1])
+
+
+def test_streams_stay_flat_under_connection_churn(start_workers):
+    processes, urls = start_workers(1,
+                                    "STREAM_MAX_CONNECTIONS = 20\n"
+                                    "STREAM_BUSY_RETRY_MS = 2500\n"
+                                    "STREAM_HEARTBEAT_SECONDS = 0.1\n")
+    url = urls[0]
+
+    def rss_bytes():
+
+        with open("/proc/%d/status" % processes[0].pid) as status:
+            line = next(line for line in status if line.startswith("VmRSS"))
+
+        return int(line.split()[1]) * 1024
+
+    def wait_until_closed():
+
+        with gevent.Timeout(5):
+
+            while worker_metric(url, "staticfuzz_streams_open"):
+                gevent.sleep(0.05)
+
+    connection = open_stream(url)
+    gevent.sleep(0.35)
+    assert connection.recv(4096).count(":\n\n") >= 2  # heartbeats
+    connection.close()
+    wait_until_closed()
+
+    for round_number in range(15):
+        connections = [open_stream(url) for __ in range(20)]
+        refused = requests.get(url + "/stream/", timeout=5)
+        assert refused.status_code == 503
+        assert refused.headers["Retry-After"] == "3"
+        assert refused.text == "retry: 2500\n\n"
+
+        for connection in connections:
+            connection.close()  # no goodbye, like a dead proxy
+
+        wait_until_closed()  # within a couple of heartbeats
+
+        if round_number == 4:
+            settled_rss = rss_bytes()
+
+    assert worker_metric(url, "staticfuzz_connections_open") <= 2
+    assert worker_metric(url, "staticfuzz_streams_refused_total") == 15
+    assert rss_bytes() - settled_rss < 2 * 1024 * 1024
+
+
+def test_stream_resume_skips_forgotten_memories(client):
+    memory_ids = []
+
+    for text in ("keep one", "forget me", "keep two"):
+        client.post('/new_memory', data={'text': text})
+        memory = staticfuzz.Memory.query.filter_by(text=text).one()
+        memory_ids.append(memory.id)
+
+    with client.session_transaction() as session:
+        session['deity'] = True
+
+    client.post('/forget', data={'id': memory_ids[1]})
+    forget_frame = broadcast.forget_frame(memory_ids[1])
+
+    def replay(last_event_id, count):
+        resp = client.get('/stream/', buffered=False,
+                          headers={"Last-Event-ID": str(last_event_id)})
+        frames = iter(resp.response)
+
+        try:
+            next(frames)  # retry:
+
+            return [next(frames) for __ in range(count)]
+        finally:
+            resp.close()
+
+    # never saw it: the memory isn't sent at all
+    replayed = replay(memory_ids[0], 1)
+    assert replayed[0].startswith("id: %d\n" % memory_ids[2])
+    assert memory_ids[1] not in staticfuzz.relay.frames
+
+    # saw it before it was forgotten: told to forget it
+    replayed = replay(memory_ids[1], 2)
+    assert replayed[0] == forget_frame
+    assert replayed[1].startswith("id: %d\n" % memory_ids[2])
+
+
+def test_stage_hooks_finish_stages_which_raise(monkeypatch):
+    profiler = glitch.StageProfiler()
+    monkeypatch.setattr(glitch, "stage_hooks", [profiler])
+
+    with pytest.raises(IOError):
+
+        with glitch.stage("decode"):
+
+            raise IOError("truncated")
+
+    assert profiler.stages["decode"]["calls"] == 1
+
+    if glitch.tracemalloc is None:
+        assert profiler.stages["decode"]["allocated_bytes"] is None
+
+
+def test_stream_gives_up_on_a_client_which_stopped_reading():
+    frames = staticfuzz.event(None, 1000, 5, 0.1)
+
+    def stalled_server():
+        next(frames)
+        gevent.sleep(1)  # like a write to a full socket buffer
+
+    writer = gevent.spawn(stalled_server)
+    writer.join(timeout=2)
+    assert isinstance(writer.exception, socket.timeout)
+
+    frames.close()  # as the server does
+    assert len(staticfuzz.hub.subscribers) == 0